@@ -1,12 +1,17 @@
-import http.client
 import logging
+import threading
+import time
 import urllib.parse
 from json import dumps, loads
 from pathlib import Path
-from urllib.request import urlopen, Request
+
+from connection_pool import ConnectionPool, PoolResponse
+from json_stream import iter_list_content
+from metrics import METRICS
+from transport import TransportPolicy
+from upload import UploadBody
 
 logger = logging.getLogger('alist.client')
-logger.setLevel('DEBUG')
 
 
 class AlistException(Exception):
@@ -21,6 +26,10 @@ class AlistServerExpcetion(AlistException):
     pass
 
 
+class ServerUnavailable(AlistServerExpcetion):
+    """HTTP 5xx / 429, 可以重试"""
+
+
 class NoAuth(AlistException):
     pass
 
@@ -50,13 +59,114 @@ class AlistApi:
     fs_link = '/fs/link'
     fs_add_aria2 = '/fs/add_aria2'
 
+    task_copy_undone = '/admin/task/copy/undone'
+    task_copy_done = '/admin/task/copy/done'
+    task_copy_retry = '/admin/task/copy/retry'
+    task_copy_cancel = '/admin/task/copy/cancel'
+
+
+# 幂等的接口, 失败时可以重试
+IDEMPOTENT_APIS = (AlistApi.me, AlistApi.fs_list, AlistApi.fs_get, AlistApi.fs_dirs, AlistApi.fs_link,
+                   AlistApi.task_copy_undone, AlistApi.task_copy_done)
+
+
+def retryable(error: BaseException) -> bool:
+    """传输错误 和 HTTP 5xx; Alist 在 HTTP 200 的响应中返回的 code 500 (例如 object not found) 不重试"""
+    return isinstance(error, ServerUnavailable) or TransportPolicy.transport_error(error)
+
+
+def transport_policy(**kwargs) -> TransportPolicy:
+    """按 Alist 的接口创建 TransportPolicy, 参数见 TransportPolicy"""
+    kwargs.setdefault('idempotent', IDEMPOTENT_APIS)
+    kwargs.setdefault('retryable', retryable)
+    return TransportPolicy(**kwargs)
+
+
+class PageSizer:
+    """根据测得的延迟和响应大小调整 fs_list 的 per_page
+
+    per_page 总是 2 的幂，响应太慢或太大时减半，又快又小时翻倍。
+    一个客户端共用一个 PageSizer，学到的页大小在目录之间延续。
+    """
+
+    def __init__(self, start=64, min_size=16, max_size=4096, target_latency=1.0, max_bytes=2 * 1024 * 1024):
+        self.per_page = start
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+
+    def feed(self, per_page, count, elapsed, nbytes):
+        """记录一页的 延迟(秒) 和 响应字节数"""
+        if count < per_page:  # 不满一页，无法推断更大的页会怎样
+            return
+        if elapsed > self.target_latency or nbytes > self.max_bytes:
+            self.per_page = max(self.min_size, per_page // 2)
+        elif elapsed * 2 < self.target_latency and nbytes * 2 < self.max_bytes:
+            self.per_page = min(self.max_size, per_page * 2)
+
+
+class _ListPager:
+    """fs_list 分页状态
+
+    :param per_page: None 自适应; 0 一次列出全部 (服务器不支持时退回分页); >0 固定页大小
+    """
+
+    def __init__(self, sizer: PageSizer, per_page=None):
+        self.sizer = sizer
+        self.fixed = per_page
+        self.offset = 0
+        self.total = None
+        self.done = False
+        self._per_page = None
+        self._skip = 0
+
+    def next_page(self):
+        """返回下一个请求的 page, per_page"""
+        if self.fixed is not None and (self.fixed or self.offset == 0):
+            per_page = self.fixed
+        else:
+            per_page = self.sizer.per_page
+            if self._per_page and per_page > self._per_page and self.offset % per_page:
+                per_page = self._per_page  # 当前位置与更大的页没有对齐，暂不放大
+        self._per_page = per_page
+        self._skip = self.offset % per_page if per_page else 0
+        return (self.offset // per_page + 1 if per_page else 1), per_page
+
+    def feed(self, res_data: dict, elapsed, nbytes) -> list:
+        """处理一页响应，返回新的条目"""
+        content = (res_data or dict()).get('content') or []
+        skip = self._skip
+        self.advance(len(content), (res_data or dict()).get('total'), elapsed, nbytes)
+        return content[skip:]
+
+    def advance(self, count, total, elapsed, nbytes):
+        """记录一页响应: 条目数 (包含需要跳过的), total"""
+        self.total = self.total if total is None else total
+        if self._per_page and self.fixed is None:
+            self.sizer.feed(self._per_page, count, elapsed, nbytes)
+        new = max(count - self._skip, 0)
+        self.offset += new
+        if not new or (self.total is not None and self.offset >= self.total) \
+                or (self.total is None and self._per_page and count < self._per_page):
+            self.done = True
+
+    @property
+    def skip(self):
+        """当前页开头需要跳过的条目数"""
+        return self._skip
+
 
 class _Client:
     """Alist 请求客户端"""
 
-    def __init__(self, base_url: str, ):
+    def __init__(self, base_url: str, pool: ConnectionPool = None, policy: TransportPolicy = None):
 
         self.base_url = base_url[:-1] if base_url.endswith('/') else base_url
+        self.pool = pool or ConnectionPool()
+        self.policy = policy or transport_policy()
+        self.page_sizer = PageSizer()
+        self._local = threading.local()
 
         self.headers = dict()
         self._init()
@@ -67,7 +177,8 @@ class _Client:
         self.headers['User-Agent'] = 'AlistClient/Python 0.1'
         self.headers['Content-Type'] = 'application/json;charset=UTF-8'
 
-    def urlopen(self, method, uri, json=None, headers=None, data=None):
+    def _prepare(self, uri, json=None, headers=None, data=None):
+        """返回 url, headers, body"""
         if data is not None and json is not None:
             raise ValueError('json 和 data 不能同时提供')
         if not isinstance(data, (str, bytes, bytearray, type(None))):
@@ -77,11 +188,41 @@ class _Client:
         headers = headers if headers else dict()
         [headers.update({k: v}) for k, v in self.headers.items() if k not in headers]
         data = data.encode() if isinstance(data, str) else data
+        return url, headers, data or dumps(json).encode()
 
-        request = Request(method=method, url=url, headers=headers, data=data or dumps(json).encode())
-        logger.debug('REQUEST: %s %s --> header=%s  data=%s', method, url, headers, json)
-        resp = urlopen(request)
-        return self.verify_response(resp)
+    def urlopen(self, method, uri, json=None, headers=None, data=None):
+        url, headers, body = self._prepare(uri, json, headers, data)
+
+        api = uri.split('?')[0]
+
+        def send(timeout):
+            logger.debug('REQUEST: %s %s --> header=%s  data=%s', method, url, headers, json)
+            start = time.perf_counter()
+            try:
+                resp = self.pool.urlopen(method, url, body=body, headers=headers, timeout=timeout)
+            except Exception:
+                if METRICS.enabled:
+                    self._observe(api, time.perf_counter() - start, len(body), 0, 'error')
+                raise
+            if METRICS.enabled:
+                self._observe(api, time.perf_counter() - start, len(body), len(resp.data), resp.status)
+            self._local.last_response_size = len(resp.data)
+            return self.verify_response(resp)
+
+        return self.policy.call(url, api, send)
+
+    @staticmethod
+    def _observe(api, elapsed, sent, received, status):
+        """记录一个请求的指标"""
+        METRICS.inc('alist_requests_total', api=api, status=status)
+        METRICS.observe('alist_request_seconds', elapsed, api=api)
+        METRICS.inc('alist_sent_bytes_total', sent, api=api)
+        METRICS.inc('alist_received_bytes_total', received, api=api)
+
+    @property
+    def last_response_size(self) -> int:
+        """当前线程最后一个响应的字节数"""
+        return getattr(self._local, 'last_response_size', 0)
 
     def url_json(self, api):
         api = api if api.startswith('/') else api + '/'
@@ -91,19 +232,33 @@ class _Client:
         self.headers.update(Authorization=token)
 
     @staticmethod
-    def verify_response(resp: http.client.HTTPResponse) -> dict:
+    def verify_response(resp: PoolResponse) -> dict:
         """验证响应信息"""
         resp_data = resp.read().decode()
         logger.debug('RESPONSE: %s --> [%d] %s', resp.geturl(), resp.getcode(), resp_data)
-        resp_json = loads(resp_data)
-        if resp.getcode() == 200 and resp_json['code'] == 200:
-            return resp_json['data']
-        elif resp.getcode() == 403 or resp_json['code'] == 403:
-            raise NoAuth(f'{resp_json["code"]}: {resp_json["message"]}')
-        elif resp.getcode() // 100 == 5 or resp_json['code'] // 100 == 5:
-            raise AlistServerExpcetion(f'{resp_json["code"]}: {resp_json["message"]}')
+        try:
+            resp_json = loads(resp_data)
+        except ValueError:
+            if resp.getcode() // 100 == 5 or resp.getcode() == 429:
+                raise ServerUnavailable(f'{resp.getcode()}: {resp_data[:200]}')
+            raise BadResponse(f'{resp.getcode()}: {resp_data[:200]}')
+        _Client.verify_code(resp.getcode(), resp_json)
+        return resp_json['data']
+
+    @staticmethod
+    def verify_code(status: int, resp_json: dict):
+        """根据 HTTP 状态码和响应中的 code 抛出对应的异常"""
+        code = resp_json.get('code')
+        if status == 200 and code == 200:
+            return
+        elif status == 403 or code == 403:
+            raise NoAuth(f'{code}: {resp_json.get("message")}')
+        elif status // 100 == 5 or status == 429:
+            raise ServerUnavailable(f'{status}: {resp_json.get("message")}')
+        elif isinstance(code, int) and code // 100 == 5:
+            raise AlistServerExpcetion(f'{code}: {resp_json.get("message")}')
         else:
-            raise HTTPRequestException(f'{resp_json["code"]}: {resp_json["message"]}')
+            raise HTTPRequestException(f'{code}: {resp_json.get("message")}')
 
     def me(self) -> dict:
         """检查权限"""
@@ -133,8 +288,8 @@ class _Client:
 
 class _ClientFs(_Client):
 
-    def fs_list(self, path, page=0, per_page=10, refresh_token=False):
-        """列出指定位置的全部内容"""
+    def fs_list(self, path, page=1, per_page=10, refresh_token=False):
+        """列出指定位置的全部内容, page 从 1 开始, per_page=0 时列出全部"""
         data = {
             "path": path,
             "page": page,
@@ -143,16 +298,81 @@ class _ClientFs(_Client):
         }
         return self.urlopen('POST', AlistApi.fs_list, json=data)
 
-    def fs_list_iter(self, path, refresh_token=False):
-        """返回生成器"""
-        page = 0
-        while True:
-            res_data = self.fs_list(path, page=page, per_page=20, refresh_token=refresh_token)
-            if not res_data.get('content'):
-                break
-            for i in res_data.get('content'):
-                yield i
-            page += 1
+    def fs_list_stream(self, path, page=1, per_page=0, refresh_token=False, fields=None, meta=None):
+        """流式的 fs_list, 从连接中逐个解析并返回 content 中的条目
+
+        :param fields: 只保留这些字段, 例如 ('name', 'is_dir', 'modified', 'size')
+        :param meta: 解析完成后填充 total 等字段 及 读取的字节数 nbytes
+        """
+        data = {
+            "path": path,
+            "page": page,
+            "per_page": per_page,
+            "refresh": refresh_token
+        }
+        url, headers, body = self._prepare(AlistApi.fs_list, json=data)
+        logger.debug('REQUEST: %s %s --> header=%s  data=%s', 'POST', url, headers, data)
+        meta = dict() if meta is None else meta
+        start = time.perf_counter()
+        try:
+            time.sleep(self.policy.admit(url))
+            start = time.perf_counter()
+            self.policy.acquire(url)
+            try:
+                with self.pool.stream('POST', url, body=body, headers=headers,
+                                      timeout=self.policy.timeout(AlistApi.fs_list)) as resp:
+                    if resp.status != 200:
+                        self.verify_response(PoolResponse(url, resp.status, resp.headers, resp.read()))
+                    yield from iter_list_content(resp.read, fields=fields, meta=meta,
+                                                 verify=lambda m: self.verify_code(resp.status, m))
+            finally:
+                self.policy.release(url)
+        except Exception as _e:
+            self.policy.record(url, _e)
+            if METRICS.enabled:
+                self._observe(AlistApi.fs_list, time.perf_counter() - start, len(body), meta.get('nbytes', 0),
+                              'error')
+            raise
+        self.policy.record(url)
+        if METRICS.enabled:
+            self._observe(AlistApi.fs_list, time.perf_counter() - start, len(body), meta.get('nbytes', 0),
+                          resp.status)
+
+    def fs_list_iter(self, path, refresh_token=False, per_page=None, stream=False, fields=None):
+        """返回生成器
+
+        :param per_page: None 根据延迟和响应大小自适应; 0 一次列出全部; >0 固定页大小
+        :param stream: 使用 fs_list_stream 逐个解析条目, 不在内存中保留完整的页
+        :param fields: stream 模式下只保留这些字段
+        """
+        pager = _ListPager(self.page_sizer, per_page)
+        while not pager.done:
+            page, _per_page = pager.next_page()
+            start = time.monotonic()
+            if not stream:
+                res_data = self.fs_list(path, page=page, per_page=_per_page, refresh_token=refresh_token)
+                yield from pager.feed(res_data, time.monotonic() - start, self.last_response_size)
+                continue
+
+            meta, count, skip, attempt = dict(), 0, pager.skip, 0
+            while True:
+                try:
+                    for entry in self.fs_list_stream(path, page, _per_page, refresh_token, fields=fields,
+                                                     meta=meta):
+                        if count >= skip:
+                            yield entry
+                        count += 1
+                    break
+                except Exception as _e:
+                    delay = self.policy.retry_delay(AlistApi.fs_list, _e, attempt)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    logger.warning('列出 %s 失败, %.2f 秒后第 %d 次重试: %r', path, delay, attempt, _e)
+                    time.sleep(delay)
+                    # 重新请求这一页, 跳过已经返回的条目
+                    meta, count, skip = dict(), 0, max(skip, count)
+            pager.advance(count, meta.get('total'), time.monotonic() - start, meta.get('nbytes', 0))
 
     def fs_get(self, path):
         """获取文件或目录的详细信息"""
@@ -174,9 +394,46 @@ class _ClientFs(_Client):
         return self.urlopen('POST', AlistApi.fs_dirs, json=data)
 
     def fs_create_file(self, path, data):
-        """创建文件"""
-        path = urllib.parse.quote_plus(path)
-        return self.urlopen('PUT', AlistApi.fs_create_file, headers={'file-path': path}, data=data) is None
+        """创建文件, data 是 str / bytes; 大文件使用 fs_put_stream"""
+        return self.fs_put_stream(path, data.encode() if isinstance(data, str) else data)
+
+    def fs_put_stream(self, path, source, size=None, as_task=False, modified: float = None, on_progress=None):
+        """流式上传, 不把文件读入内存
+
+        :param source: 本地路径 | 二进制文件对象 | bytes-like (bytes, memoryview, mmap), 见 upload.UploadBody
+        :param size: 文件对象的字节数, 未知时使用 chunked 编码
+        :param as_task: 服务器接收后作为任务异步上传到存储
+        :param modified: 文件的修改时间 (时间戳), 支持的存储会保留
+        :param on_progress: 回调 (sent, size)
+        """
+        url = self.url_json(AlistApi.fs_create_file)
+        headers = dict(self.headers, **{'File-Path': urllib.parse.quote(path),
+                                        'Content-Type': 'application/octet-stream'})
+        if as_task:
+            headers['As-Task'] = 'true'
+        if modified is not None:
+            headers['Last-Modified'] = str(int(modified * 1000))
+
+        with UploadBody(source, size, on_progress) as body:
+            if body.size is not None:
+                headers['Content-Length'] = str(body.size)
+
+            def send(timeout):
+                logger.debug('REQUEST: PUT %s --> header=%s  size=%s', url, headers, body.size)
+                start = time.perf_counter()
+                try:
+                    resp = self.pool.urlopen('PUT', url, body=body, headers=headers, timeout=timeout)
+                except Exception:
+                    if METRICS.enabled:
+                        self._observe(AlistApi.fs_create_file, time.perf_counter() - start, body.sent, 0, 'error')
+                    raise
+                if METRICS.enabled:
+                    self._observe(AlistApi.fs_create_file, time.perf_counter() - start, body.sent, len(resp.data),
+                                  resp.status)
+                self._local.last_response_size = len(resp.data)
+                return self.verify_response(resp)
+
+            return self.policy.call(url, AlistApi.fs_create_file, send) is None
 
     def fs_mkdir(self, path, exist_ok=True, parents=True):
         """创建目录"""
@@ -220,14 +477,37 @@ class _ClientFs(_Client):
     def fs_from(self):
         raise NotImplementedError
 
-    def fs_link(self):
-        raise NotImplementedError
+    def fs_link(self, path) -> dict:
+        """文件的直链 {'url': ..., 'header': {name: [value, ]}}, 需要管理员权限"""
+        data = {
+            "path": path,
+        }
+        return self.urlopen('POST', AlistApi.fs_link, json=data)
 
     def fs_add_aria2(self):
         raise NotImplementedError
 
 
-class Client(_ClientFs, _Client):
+class _ClientTask(_Client):
+    """任务管理, 需要管理员权限"""
+
+    def task_copy_undone(self) -> list:
+        """未完成的复制任务"""
+        return self.urlopen('GET', AlistApi.task_copy_undone) or []
+
+    def task_copy_done(self) -> list:
+        """已完成 (成功, 失败, 取消) 的复制任务"""
+        return self.urlopen('GET', AlistApi.task_copy_done) or []
+
+    def task_copy_retry(self, tid):
+        """重试失败的复制任务"""
+        return self.urlopen('POST', f'{AlistApi.task_copy_retry}?tid={urllib.parse.quote(str(tid))}')
+
+    def task_copy_cancel(self, tid):
+        return self.urlopen('POST', f'{AlistApi.task_copy_cancel}?tid={urllib.parse.quote(str(tid))}')
+
+
+class Client(_ClientFs, _ClientTask, _Client):
     pass
 
 
@@ -237,6 +517,7 @@ def debug_log():
     cs.setFormatter(logger_fmt)
     cs.setLevel('DEBUG')
     logger.addHandler(cs)
+    logger.setLevel('DEBUG')
 
 
 def login():
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : async_client.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/02 21:40
+
+asyncio 版本的 Alist 客户端，接口与 alist_client.Client 保持一致，
+用于同时发起大量的目录列表、元数据请求。
+
+    async with AsyncClient('https://localhost/api', max_concurrency=100) as client:
+        await client.login('user', 'passwd')
+        infos = await asyncio.gather(*[client.fs_get(p) for p in paths])
+"""
+import asyncio
+import http.client
+import io
+import logging
+import time
+import urllib.parse
+
+from alist_client import _ClientFs, _ListPager, AlistApi, LoginError, PageSizer, transport_policy
+from connection_pool import PoolResponse
+from metrics import METRICS
+from transport import TransportPolicy
+
+logger = logging.getLogger('alist.client.async')
+
+
+class AsyncConnectionPool:
+    """asyncio Keep-Alive 连接池，每个 Host 最多 maxsize 个连接"""
+
+    def __init__(self, maxsize=100, timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+
+        self._idle = dict()
+        self._slots = dict()
+        self._stats = dict(requests=0, hits=0, new_connections=0, waits=0, discarded=0)
+
+    @property
+    def stats(self) -> dict:
+        return dict(self._stats)
+
+    def _slot(self, key) -> asyncio.Semaphore:
+        if key not in self._slots:
+            self._slots[key] = asyncio.Semaphore(self.maxsize)
+            self._idle[key] = list()
+        return self._slots[key]
+
+    async def _connect(self, key):
+        idle = self._idle[key]
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                self._stats['hits'] += 1
+                return reader, writer, True
+            writer.close()
+        self._stats['new_connections'] += 1
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(host, port, ssl=True if scheme == 'https' else None)
+        return reader, writer, False
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise http.client.RemoteDisconnected('Remote end closed connection without response')
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines.append(line)
+        headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines) + b'\r\n'))
+
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while await reader.readline() not in (b'\r\n', b'\n', b''):
+                        pass  # 忽略 trailer
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(chunks)
+        elif headers.get('Content-Length') is not None:
+            data = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            data = await reader.read()
+
+        will_close = headers.get('Connection', '').lower() == 'close' or version == 'HTTP/1.0' \
+            or headers.get('Content-Length') is None and headers.get('Transfer-Encoding') is None
+        return int(status), headers, data, will_close
+
+    async def urlopen(self, method, url, body=None, headers=None, timeout=None) -> PoolResponse:
+        parse = urllib.parse.urlsplit(url)
+        scheme = parse.scheme.lower()
+        key = (scheme, parse.hostname, parse.port or (443 if scheme == 'https' else 80))
+        target = parse.path or '/'
+        if parse.query:
+            target += '?' + parse.query
+        body = body or b''
+        lines = [f'{method} {target} HTTP/1.1', f'Host: {parse.netloc}', f'Content-Length: {len(body)}']
+        lines.extend(f'{k}: {v}' for k, v in (headers or dict()).items())
+        raw = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+        slot = self._slot(key)
+        if slot.locked():
+            self._stats['waits'] += 1
+        self._stats['requests'] += 1
+        async with slot:
+            while True:
+                reader, writer, reused = await self._connect(key)
+                try:
+                    writer.write(raw)
+                    status, resp_headers, data, will_close = await asyncio.wait_for(
+                        self._read_response(reader), self.timeout if timeout is None else timeout)
+                except (http.client.RemoteDisconnected, ConnectionError, asyncio.IncompleteReadError):
+                    self._stats['discarded'] += 1
+                    writer.close()
+                    if reused:
+                        continue
+                    raise
+                except BaseException:
+                    self._stats['discarded'] += 1
+                    writer.close()
+                    raise
+                if will_close:
+                    self._stats['discarded'] += 1
+                    writer.close()
+                else:
+                    self._idle[key].append((reader, writer))
+                return PoolResponse(url, status, resp_headers, data)
+
+    async def close(self):
+        for idle in self._idle.values():
+            while idle:
+                _, writer = idle.pop()
+                writer.close()
+
+
+class AsyncClient(_ClientFs):
+    """异步 Alist 客户端
+
+    直接继承自 _ClientFs 的方法 (fs_list, fs_get, fs_dir, fs_rename, fs_move, fs_copy, fs_remove, fs_link)
+    返回的是 coroutine，需要 await。fs_list_stream, fs_put_stream 依赖同步的连接池, 不支持。
+
+    :param max_concurrency: 同时进行中的最大请求数
+    :param policy: 限速、重试、熔断策略, 与 Client 相同
+    """
+
+    def __init__(self, base_url: str, max_concurrency=100, timeout=60, policy: TransportPolicy = None):
+        self.base_url = base_url[:-1] if base_url.endswith('/') else base_url
+        self.pool = AsyncConnectionPool(maxsize=max_concurrency, timeout=timeout)
+        self.policy = policy or transport_policy()
+        self.page_sizer = PageSizer()
+
+        self.headers = dict()
+        self._init()
+
+        self.me_info = dict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def urlopen(self, method, uri, json=None, headers=None, data=None):
+        return (await self._urlopen_sized(method, uri, json, headers, data))[0]
+
+    async def _urlopen_sized(self, method, uri, json=None, headers=None, data=None):
+        """返回 (data, 响应的字节数); 多个 coroutine 共用一个客户端, 响应大小随响应返回, 不保存在实例上"""
+        url, headers, body = self._prepare(uri, json, headers, data)
+
+        api = uri.split('?')[0]
+
+        async def send(timeout):
+            logger.debug('REQUEST: %s %s --> header=%s  data=%s', method, url, headers, json)
+            start = time.perf_counter()
+            try:
+                resp = await self.pool.urlopen(method, url, body=body, headers=headers, timeout=timeout)
+            except Exception:
+                if METRICS.enabled:
+                    self._observe(api, time.perf_counter() - start, len(body), 0, 'error')
+                raise
+            if METRICS.enabled:
+                self._observe(api, time.perf_counter() - start, len(body), len(resp.data), resp.status)
+            return self.verify_response(resp), len(resp.data)
+
+        return await self.policy.acall(url, api, send)
+
+    async def me(self) -> dict:
+        """检查权限"""
+        me_info = await self.urlopen(method='GET', uri=AlistApi.me) or dict()
+        self.me_info.update(me_info)
+        return me_info
+
+    async def login(self, user, passwd, opt=''):
+        """登陆"""
+        data = {
+            "username": user,
+            "password": passwd,
+            "otp_code": opt
+        }
+        data = await self.urlopen(method='POST', uri=AlistApi.login, json=data)
+        if data:
+            self.set_token(data['token'])
+            if (await self.me()).get('username') == user:
+                logger.info('%s 登陆成功。', user)
+            else:
+                logger.error('%s 登陆失败 ... ', user)
+                raise LoginError('%s 登陆失败 ... ', user)
+        else:
+            raise LoginError('%s 登陆失败, 没有返回 token ... ', user)
+
+    async def fs_list_iter(self, path, refresh_token=False, per_page=None):
+        """返回异步生成器, per_page 与 Client.fs_list_iter 相同"""
+        pager = _ListPager(self.page_sizer, per_page)
+        while not pager.done:
+            page, _per_page = pager.next_page()
+            start = time.monotonic()
+            res_data, nbytes = await self._urlopen_sized('POST', AlistApi.fs_list, json={
+                "path": path,
+                "page": page,
+                "per_page": _per_page,
+                "refresh": refresh_token
+            })
+            for i in pager.feed(res_data, time.monotonic() - start, nbytes):
+                yield i
+
+    def fs_list_stream(self, *args, **kwargs):
+        raise NotImplementedError('AsyncClient 不支持 fs_list_stream, 使用 fs_list_iter')
+
+    def fs_put_stream(self, *args, **kwargs):
+        raise NotImplementedError('AsyncClient 不支持 fs_put_stream, 大文件使用 alist_client.Client 上传')
+
+    async def fs_create_file(self, path, data):
+        """创建文件"""
+        path = urllib.parse.quote(path)
+        return await self.urlopen('PUT', AlistApi.fs_create_file, headers={'File-Path': path}, data=data) is None
+
+    async def fs_mkdir(self, path, exist_ok=True, parents=True):
+        """创建目录"""
+        return await self.urlopen('POST', AlistApi.fs_mkdir, json={'path': path}) is None
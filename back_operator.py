@@ -1,21 +1,59 @@
 import abc
 import atexit
+import functools
 import logging
 import os
+import sys
 import time
 import urllib.parse
 from abc import ABCMeta
 from pathlib import Path
-from typing import List
+from typing import List, Optional
+
+from metrics import METRICS
+from tools import atomic_write_text
 
 logger = logging.getLogger('alist.sync.operator')
 
+_DELETED = object()
+
+METRICS.set_buckets('operator_seconds', (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.01, 0.1, 1.0, 10.0, 60.0))
+
+
+def _timed(op):
+    """指标开启时记录 operator_seconds{backend, op}"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not METRICS.enabled:
+                return func(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                METRICS.observe('operator_seconds', time.perf_counter() - start, backend=self.backend, op=op)
+
+        return wrapper
+
+    return decorator
+
+
+def _normalize_path(path: str) -> str:
+    """与 PurePosixPath(path).as_posix() 相同: 合并 '//', 去掉 '.' 和结尾的 '/'"""
+    if '//' in path or '/.' in path or path.startswith('.') or len(path) > 1 and path.endswith('/'):
+        parts = [p for p in path.split('/') if p and p != '.']
+        path = ('/' if path.startswith('/') else '') + '/'.join(parts)
+    return path or '.'
+
 
 class _OperatorBase(metaclass=abc.ABCMeta):
+    backend = None
 
     def __init__(self, cache_uri):
         self.uri_parse = urllib.parse.urlparse(cache_uri)
         self._item_dirs = set()
+        self._item_index = dict()
         self._init()
 
     @abc.abstractmethod
@@ -28,6 +66,10 @@ class _OperatorBase(metaclass=abc.ABCMeta):
         """验证值是否正确"""
         raise NotImplementedError()
 
+    def load_value(self, value):
+        """从存储中读出的值 (json 解析后) 转换为内存中的类型"""
+        return value
+
     @property
     def item_dirs(self):
         if self._item_dirs:
@@ -36,6 +78,7 @@ class _OperatorBase(metaclass=abc.ABCMeta):
 
     def add_item_dir(self, item_dir):
         self._item_dirs.add(item_dir)
+        self._build_item_index()
 
     def set_item_dirs(self, *item_dirs):
         x = []
@@ -46,19 +89,46 @@ class _OperatorBase(metaclass=abc.ABCMeta):
                 x.append(i)
 
         self._item_dirs = set(x)
+        self._build_item_index()
         logger.info('set items dir success, %s', self._item_dirs)
 
+    def _build_item_index(self):
+        """规范化的 item_dir 字符串 -> item_dir, 供 verify_path_relative_item_base 查找"""
+        self._item_index = {_normalize_path(os.fspath(i)): str(i) for i in self._item_dirs}
+
     def verify_path_relative_item_base(self, path):
-        """从Alist总是得到完整的绝对路径，我们需要将Path 分解为 sub_path & item_path"""
-        path = Path(path)
-        for item_dir in self.item_dirs:
-            if path.is_relative_to(item_dir):
-                return str(item_dir), path.relative_to(item_dir).as_posix()
-        raise ValueError(f'Path 应该相对与一个 item_dirs {self.item_dirs}')
+        """从Alist总是得到完整的绝对路径，我们需要将Path 分解为 sub_path & item_path
+
+        逐级截断 path 在 _item_index 中查找, 最深的 item_dir 优先, 不创建 Path 对象。
+        """
+        index = self._item_index or self.item_dirs
+        path = _normalize_path(path if type(path) is str else os.fspath(path))
+        prefix = path
+        while True:
+            item_dir = index.get(prefix)
+            if item_dir is not None:
+                if prefix == path:
+                    return item_dir, '.'
+                return item_dir, path[len(prefix):].lstrip('/')
+            cut = prefix.rfind('/')
+            if cut < 0 or prefix == '/':
+                raise ValueError(f'Path 应该相对与一个 item_dirs {self.item_dirs}')
+            prefix = prefix[:cut] or '/'
 
     @abc.abstractmethod
     def search_path(self, path) -> dict:
-        """查询一个路径"""
+        """查询一个路径, 没有记录或者 path 不在任何 item_dir 中时返回 None (各后端一致)"""
+
+    def select_path(self, path):
+        return self.search_path(path)
+
+    def iter_item(self, item_dir):
+        """遍历一个 item_dir 中的全部记录, 返回 (sub_path, value)"""
+        raise NotImplementedError()
+
+    def drop_item(self, item_dir):
+        """删除一个 item_dir 中的全部记录"""
+        raise NotImplementedError()
 
     def search_item(self, path, item_dir) -> dict:
         """"""
@@ -70,6 +140,10 @@ class _OperatorBase(metaclass=abc.ABCMeta):
         path 是一个绝对路径, 且必须相对于一个item_dir
         """
 
+    def _store(self, item_dir, sub_path, item_value):
+        """写入一条已经验证过的记录, 不再验证 (批量写入时已经整批验证)"""
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def create_path(self, path, path_value):
         """创建一个新的"""
@@ -78,18 +152,57 @@ class _OperatorBase(metaclass=abc.ABCMeta):
     def delete_path(self, path):
         pass
 
+    # 多个节点共享后端时的扫描协调, 本地后端只有一个节点: 总是获得租约, 总是最后一个结束
+    lease_ttl = 600
+
+    def enter_scan(self, item_dir):
+        """开始扫描 item_dir, 登记本节点"""
+
+    def leave_scan(self, item_dir) -> bool:
+        """结束扫描 item_dir, 返回是否是最后一个结束的节点 (可以清除扫描游标)"""
+        return True
+
+    def acquire_lease(self, path) -> bool:
+        """获取列出目录的租约, 只有获得租约的节点列出该目录"""
+        return True
+
+    def renew_lease(self, path):
+        """延长持有的租约, 列出很大的目录时定期调用"""
+
+    def release_lease(self, path, listing: list = None):
+        """释放租约; listing 为列出的子目录 [(name, value), ...] 时发布给其他节点, 本次扫描中不会再被列出"""
+
+    def shared_listing(self, path) -> Optional[list]:
+        """其他节点发布的子目录, 没有时返回 None"""
+        return None
+
 
 class JsonOperator(_OperatorBase, metaclass=ABCMeta):
-    """"""
+    """Json 后端, cache_uri: json:///path/to/cache.json
+
+    修改记录在 update_path / delete_path 中标记, 后台线程每 5 秒把修改追加到
+    <cache>.json.journal, 日志条目超过数据量时压缩为新的快照 (临时文件 + rename)。
+    启动时先读快照, 再重放日志。
+    """
+    backend = 'json'
+    save_interval = 5
+    compact_min_lines = 10000
 
     def _init(self):
+        from threading import Lock
+
         self.data = dict()
+        self._dirty = dict()  # (item_dir, sub_path) -> value; _DELETED 删除; sub_path=None 删除整个 item
+        self._lock = Lock()  # 保护 data 和 _dirty
+        self._io_lock = Lock()  # 保证日志追加与快照压缩串行
+        self._journal_lines = 0
 
         self.path = Path(self.uri_parse.path)
+        self.journal_path = self.path.with_name(self.path.name + '.journal')
         if self.path.exists():
-            from json import loads
-            self.data = loads(self.path.read_text(encoding='utf8'))
-        atexit.register(self.dumps_data)
+            self._load_snapshot()
+        self._replay_journal()
+        atexit.register(self.flush)
         self._thread()
         logger.debug('Json Operation Init Success . ')
 
@@ -99,47 +212,126 @@ class JsonOperator(_OperatorBase, metaclass=ABCMeta):
     def __enter__(self):
         return self
 
+    def _load_snapshot(self):
+        from json import loads
+        self.data = {sys.intern(item_dir): {k: self.load_value(v) for k, v in values.items()}
+                     for item_dir, values in loads(self.path.read_text(encoding='utf8')).items()}
+
+    def _apply(self, item_dir, sub_path, value):
+        if sub_path is None:
+            self.data.pop(item_dir, None)
+        elif value is _DELETED:
+            self.data.get(item_dir, dict()).pop(sub_path, None)
+        else:
+            self.data.setdefault(item_dir, dict())[sub_path] = value
+
+    def _replay_journal(self):
+        """重放日志, 跳过无法解析的记录 (写入时进程退出留下的不完整的行)
+
+        有坏记录或者最后一行没有换行时, 只保留完整的记录重写日志,
+        否则之后追加的第一条记录会接在坏记录后面, 同样无法解析。
+        """
+        if not self.journal_path.exists():
+            return
+        from json import loads
+        good, bad = [], 0
+        with self.journal_path.open('rb') as f:
+            for line in f:
+                try:
+                    record = loads(line)
+                except ValueError:
+                    logger.warning('忽略不完整的日志记录: %r', line[:200])
+                    bad += 1
+                    continue
+                self._apply(record[0], record[1], self.load_value(record[2]) if len(record) > 2 else _DELETED)
+                good.append(line if line.endswith(b'\n') else line + b'\n')
+                bad += not line.endswith(b'\n')
+        self._journal_lines = len(good)
+        if bad:
+            atomic_write_text(self.journal_path, b''.join(good).decode('utf8'))
+            logger.warning('日志 %s 中有 %d 条不完整的记录, 已重写', self.journal_path, bad)
+        logger.info('Replay %d journal records from %s', self._journal_lines, self.journal_path)
+
     def _thread(self):
 
         def dump_in_thread():
             logger.info('sub_thread is running .')
-            hash_data = hash(str(self.data))
             while True:
-                time.sleep(5)
-                if hash_data != hash(str(self.data)):
-                    self.dumps_data()
-                    hash_data = hash(str(self.data))
-                else:
-                    logger.debug(f'data hash Not change. skip dumps pid=%d, new_pid=%d', _pid, os.getpid())
-                    logger.info(f'{logger.handlers = }')
+                time.sleep(self.save_interval)
+                try:
+                    self.flush()
+                    if self._journal_lines > max(self.compact_min_lines, self._record_count()):
+                        self.compact()
+                except Exception as _e:
+                    logger.error('Save to %s failed: %s', self.path, _e)
 
         from threading import Thread
 
-        Thread(target=dump_in_thread, name='dump_data').start()
+        Thread(target=dump_in_thread, name='dump_data', daemon=True).start()
         logger.info('定时Save 线程已开启.')
 
-    def dumps_data(self):
+    def _record_count(self):
+        return sum(len(v) for v in self.data.values())
+
+    @_timed('flush')
+    def flush(self):
+        """将修改追加到日志"""
+        from json import dumps
+        with self._io_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                dirty, self._dirty = self._dirty, dict()
+            lines = [dumps([k[0], k[1]] if v is _DELETED else [k[0], k[1], v], ensure_ascii=False) + '\n'
+                     for k, v in dirty.items()]
+            with self.journal_path.open('a', encoding='utf8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_lines += len(lines)
+            logger.debug('Append %d records to %s', len(lines), self.journal_path)
+
+    @_timed('compact')
+    def compact(self):
+        """写入新的快照并清空日志"""
         from json import dumps
-        lens = self.path.write_text(dumps(self.data, ensure_ascii=False), encoding='utf8')
-        logger.info('Save to %s, size %d', str(self.path), lens)
+        with self._io_lock:
+            with self._lock:
+                self._dirty.clear()
+                data = {k: dict(v) for k, v in self.data.items()}
+            lens = atomic_write_text(self.path, dumps(data, ensure_ascii=False))
+            self.journal_path.unlink(missing_ok=True)
+            self._journal_lines = 0
+            logger.info('Save to %s, size %d', str(self.path), lens)
+
+    def dumps_data(self):
+        self.compact()
 
     def search_path(self, path):
         try:
             _item, _sub_path = self.verify_path_relative_item_base(path)
-            return self.data.get(_item, dict()).get(_sub_path)
         except ValueError:
-            return self.data.get(path)
+            return None
+        return self.data.get(_item, dict()).get(_sub_path)
 
-    def select_path(self, path):
-        return self.search_path(path)
+    def iter_item(self, item_dir):
+        with self._lock:
+            records = list(self.data.get(str(item_dir), dict()).items())
+        return iter(records)
 
-    def update_path(self, path, item_value):
-        item_dir, sub_path = self.verify_path_relative_item_base(path)
-        if self.verify_item_value(item_value):
+    def _store(self, item_dir, sub_path, item_value):
+        with self._lock:
             if self.data.get(item_dir) is None:
                 self.data[item_dir] = dict()
             self.data[item_dir][sub_path] = item_value
-            logger.info('update data[%s][%s] = %s', item_dir, sub_path, item_value)
+            self._dirty[(item_dir, sub_path)] = item_value
+
+    @_timed('update')
+    def update_path(self, path, item_value):
+        item_dir, sub_path = self.verify_path_relative_item_base(path)
+        if self.verify_item_value(item_value):
+            self._store(item_dir, sub_path, item_value)
+            logger.debug('update data[%s][%s] = %s', item_dir, sub_path, item_value)
         else:
             raise ValueError(f'item_value 验证失败。')
 
@@ -149,9 +341,277 @@ class JsonOperator(_OperatorBase, metaclass=ABCMeta):
     def delete_path(self, path):
         try:
             item_dir, sub_path = self.verify_path_relative_item_base(path)
-            del self.data[item_dir][sub_path]
+            with self._lock:
+                del self.data[item_dir][sub_path]
+                self._dirty[(item_dir, sub_path)] = _DELETED
+        except ValueError:
+            self.drop_item(path)
+
+    def drop_item(self, item_dir):
+        item_dir = str(item_dir)
+        with self._lock:
+            self.data.pop(item_dir, None)
+            self._dirty = {k: v for k, v in self._dirty.items() if k[0] != item_dir}
+            self._dirty[(item_dir, None)] = _DELETED
+
+
+class SnapshotOperator(JsonOperator):
+    """列式快照后端, cache_uri: snap:///path/to/cache.snap
+
+    启动时用 mmap 打开快照 (见 snapshot.py), 不解析全部记录; 查找时二分查找。
+    修改保存在内存的 data 中 (删除记为 _DELETED), 与 JsonOperator 一样追加到 .journal,
+    压缩时把快照与修改合并写入新的快照。
+    """
+    backend = 'snap'
+
+    def _init(self):
+        self.snapshot = None
+        self._dropped = set()  # 快照中已经删除的 item
+        self._dropped_since = None  # 压缩期间删除的 item
+        super()._init()
+
+    def _load_snapshot(self):
+        from snapshot import Snapshot
+        self.snapshot = Snapshot(self.path)
+        logger.info('打开快照 %s, %d 条记录', self.path, len(self.snapshot))
+
+    def _apply(self, item_dir, sub_path, value):
+        if sub_path is None:
+            self.data.pop(item_dir, None)
+            self._dropped.add(item_dir)
+            if self._dropped_since is not None:
+                self._dropped_since.add(item_dir)
+        else:
+            self.data.setdefault(item_dir, dict())[sub_path] = value
+
+    def _record_count(self):
+        return sum(len(v) for v in self.data.values()) + (len(self.snapshot) if self.snapshot is not None else 0)
+
+    def _snapshot_items(self):
+        return [] if self.snapshot is None else [i for i in self.snapshot.items if i not in self._dropped]
+
+    def stored_items(self) -> list:
+        """有记录的 item_dir"""
+        with self._lock:
+            return sorted(set(self._snapshot_items()) | set(self.data))
+
+    def _lookup(self, item_dir, sub_path):
+        overlay = self.data.get(item_dir, dict())
+        if sub_path in overlay:
+            value = overlay[sub_path]
+            return None if value is _DELETED else value
+        if self.snapshot is None or item_dir in self._dropped:
+            return None
+        return self.snapshot.get(item_dir, sub_path, self.load_value)
+
+    def search_path(self, path):
+        try:
+            key = self.verify_path_relative_item_base(path)
+        except ValueError:
+            return None
+        return self._lookup(*key)
+
+    def iter_item(self, item_dir):
+        """按快照中的顺序 (sub_path 的 UTF-8 字节序) 合并快照与修改
+
+        生成器持有开始时的 Snapshot, 压缩替换快照后仍然可以读完, 旧的 mmap 在没有引用后由垃圾回收关闭。
+        """
+        from snapshot import sorted_subs
+        item_dir = str(item_dir)
+        with self._lock:
+            overlay = dict(self.data.get(item_dir, dict()))
+            snapshot = None if item_dir in self._dropped else self.snapshot
+        pending, i = sorted_subs(overlay), 0
+        rows = snapshot.iter_item(item_dir, self.load_value) if snapshot is not None else ()
+        for sub_path, value in rows:
+            key = sub_path.encode()
+            while i < len(pending) and pending[i].encode() < key:
+                if overlay[pending[i]] is not _DELETED:
+                    yield pending[i], overlay[pending[i]]
+                i += 1
+            if i < len(pending) and pending[i] == sub_path:
+                value = overlay[sub_path]
+                i += 1
+            if value is not _DELETED:
+                yield sub_path, value
+        for sub_path in pending[i:]:
+            if overlay[sub_path] is not _DELETED:
+                yield sub_path, overlay[sub_path]
+
+    def delete_path(self, path):
+        try:
+            item_dir, sub_path = self.verify_path_relative_item_base(path)
+            with self._lock:
+                self.data.setdefault(item_dir, dict())[sub_path] = _DELETED
+                self._dirty[(item_dir, sub_path)] = _DELETED
+        except ValueError:
+            self.drop_item(path)
+
+    def drop_item(self, item_dir):
+        item_dir = str(item_dir)
+        with self._lock:
+            self._apply(item_dir, None, _DELETED)
+            self._dirty = {k: v for k, v in self._dirty.items() if k[0] != item_dir}
+            self._dirty[(item_dir, None)] = _DELETED
+
+    @_timed('compact')
+    def compact(self):
+        """快照与修改按顺序合并, 逐条写入新的快照, 清空日志; 写入期间的修改保留在 data 中"""
+        from snapshot import Snapshot, write_snapshot
+        with self._io_lock:
+            with self._lock:
+                self._dirty.clear()
+                captured = {k: dict(v) for k, v in self.data.items()}
+                dropped, self._dropped_since = set(self._dropped), set()
+                items = set(self._snapshot_items()) | set(captured)
+            count = write_snapshot(self.path, ((item, sub, value) for item in sorted(items)
+                                               for sub, value in self.iter_item(item)))
+            self.journal_path.unlink(missing_ok=True)
+            self._journal_lines = 0
+            with self._lock:
+                self.snapshot = Snapshot(self.path)  # 旧快照可能还在被 iter_item 读取, 不主动关闭
+                for item, values in captured.items():  # 已写入快照并且之后没有再修改的记录
+                    current = self.data.get(item, dict())
+                    for sub, value in values.items():
+                        if sub in current and current[sub] is value:
+                            del current[sub]
+                    if item in self.data and not current:
+                        del self.data[item]
+                self._dropped = (self._dropped - dropped) | self._dropped_since
+                self._dropped_since = None
+            logger.info('Save to %s, %d 条记录', str(self.path), count)
+
+
+class SqliteOperator(_OperatorBase):
+    """SQLite 后端, cache_uri: sqlite:///path/to/cache.db?batch=1000
+
+    写入先进入内存缓冲区, 缓冲区满 batch 条后在一个事务中批量 upsert,
+    所以内存占用与数据总量无关。
+    """
+    backend = 'sqlite'
+    batch_size = 1000
+
+    def _init(self):
+        import sqlite3
+        from threading import RLock
+
+        self.path = Path(self.uri_parse.path)
+        query = urllib.parse.parse_qs(self.uri_parse.query)
+        self.batch_size = int(query.get('batch', [self.batch_size])[0])
+
+        self._lock = RLock()
+        self._pending = dict()  # (item_dir, sub_path) -> json value, None 表示删除
+        # 多个进程 (supervisor) 同时写入时等待锁, 而不是立即失败
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS records ('
+                          'item_dir TEXT NOT NULL, sub_path TEXT NOT NULL, value TEXT NOT NULL, '
+                          'PRIMARY KEY (item_dir, sub_path)) WITHOUT ROWID')
+        atexit.register(self.close)
+        logger.debug('Sqlite Operation Init Success . ')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    @_timed('commit')
+    def commit(self):
+        """将缓冲区写入数据库"""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, dict()
+            upsert = [(k[0], k[1], v) for k, v in pending.items() if v is not None]
+            delete = [k for k, v in pending.items() if v is None]
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany('INSERT INTO records (item_dir, sub_path, value) VALUES (?, ?, ?) '
+                                      'ON CONFLICT (item_dir, sub_path) DO UPDATE SET value = excluded.value',
+                                      upsert)
+                self.conn.executemany('DELETE FROM records WHERE item_dir = ? AND sub_path = ?', delete)
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            logger.info('Save to %s, upsert %d, delete %d', str(self.path), len(upsert), len(delete))
+
+    dumps_data = commit
+
+    def close(self):
+        with self._lock:
+            if self.conn is None:
+                return
+            self.commit()
+            self.conn.close()
+            self.conn = None
+
+    def _write(self, key, value):
+        with self._lock:
+            self._pending[key] = value
+            if len(self._pending) >= self.batch_size:
+                self.commit()
+
+    def search_path(self, path):
+        from json import loads
+        try:
+            key = self.verify_path_relative_item_base(path)
         except ValueError:
-            del self.data[path]
+            return None
+        with self._lock:
+            if key in self._pending:
+                value = self._pending[key]
+            else:
+                row = self.conn.execute('SELECT value FROM records WHERE item_dir = ? AND sub_path = ?',
+                                        key).fetchone()
+                value = row[0] if row else None
+        return None if value is None else self.load_value(loads(value))
+
+    def iter_item(self, item_dir):
+        """在单独的只读连接上遍历, 整个遍历是一个读事务 (WAL 下是开始时的快照);
+        共用的连接上不保留打开的游标, 其他线程同时提交不会中断或改变遍历的结果"""
+        import sqlite3
+        from json import loads
+        with self._lock:
+            self.commit()
+        conn = sqlite3.connect(f'{self.path.absolute().as_uri()}?mode=ro', uri=True, timeout=60,
+                               isolation_level=None)
+        try:
+            conn.execute('BEGIN')
+            for sub_path, value in conn.execute('SELECT sub_path, value FROM records WHERE item_dir = ?',
+                                                (str(item_dir),)):
+                yield sub_path, self.load_value(loads(value))
+        finally:
+            conn.close()
+
+    def _store(self, item_dir, sub_path, item_value):
+        from json import dumps
+        self._write((item_dir, sub_path), dumps(item_value, ensure_ascii=False))
+
+    @_timed('update')
+    def update_path(self, path, item_value):
+        item_dir, sub_path = self.verify_path_relative_item_base(path)
+        if self.verify_item_value(item_value):
+            self._store(item_dir, sub_path, item_value)
+            logger.debug('update data[%s][%s] = %s', item_dir, sub_path, item_value)
+        else:
+            raise ValueError(f'item_value 验证失败。')
+
+    def create_path(self, path, item_value):
+        return self.update_path(path, item_value)
+
+    def delete_path(self, path):
+        try:
+            self._write(self.verify_path_relative_item_base(path), None)
+        except ValueError:
+            self.drop_item(path)
+
+    def drop_item(self, item_dir):
+        with self._lock:
+            self.commit()
+            self.conn.execute('DELETE FROM records WHERE item_dir = ?', (str(item_dir),))
 
 
 class MysqlOperator:
@@ -159,42 +619,279 @@ class MysqlOperator:
         pass
 
 
-class RedisOperator:
-    def __init__(self, ):
-        # import redis
-        pass
+class RedisOperator(_OperatorBase):
+    """Redis 后端, 多个同步节点共享扫描状态
+
+    cache_uri: redis://[:password@]host:6379/0?prefix=alist_sync&batch=1000&lease_ttl=600&scan_ttl=86400
+
+    每个 item_dir 一个 Hash: <prefix>:<item_dir>, field 为 sub_path;
+    写入缓冲 batch 条后通过 pipeline 一次发送。
+
+    多个节点同时扫描同一个 item 时分担目录列表:
+        enter_scan 在 <prefix>:scan:<item>:nodes 中登记本节点, 第一个进入的节点开始新的一轮 (gen 加一);
+        列出目录前获取租约 <prefix>:lease:<gen>:<path> (SET NX EX lease_ttl), 只有一个节点列出该目录;
+        列出后把租约替换为子目录列表 (保留到本轮结束), 其他节点使用这个列表继续进入子目录, 不再列出;
+        leave_scan 注销本节点, 最后一个结束的节点清除扫描游标。
+    节点异常退出时: 租约 lease_ttl 秒后过期, 由其他节点重新列出; 登记 scan_ttl 秒后过期。
+    """
+    backend = 'redis'
+    batch_size = 1000
+    lease_ttl = 600
+    scan_ttl = 86400
+
+    # 只修改自己持有的租约: ARGV[2] 为空时删除, 否则替换为发布的子目录列表
+    _release_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        if ARGV[2] == '' then
+            return redis.call('del', KEYS[1])
+        end
+        redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+        return 1
+    end
+    return 0
+    """
+    _renew_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('expire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    # 删除过期的节点登记; enter 时没有其他节点则开始新的一轮
+    _prune = """
+    local flat = redis.call('hgetall', KEYS[1])
+    for i = 1, #flat, 2 do
+        if tonumber(flat[i + 1]) < tonumber(ARGV[2]) then
+            redis.call('hdel', KEYS[1], flat[i])
+        end
+    end
+    """
+    _enter_script = _prune + """
+    if redis.call('hlen', KEYS[1]) == 0 then
+        redis.call('incr', KEYS[2])
+    end
+    redis.call('hset', KEYS[1], ARGV[1], tonumber(ARGV[2]) + tonumber(ARGV[3]))
+    redis.call('expire', KEYS[1], ARGV[3])
+    return redis.call('get', KEYS[2])
+    """
+    _leave_script = """
+    redis.call('hdel', KEYS[1], ARGV[1])
+    """ + _prune + """
+    return redis.call('hlen', KEYS[1])
+    """
+    _LISTED = 'L:'
 
+    def _init(self):
+        import redis
+        import socket
+        import uuid
+        from threading import RLock
+
+        query = urllib.parse.parse_qs(self.uri_parse.query)
+        self.prefix = query.get('prefix', ['alist_sync'])[0]
+        self.batch_size = int(query.get('batch', [self.batch_size])[0])
+        self.lease_ttl = int(query.get('lease_ttl', [self.lease_ttl])[0])
+        self.scan_ttl = int(query.get('scan_ttl', [self.scan_ttl])[0])
+        self.token = f'T:{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+        self._gen = dict()  # item_dir -> 本轮扫描的编号
+
+        self._lock = RLock()
+        self._pending = dict()  # (item_dir, sub_path) -> json value, None 表示删除
+        self.redis = redis.Redis.from_url(self.uri_parse._replace(query='').geturl(), decode_responses=True)
+        self._release = self.redis.register_script(self._release_script)
+        self._renew = self.redis.register_script(self._renew_script)
+        self._enter = self.redis.register_script(self._enter_script)
+        self._leave = self.redis.register_script(self._leave_script)
+        atexit.register(self.commit)
+        logger.debug('Redis Operation Init Success . ')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.commit()
+
+    def __enter__(self):
+        return self
+
+    def _key(self, item_dir):
+        return f'{self.prefix}:{item_dir}'
+
+    @_timed('commit')
+    def commit(self):
+        """通过 pipeline 批量写入缓冲区"""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, dict()
+            pipe = self.redis.pipeline(transaction=False)
+            for (item_dir, sub_path), value in pending.items():
+                if value is None:
+                    pipe.hdel(self._key(item_dir), sub_path)
+                else:
+                    pipe.hset(self._key(item_dir), sub_path, value)
+            pipe.execute()
+            logger.info('Save to redis %s, %d records', self.prefix, len(pending))
+
+    dumps_data = commit
+
+    def _write(self, key, value):
+        with self._lock:
+            self._pending[key] = value
+            if len(self._pending) >= self.batch_size:
+                self.commit()
+
+    def search_path(self, path):
+        from json import loads
+        try:
+            item_dir, sub_path = self.verify_path_relative_item_base(path)
+        except ValueError:
+            return None
+        with self._lock:
+            if (item_dir, sub_path) in self._pending:
+                value = self._pending[(item_dir, sub_path)]
+            else:
+                value = self.redis.hget(self._key(item_dir), sub_path)
+        return None if value is None else self.load_value(loads(value))
+
+    def iter_item(self, item_dir):
+        from json import loads
+        self.commit()
+        for sub_path, value in self.redis.hscan_iter(self._key(str(item_dir)), count=1000):
+            yield sub_path, self.load_value(loads(value))
+
+    def _store(self, item_dir, sub_path, item_value):
+        from json import dumps
+        self._write((item_dir, sub_path), dumps(item_value, ensure_ascii=False))
+
+    @_timed('update')
+    def update_path(self, path, item_value):
+        item_dir, sub_path = self.verify_path_relative_item_base(path)
+        if self.verify_item_value(item_value):
+            self._store(item_dir, sub_path, item_value)
+            logger.debug('update data[%s][%s] = %s', item_dir, sub_path, item_value)
+        else:
+            raise ValueError(f'item_value 验证失败。')
+
+    def create_path(self, path, item_value):
+        return self.update_path(path, item_value)
+
+    def delete_path(self, path):
+        try:
+            self._write(self.verify_path_relative_item_base(path), None)
+        except ValueError:
+            self.drop_item(path)
+
+    def drop_item(self, item_dir):
+        with self._lock:
+            self.commit()
+            self.redis.delete(self._key(str(item_dir)))
+
+    def _scan_keys(self, item_dir):
+        return f'{self.prefix}:scan:{item_dir}:nodes', f'{self.prefix}:scan:{item_dir}:gen'
+
+    def enter_scan(self, item_dir):
+        item_dir = _normalize_path(str(item_dir))
+        self._gen[item_dir] = self._enter(keys=self._scan_keys(item_dir),
+                                          args=[self.token, int(time.time()), self.scan_ttl])
+        logger.info('开始扫描 %s, 第 %s 轮', item_dir, self._gen[item_dir])
+
+    def leave_scan(self, item_dir) -> bool:
+        item_dir = _normalize_path(str(item_dir))
+        self.commit()  # 缓冲中的游标先写入, 否则可能在最后一个节点清除游标之后才写入
+        remaining = self._leave(keys=self._scan_keys(item_dir)[:1], args=[self.token, int(time.time())])
+        if remaining:
+            logger.info('结束扫描 %s, 还有 %d 个节点在扫描', item_dir, remaining)
+        return not remaining
+
+    def _lease_key(self, path):
+        path = _normalize_path(str(path))
+        try:
+            item_dir = _normalize_path(self.verify_path_relative_item_base(path)[0])
+        except ValueError:
+            item_dir = path
+        return f'{self.prefix}:lease:{self._gen.get(item_dir, 0)}:{path}'
+
+    def acquire_lease(self, path) -> bool:
+        return bool(self.redis.set(self._lease_key(path), self.token, nx=True, ex=self.lease_ttl))
+
+    def renew_lease(self, path):
+        self._renew(keys=[self._lease_key(path)], args=[self.token, self.lease_ttl])
+
+    def release_lease(self, path, listing: list = None):
+        from json import dumps
+        value = '' if listing is None else self._LISTED + dumps(listing, ensure_ascii=False)
+        self._release(keys=[self._lease_key(path)], args=[self.token, value, self.scan_ttl])
+
+    def shared_listing(self, path) -> Optional[list]:
+        from json import loads
+        value = self.redis.get(self._lease_key(path))
+        if value is None or not value.startswith(self._LISTED):
+            return None
+        return loads(value[len(self._LISTED):])
 
-class SqliteOperator:
-    def __init__(self):
-        pass
 
 # class MongoOperator(_OperatorBase):
 #     """"""
 
-# class Operator:
-#     """缓存对象，处理多驱动的标准接口。
-#
-#     数据结构: [{name: , base_path1: , base_path2: }, {} ... ]
-#     """
-#
-#     def __new__(cls, cache_uri, *args, **kwargs):
-#         urlparse = urllib.parse.urlparse(cache_uri)
-#         logger = logging.getLogger('operator')
-#         logger.debug(f'{urlparse.scheme = } ')
-#         if urlparse.scheme == 'json':
-#             logger.debug(type(cls.__dict__))
-#             # cls.__dict__.setdefault(JsonOperator.__dict__)
-#             cls.set_attr(JsonOperator)
-#             return JsonOperator(urlparse.path)
-#         elif urlparse.scheme == 'redis':
-#             pass
-#         else:
-#             raise
-#
-#     @classmethod
-#     def set_attr(cls, c):
-#         """"""
-#         for name, func in c.__dict__.items():
-#             if name not in cls.__dict__.keys():
-#                 cls.__setattr__(cls, name, func)
+OPERATORS = {
+    'json': JsonOperator,
+    'sqlite': SqliteOperator,
+    'redis': RedisOperator,
+    'snap': SnapshotOperator,
+}
+
+
+class Operator:
+    """缓存对象，按 cache_uri 的 scheme 选择后端。
+
+    子类 (FileRecord, UpdatingCache) 只实现业务相关的方法 (验证器等)，
+    实例化时与后端组合成一个新的类: class FileRecord(FileRecord, JsonOperator)
+    """
+    _classes = dict()
+
+    def __new__(cls, cache_uri, *args, **kwargs):
+        if issubclass(cls, _OperatorBase):
+            return super().__new__(cls)
+
+        scheme = urllib.parse.urlparse(cache_uri).scheme.lower()
+        if scheme not in OPERATORS:
+            raise ValueError(f'不支持的 cache_uri: {cache_uri}, 可用的 scheme: {list(OPERATORS)}')
+        key = (cls, OPERATORS[scheme])
+        if key not in cls._classes:
+            cls._classes[key] = ABCMeta(cls.__name__, key, {'__module__': cls.__module__})
+        return super().__new__(cls._classes[key])
+
+
+def bench_verify_path(n=200000, items=20):
+    """对比 Path.is_relative_to 与前缀索引的 verify_path_relative_item_base"""
+    import timeit
+
+    class _Bench(_OperatorBase):
+        def _init(self): pass
+
+        def verify_item_value(self, item_value): return True
+
+        def search_path(self, path): pass
+
+        def update_path(self, path, item_value): pass
+
+        def create_path(self, path, path_value): pass
+
+        def delete_path(self, path): pass
+
+    def legacy(op, path):
+        path = Path(path)
+        for item_dir in op.item_dirs:
+            if path.is_relative_to(item_dir):
+                return str(item_dir), path.relative_to(item_dir).as_posix()
+        raise ValueError()
+
+    op = _Bench('bench://')
+    op.set_item_dirs([f'/storage_{i}/sync/' for i in range(items)])
+    paths = [f'/storage_{i % items}/sync/dir_{i % 97}/sub_{i % 13}/file_{i}.txt' for i in range(n)]
+    assert all(legacy(op, p) == op.verify_path_relative_item_base(p) for p in paths[:1000])
+    old = timeit.timeit(lambda: [legacy(op, p) for p in paths], number=1)
+    new = timeit.timeit(lambda: [op.verify_path_relative_item_base(p) for p in paths], number=1)
+    print(f'{n} paths, {items} items: Path {old / n * 1e6:.2f} us/call, index {new / n * 1e6:.2f} us/call, '
+          f'{old / new:.1f}x')
+
+
+if __name__ == '__main__':
+    bench_verify_path()
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : benchmark.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/11 21:05
+
+基准测试, 使用进程内的 mock_alist.MockAlist, 不需要真实的 Alist 服务器。
+
+    python benchmark.py all --width 5 --depth 3 --files 50 --latency 0.005 --output bench.json
+    python benchmark.py scan --compare bench.json        # 与上一次的结果比较, 变慢超过阈值时返回 1
+
+每个测试在单独的子进程中运行, 峰值内存 (ru_maxrss) 互不影响。结果写入 JSON:
+    {"meta": {...}, "results": [{"name": ..., "params": {...}, "metrics": {...}}, ...]}
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+logger = logging.getLogger('alist.benchmark')
+
+# 指标 -> 越大越好 (True) / 越小越好 (False), 用于 --compare
+HIGHER_IS_BETTER = {
+    'files_per_sec': True, 'dirs_per_sec': True, 'writes_per_sec': True, 'reads_per_sec': True,
+    'iter_per_sec': True, 'seconds': False, 'save_seconds': False, 'load_seconds': False,
+    'requests': False, 'peak_rss_mb': False,
+}
+
+
+def _peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def bench_scan(width, depth, files, latency, workers, mode='full'):
+    """Sync.scan_update_file 的吞吐量; incremental 时先完整扫描一次, 测量第二次扫描"""
+    from mock_alist import MockAlist
+    from sync import Sync
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            MockAlist(roots=['/local', '/remote'], width=width, depth=depth, files=files, latency=latency) as server:
+        sync = Sync(dict(items=['/local', '/remote'], cache_path=f'json://{tmp}/cache.json',
+                         alist_prefix=server.base_url, alist_token=server.token,
+                         scan_workers=workers, scan_mode=mode))
+        if mode == 'incremental':
+            sync.scan_update_file()
+        server.calls.clear()
+        start = time.perf_counter()
+        stats = sync.scan_update_file()
+        seconds = time.perf_counter() - start
+        return dict(seconds=round(seconds, 3), files=stats['files'], dirs=stats['dirs'],
+                    files_per_sec=round(stats['files'] / seconds, 1), dirs_per_sec=round(stats['dirs'] / seconds, 1),
+                    requests=sum(server.calls.values()), peak_rss_mb=_peak_rss_mb())
+
+
+def bench_operator(backend, records, redis_url=None):
+    """FileRecord 在不同后端上的写入 / 保存 / 读取 / 遍历速度"""
+    from file_record import FileEntry, FileRecord
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = {'json': f'json://{tmp}/cache.json',
+               'snap': f'snap://{tmp}/cache.snap',
+               'sqlite': f'sqlite://{tmp}/cache.db?batch=5000',
+               'redis': f'{redis_url}?prefix=alist_bench_{os.getpid()}&batch=5000'}[backend]
+        item = '/bench'
+        paths = [f'{item}/dir_{i // 100}/file_{i}.txt' for i in range(records)]
+        op = FileRecord(uri)
+        op.set_item_dirs([item])
+
+        start = time.perf_counter()
+        for i, path in enumerate(paths):
+            op.update_path(path, FileEntry(1667000000 + i, i))
+        write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        op.dumps_data()
+        save = time.perf_counter() - start
+
+        sample = random.sample(paths, min(records, 20000))
+        start = time.perf_counter()
+        for path in sample:
+            op.search_path(path)
+        read = time.perf_counter() - start
+
+        start = time.perf_counter()
+        count = sum(1 for _ in op.iter_item(item))
+        iterate = time.perf_counter() - start
+
+        load = None
+        if backend in ('json', 'snap'):
+            start = time.perf_counter()
+            FileRecord(uri)
+            load = round(time.perf_counter() - start, 3)
+        if backend == 'redis':
+            op.drop_item(item)
+        return dict(writes_per_sec=round(records / write, 1), save_seconds=round(save, 3),
+                    reads_per_sec=round(len(sample) / read, 1), iter_per_sec=round(count / iterate, 1),
+                    load_seconds=load, peak_rss_mb=_peak_rss_mb())
+
+
+def _run_isolated(func, kwargs) -> dict:
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(func, **kwargs).result()
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results: list, baseline: dict, threshold=0.1) -> list:
+    """返回比 baseline 差超过 threshold 的指标"""
+    old = {(r['name'], json.dumps(r['params'], sort_keys=True)): r['metrics'] for r in baseline.get('results', [])}
+    regressions = []
+    for r in results:
+        before = old.get((r['name'], json.dumps(r['params'], sort_keys=True)))
+        if not before:
+            continue
+        for metric, higher in HIGHER_IS_BETTER.items():
+            a, b = before.get(metric), r['metrics'].get(metric)
+            if not a or b is None:
+                continue
+            change = (b - a) / a
+            if (change < -threshold) if higher else (change > threshold):
+                regressions.append(dict(name=r['name'], params=r['params'], metric=metric,
+                                        before=a, after=b, change=round(change, 3)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='alist_sync benchmarks')
+    parser.add_argument('suite', nargs='?', default='all', choices=['all', 'scan', 'operator'])
+    parser.add_argument('--width', type=int, default=5, help='每个目录的子目录数')
+    parser.add_argument('--depth', type=int, default=3, help='目录深度')
+    parser.add_argument('--files', type=int, default=20, help='每个目录的文件数')
+    parser.add_argument('--latency', type=float, default=0.002, help='mock 服务器每个请求的延迟 (秒)')
+    parser.add_argument('--workers', type=int, default=8, help='scan_workers')
+    parser.add_argument('--records', type=int, default=100000, help='operator 测试的记录数')
+    parser.add_argument('--backends', default='json,snap,sqlite', help='operator 测试的后端, 逗号分隔')
+    parser.add_argument('--redis-url', default=os.environ.get('ALIST_SYNC_BENCH_REDIS'))
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='上一次的结果文件')
+    parser.add_argument('--threshold', type=float, default=0.1, help='变化超过该比例视为退化')
+    args = parser.parse_args(argv)
+
+    cases = []
+    if args.suite in ('all', 'scan'):
+        tree = dict(width=args.width, depth=args.depth, files=args.files, latency=args.latency,
+                    workers=args.workers)
+        cases.append(('scan_full', bench_scan, dict(tree, mode='full')))
+        cases.append(('scan_incremental', bench_scan, dict(tree, mode='incremental')))
+    if args.suite in ('all', 'operator'):
+        for backend in args.backends.split(','):
+            if backend == 'redis' and not args.redis_url:
+                print('skip redis: 没有 --redis-url')
+                continue
+            cases.append((f'operator_{backend}', bench_operator,
+                          dict(backend=backend, records=args.records, redis_url=args.redis_url)))
+
+    results = []
+    for name, func, params in cases:
+        metrics = _run_isolated(func, params)
+        params = {k: v for k, v in params.items() if k != 'redis_url'}
+        results.append(dict(name=name, params=params, metrics=metrics))
+        print(f'{name:<20} {json.dumps(metrics)}')
+
+    report = dict(meta=dict(time=time.strftime('%Y-%m-%dT%H:%M:%S%z'), commit=_git_commit(),
+                            python=platform.python_version(), platform=platform.platform(),
+                            cpus=os.cpu_count()),
+                  results=results)
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'结果写入 {args.output}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for r in regressions:
+            print(f'退化: {r["name"]} {r["metric"]} {r["before"]} -> {r["after"]} ({r["change"]:+.1%})')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main())
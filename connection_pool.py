@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : connection_pool.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/01 20:12
+
+Keep-Alive 连接池，线程安全，每个 Host 保持有限数量的长连接。
+"""
+import contextlib
+import http.client
+import logging
+import queue
+import threading
+import urllib.parse
+
+logger = logging.getLogger('alist.client.pool')
+
+# 复用的连接已经被服务端关闭时，会抛出这些异常，此时换一个新连接重试一次
+_STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError,
+                 ConnectionResetError, ConnectionAbortedError)
+
+
+def _rewind(body) -> bool:
+    """重发前把可读的请求体 (upload.UploadBody) 移回开头, 无法移回时不重发"""
+    if not hasattr(body, 'read'):
+        return True
+    rewind = getattr(body, 'rewind', None)
+    return rewind is not None and rewind()
+
+
+class PoolTimeout(Exception):
+    """等待空闲连接超时"""
+
+
+class PoolResponse:
+    """已读取完成的响应, 接口与 urllib 的响应保持一致"""
+
+    def __init__(self, url, status, headers, data: bytes):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+    def read(self) -> bytes:
+        return self.data
+
+    def getcode(self) -> int:
+        return self.status
+
+    def geturl(self) -> str:
+        return self.url
+
+
+class _HostPool:
+    """单个 Host 的连接池"""
+
+    def __init__(self, scheme, host, port, maxsize, blocksize=8192):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.blocksize = blocksize
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(maxsize)
+
+    def new_connection(self, timeout):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout, blocksize=self.blocksize)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout, blocksize=self.blocksize)
+
+
+class ConnectionPool:
+    """HTTP Keep-Alive 连接池
+
+    :param maxsize: 每个 Host 同时存在的最大连接数 (空闲 + 使用中)
+    :param timeout: socket 超时时间
+    :param pool_timeout: 等待空闲连接的最长时间, None 表示一直等待
+    :param blocksize: 可读的请求体 (文件上传) 每次读取并发送的字节数
+    """
+
+    def __init__(self, maxsize=10, timeout=60, pool_timeout=None, blocksize=256 * 1024):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.pool_timeout = pool_timeout
+        self.blocksize = blocksize
+
+        self._hosts = dict()
+        self._lock = threading.Lock()
+        self._stats = dict(requests=0, hits=0, new_connections=0, waits=0, discarded=0)
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    @property
+    def stats(self) -> dict:
+        """连接池统计: requests, hits(复用), new_connections, waits(等待空闲连接), discarded(丢弃)"""
+        with self._lock:
+            return dict(self._stats)
+
+    def _host_pool(self, scheme, host, port) -> _HostPool:
+        key = (scheme, host, port)
+        with self._lock:
+            if key not in self._hosts:
+                self._hosts[key] = _HostPool(scheme, host, port, self.maxsize, self.blocksize)
+            return self._hosts[key]
+
+    def _get_conn(self, host_pool: _HostPool, timeout):
+        if not host_pool.slots.acquire(blocking=False):
+            self._count('waits')
+            if not host_pool.slots.acquire(timeout=self.pool_timeout):
+                raise PoolTimeout(f'等待连接超时: {host_pool.host}')
+        try:
+            conn = host_pool.idle.get_nowait()
+            self._count('hits')
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        except queue.Empty:
+            self._count('new_connections')
+            return host_pool.new_connection(timeout), False
+
+    def _put_conn(self, host_pool: _HostPool, conn, reusable=True):
+        if reusable:
+            host_pool.idle.put(conn)
+        else:
+            self._count('discarded')
+            conn.close()
+        host_pool.slots.release()
+
+    def _request(self, method, url, body, headers, timeout):
+        """发送请求, 返回 (host_pool, conn, resp), 响应体尚未读取"""
+        parse = urllib.parse.urlsplit(url)
+        scheme = parse.scheme.lower()
+        port = parse.port or (443 if scheme == 'https' else 80)
+        target = parse.path or '/'
+        if parse.query:
+            target += '?' + parse.query
+        host_pool = self._host_pool(scheme, parse.hostname, port)
+        timeout = self.timeout if timeout is None else timeout
+        self._count('requests')
+
+        while True:
+            conn, reused = self._get_conn(host_pool, timeout)
+            try:
+                conn.request(method, target, body=body, headers=headers or dict())
+                return host_pool, conn, conn.getresponse()
+            except _STALE_ERRORS:
+                self._put_conn(host_pool, conn, reusable=False)
+                if reused and _rewind(body):
+                    logger.debug('连接已被服务端关闭, 使用新连接重试: %s', url)
+                    continue
+                raise
+            except BaseException:
+                self._put_conn(host_pool, conn, reusable=False)
+                raise
+
+    def urlopen(self, method, url, body=None, headers=None, timeout=None) -> PoolResponse:
+        """发送请求并读取完整的响应"""
+        host_pool, conn, resp = self._request(method, url, body, headers, timeout)
+        try:
+            data = resp.read()
+        except BaseException:
+            self._put_conn(host_pool, conn, reusable=False)
+            raise
+        self._put_conn(host_pool, conn, reusable=not resp.will_close)
+        return PoolResponse(url, resp.status, resp.headers, data)
+
+    @contextlib.contextmanager
+    def stream(self, method, url, body=None, headers=None, timeout=None):
+        """发送请求, 返回未读取的 http.client.HTTPResponse, 由调用者分块读取
+
+        响应体读取完整时连接放回连接池, 否则关闭连接。
+
+            with pool.stream('GET', url) as resp:
+                while chunk := resp.read(65536): ...
+        """
+        host_pool, conn, resp = self._request(method, url, body, headers, timeout)
+        resp.url = url
+        try:
+            yield resp
+        except BaseException:
+            self._put_conn(host_pool, conn, reusable=False)
+            raise
+        self._put_conn(host_pool, conn, reusable=resp.isclosed() and not resp.will_close)
+
+    def close(self):
+        """关闭全部空闲连接"""
+        with self._lock:
+            hosts, self._hosts = list(self._hosts.values()), dict()
+        for host_pool in hosts:
+            while True:
+                try:
+                    host_pool.idle.get_nowait().close()
+                except queue.Empty:
+                    break
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : content_verify.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/14 20:30
+
+复制前的内容校验。
+
+不同的存储对同一个文件返回的 modified 常常不同, 只按 modified 计算的复制计划会重复复制相同的文件。
+目标已经存在的复制操作, 先比较 size, 再比较存储提供的 hash_info (共同的算法):
+
+    mode='size'  size 相同即认为内容相同
+    mode='hash'  需要至少一个共同的 hash 算法并且全部相同; 记录中没有 hash 的文件批量 fs_get 查询,
+                 查询结果写回 FileRecord, 下一次不再查询
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath as Path
+
+from file_record import FileEntry, FileRecord, hash_text, same_content
+from sync_plan import CopyPlan
+
+logger = logging.getLogger('alist.sync.verify')
+
+MODES = ('size', 'hash')
+
+
+class ContentVerifier:
+    """从复制计划中去掉目标内容已经相同的操作
+
+    :param client: Alist 客户端
+    :param record: FileRecord, 读取文件的 size / hash, 并缓存查询到的 hash
+    :param mode: 'size' | 'hash'
+    :param workers: 并发 fs_get 的线程数
+    """
+
+    def __init__(self, client, record: FileRecord, mode='hash', workers=8):
+        if mode not in MODES:
+            raise ValueError(f'mode 应该是 {MODES} 之一: {mode}')
+        self.client = client
+        self.record = record
+        self.mode = mode
+        self.workers = workers
+        self.stats = dict(checked=0, same=0, skipped_bytes=0, lookups=0, lookup_failed=0, unknown=0)
+
+    def _lookup(self, paths) -> dict:
+        """并发 fs_get, 返回 path -> hash, 结果写回 FileRecord"""
+        def get(path):
+            try:
+                return path, hash_text(self.client.fs_get(path) or dict())
+            except Exception as _e:
+                logger.warning('查询 %s 的 hash 失败: %s', path, _e)
+                return path, None
+
+        found = dict()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='verify') as executor:
+            for path, h in executor.map(get, paths):
+                self.stats['lookups'] += 1
+                if h is None:
+                    self.stats['lookup_failed'] += 1
+                    continue
+                found[path] = h
+        for path, h in found.items():  # Operator 不需要加锁, 在调用线程中写回
+            entry = self.record.select_path(path)
+            if isinstance(entry, FileEntry):
+                self.record.update_path(path, entry._replace(hash=h))
+        return found
+
+    def filter(self, plan: CopyPlan) -> CopyPlan:
+        """返回去掉内容相同的操作后的计划"""
+        keep, pending = [], dict()  # pending: 操作序号 -> (src_path, dst_path, src_entry, dst_entry)
+        for n, (sub_path, src_item, dst_item, size) in enumerate(plan):
+            dst_path = Path(dst_item, sub_path).as_posix()
+            dst = self.record.select_path(dst_path)
+            if not isinstance(dst, FileEntry) or dst.size != size:
+                keep.append(n)
+                continue
+            self.stats['checked'] += 1
+            if self.mode == 'size':
+                self._same(size)
+                continue
+            src_path = Path(src_item, sub_path).as_posix()
+            src = self.record.select_path(src_path)
+            result = same_content(src, dst) if isinstance(src, FileEntry) else False
+            if result is None:
+                pending[n] = (src_path, dst_path, src, dst)
+            elif result:
+                self._same(size)
+            else:
+                keep.append(n)
+
+        if pending:
+            paths = {p for src_path, dst_path, src, dst in pending.values()
+                     for p, e in ((src_path, src), (dst_path, dst)) if e.hash is None}
+            logger.info('%d 个文件 size 相同但没有共同的 hash, 查询 %d 个路径', len(pending), len(paths))
+            found = self._lookup(sorted(paths))
+            for n, (src_path, dst_path, src, dst) in pending.items():
+                src = src._replace(hash=found.get(src_path, src.hash))
+                dst = dst._replace(hash=found.get(dst_path, dst.hash))
+                result = same_content(src, dst)
+                if result:
+                    self._same(src.size)
+                    continue
+                if result is None:
+                    self.stats['unknown'] += 1
+                keep.append(n)
+
+        logger.info('内容校验: %s', self.stats)
+        return plan.subset(sorted(keep))
+
+    def _same(self, size):
+        self.stats['same'] += 1
+        self.stats['skipped_bytes'] += size or 0
@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : dir_index.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/08 21:30
+
+目录指纹, 用于增量扫描。
+
+目录在父目录列表中的 modified / size 作为它的指纹, 在目录及全部子目录扫描完成后记录。
+下一次扫描时指纹没有变化的目录不再进入。
+
+限制: 指纹只来自父目录的列表, 不包含目录中的条目数 (需要列出目录才能知道)。
+多数存储只在直接子项变化时更新目录的 modified; 如果目录的 size 也总是 0,
+深层文件的变化不会改变上级目录的指纹, 增量扫描发现不了, 需要定期做一次 full 扫描。
+"""
+import logging
+
+from file_record import FileEntry
+from updating_cache import UpdatingCache
+
+logger = logging.getLogger('alist.sync.dir_index')
+
+
+class DirIndex(UpdatingCache):
+    """path -> FileEntry(modified, size, is_dir=True)"""
+    suffix = '_dir_index'
+
+    def load_value(self, value) -> FileEntry:
+        return FileEntry.from_value(value)
+
+    def verify_item_value(self, item_value) -> bool:
+        return isinstance(item_value, FileEntry) and item_value.is_dir
+
+    def unchanged(self, path, entry: FileEntry) -> bool:
+        """目录的指纹与上次扫描完成时相同; 没有 modified 的目录 (部分存储不返回) 总是认为已经改变"""
+        if entry is None or not entry.modified:
+            return False
+        return self.search_path(path) == entry
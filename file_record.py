@@ -1,36 +1,170 @@
+import json
 import logging
+import sys
 from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
 
-from back_operator import JsonOperator as Operator
-from tools import time_2_timestamp
+from back_operator import Operator
+from tools import time_2_timestamp, times_2_timestamps
 
 logger = logging.getLogger('alist.sync.file_record')
 
+HASH_FIELDS = ('hash_info', 'hashinfo')
+
+
+def hash_text(dic: dict) -> Optional[str]:
+    """fs/list, fs/get 条目中的 hash_info 转为 'md5:...,sha1:...' (算法排序, 小写), 没有时返回 None
+
+    新版本 Alist 返回对象 hash_info, 旧版本返回 JSON 字符串 hashinfo ('null' 表示没有)。
+    """
+    info = dic.get('hash_info')
+    if info is None:
+        info = dic.get('hashinfo')
+    if isinstance(info, str):
+        try:
+            info = json.loads(info) if info else None
+        except ValueError:
+            return None
+    if not isinstance(info, dict):
+        return None
+    pairs = sorted((str(k).lower(), str(v).lower()) for k, v in info.items() if v)
+    return ','.join(f'{k}:{v}' for k, v in pairs) or None
+
+
+def parse_hashes(text: Optional[str]) -> dict:
+    """hash_text 的逆操作, 返回 {algo: hex}"""
+    return dict(pair.split(':', 1) for pair in text.split(',')) if text else dict()
+
+
+def same_content(a: 'FileEntry', b: 'FileEntry') -> Optional[bool]:
+    """比较两个文件的 size 和 hash: size 或共同算法的 hash 不同为 False,
+    共同算法的 hash 全部相同为 True, 没有共同的算法时为 None (无法判断)"""
+    if a.size != b.size:
+        return False
+    ha, hb = parse_hashes(a.hash), parse_hashes(b.hash)
+    common = ha.keys() & hb.keys()
+    if not common:
+        return None
+    return all(ha[k] == hb[k] for k in common)
+
+
+class FileEntry(NamedTuple):
+    """一个文件的记录, 替代 fs/list 返回的 dict
+
+    NamedTuple 没有 __dict__ (__slots__ = ()), 每条约 64 字节,
+    保存为 json 时是一个数组 [modified, size, is_dir, hash]。
+    hash 是存储提供的 hash_info, 格式见 hash_text; 旧缓存中没有这一列。
+    """
+    modified: Optional[int]
+    size: Optional[int]
+    is_dir: bool = False
+    hash: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, dic: dict) -> 'FileEntry':
+        """从 fs/list, fs/get 的条目 或 旧版本缓存中的 dict 创建"""
+        return cls(time_2_timestamp(dic.get('modified')), dic.get('size'), bool(dic.get('is_dir', False)),
+                   hash_text(dic) or dic.get('hash'))
+
+    @classmethod
+    def from_dicts(cls, dics: Iterable[dict]) -> list:
+        """批量转换一页条目"""
+        dics = list(dics)
+        modified = times_2_timestamps([d.get('modified') for d in dics])
+        return [cls(m, d.get('size'), bool(d.get('is_dir', False)), hash_text(d)) for m, d in zip(modified, dics)]
+
+    @classmethod
+    def from_value(cls, value) -> 'FileEntry':
+        """从存储中读出的 list / dict 创建"""
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, dict):
+            return cls.from_dict(value)
+        return cls(*value)
+
+
+def _non_negative_int(x):
+    return x is None or type(x) is int and x >= 0
+
+
+def _optional_str(x):
+    return x is None or type(x) is str
+
 
 class FileRecord(Operator):
     data_model_item = {
-        "modified": lambda x: x is None or isinstance(x, int) and x >= 0,
-        "size": lambda x: x is None or isinstance(x, int) and x >= 0
+        "modified": _non_negative_int,
+        "size": _non_negative_int,
+        "hash": _optional_str,
     }
 
-    def verify_item_value(self, value: dict) -> bool:
+    def load_value(self, value) -> FileEntry:
+        return FileEntry.from_value(value)
+
+    def verify_item_value(self, value: FileEntry) -> bool:
+        for key, v in self.data_model_item.items():
+            if not v(getattr(value, key)):
+                logging.getLogger('alist.sync.operator').debug('Error: %s : %s is NOT success ',
+                                                               key, getattr(value, key))
+                return False
+        return True
+
+    def verify_entries(self, entries: Iterable[FileEntry]) -> bool:
+        """按列一次验证一批记录"""
+        entries = list(entries)
         for key, v in self.data_model_item.items():
-            if not v(value[key]):
-                logging.getLogger('alist.sync.operator').debug('Error: %s : %s is NOT success ', key, value[key])
+            column = [getattr(e, key) for e in entries]
+            if all(type(x) is int for x in column):
+                if column and min(column) < 0:
+                    return False
+            elif not all(map(v, column)):
                 return False
         return True
 
-    def update_path(self, path, item_value: dict):
-        if isinstance(item_value['modified'], str):
-            item_value['modified'] = time_2_timestamp(item_value['modified'])
-        keys = self.data_model_item.keys()
-        for _ in list(item_value.keys()):
-            if _ not in keys:
-                del item_value[_]
+    def update_path(self, path, item_value):
+        if not isinstance(item_value, FileEntry):
+            item_value = FileEntry.from_value(item_value)
         return super().update_path(path, item_value)
 
+    def update_many(self, items: Iterable[tuple]):
+        """批量更新 [(path, FileEntry | dict), ...], 整批验证一次, 逐条写入时不再验证
+
+        sub_path 被 intern: 互为镜像的 item 中相同的 sub_path 共用一个字符串。
+        """
+        rows = []
+        for path, value in items:
+            item_dir, sub_path = self.verify_path_relative_item_base(path)
+            rows.append((item_dir, sys.intern(sub_path),
+                         value if isinstance(value, FileEntry) else FileEntry.from_value(value)))
+        if not self.verify_entries(v for _, _, v in rows):
+            raise ValueError(f'item_value 验证失败。')
+        for item_dir, sub_path, entry in rows:
+            self._store(item_dir, sub_path, entry)
+
+
+def bench_memory(n=200000):
+    """对比 dict 与 FileEntry 的内存占用"""
+    import tracemalloc
+
+    def measure(factory):
+        tracemalloc.start()
+        data = {sys.intern('/item'): {f'dir_{i // 100}/file_{i}.txt': factory(i) for i in range(n)}}
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del data
+        return current
+
+    as_dict = measure(lambda i: {'modified': 1667000000 + i, 'size': i})
+    as_entry = measure(lambda i: FileEntry(1667000000 + i, i))
+    print(f'{n} records: dict {as_dict / n:.1f} B/record, FileEntry {as_entry / n:.1f} B/record, '
+          f'saved {1 - as_entry / as_dict:.1%}')
+
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        bench_memory()
+        sys.exit()
+
     import logging.config, yaml
 
     logging.config.dictConfig(yaml.safe_load(open('logger_config.yml').read()))
@@ -38,6 +172,6 @@ if __name__ == '__main__':
     log.info(f'start file record file. ')
     stat = FileRecord('json:///tmp/tmp.json')  # ('json:///tmp/tmp.json')
     stat.set_item_dirs(['/item'])
-    stat.create_path('/item/sub', {'modified': '123', 'size': 222})
+    stat.create_path('/item/sub', {'modified': '2022-10-29T17:23:00Z', 'size': 222})
     log.info(f'END')
     Path('/tmp/tmp.json').unlink(missing_ok=True)
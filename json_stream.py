@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : json_stream.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/05 16:20
+
+fs/list 响应的流式解析。
+
+响应结构: {"code": 200, "message": "success", "data": {"content": [...], "total": 1, ...}}
+content 数组中的元素在读取到时立即返回，不需要先把整个响应读入内存。
+"""
+import codecs
+import json
+import logging
+from typing import Callable, Iterable
+
+logger = logging.getLogger('alist.client.stream')
+
+_WS = ' \t\n\r'
+
+
+class _Reader:
+    """在分块读取的文本上用 JSONDecoder.raw_decode 逐个解析值"""
+
+    def __init__(self, read: Callable[[int], bytes], chunk_size=64 * 1024):
+        self._read = read
+        self.chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.nbytes = 0
+
+    def fill(self):
+        if self.eof:
+            raise json.JSONDecodeError('响应不完整', self.buf, self.pos)
+        chunk = self._read(self.chunk_size)
+        self.nbytes += len(chunk)
+        self.eof = not chunk
+        if self.pos > self.chunk_size:  # 丢弃已经解析的部分
+            self.buf, self.pos = self.buf[self.pos:], 0
+        self.buf += self._decoder.decode(chunk, final=self.eof)
+
+    def peek(self) -> str:
+        """跳过空白, 返回下一个字符"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WS:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self.fill()
+
+    def expect(self, chars):
+        ch = self.peek()
+        if ch not in chars:
+            raise json.JSONDecodeError(f'应该是 {chars!r}', self.buf, self.pos)
+        self.pos += 1
+        return ch
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self._json.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                self.fill()
+                continue
+            if end == len(self.buf) and not self.eof:  # 数字可能被截断, 读更多再确认
+                self.fill()
+                continue
+            self.pos = end
+            return obj
+
+
+def _members(reader: _Reader):
+    """遍历对象的 key, 调用者负责读取 value"""
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.pos += 1
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        yield key
+        if reader.expect(',}') == '}':
+            return
+
+
+def iter_list_content(read: Callable[[int], bytes], fields: Iterable[str] = None, meta: dict = None,
+                      verify: Callable[[dict], None] = None):
+    """流式解析 fs/list 的响应, 逐个返回 content 中的条目
+
+    :param read: 读取函数, 例如 HTTPResponse.read
+    :param fields: 只保留条目中的这些字段
+    :param meta: 解析完成后填充 code, message 以及 data 中除 content 以外的字段 (total 等)
+    :param verify: 以 {code, message} 调用, 检查错误码; 在第一个条目返回之前调用
+    """
+    reader = _Reader(read)
+    meta = dict() if meta is None else meta
+    fields = tuple(fields) if fields else None
+    held = []  # code 出现之前的条目, 验证后再返回
+    verified = False
+
+    def check():
+        nonlocal verified
+        if not verified and 'code' in meta:
+            verified = True
+            if verify is not None:
+                verify(meta)
+
+    for key in _members(reader):
+        if key != 'data' or reader.peek() != '{':
+            meta[key] = reader.value()
+            if 'message' in meta:
+                check()
+            continue
+        check()
+        for data_key in _members(reader):
+            if data_key != 'content' or reader.peek() != '[':
+                meta[data_key] = reader.value()
+                continue
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+                continue
+            while True:
+                entry = reader.value()
+                if fields:
+                    entry = {k: entry[k] for k in fields if k in entry}
+                if verified:
+                    yield entry
+                else:
+                    held.append(entry)
+                if reader.expect(',]') == ']':
+                    break
+    check()
+    meta['nbytes'] = reader.nbytes
+    yield from held
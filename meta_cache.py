@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : meta_cache.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/09 20:10
+
+客户端的元数据缓存, 减少对 Alist 服务器的请求。
+
+fs_get, fs_list, fs_dir 以及完整的 fs_list_iter 列表按 TTL 缓存, 按条目数和估计的字节数 LRU 淘汰。
+每个缓存条目登记在它所属的目录下, fs_copy / fs_move / fs_remove / fs_rename / fs_mkdir / fs_create_file / fs_put_stream
+之后使受影响目录的条目失效。
+
+注意: fs_copy 在服务器上是异步任务, 任务完成前重新缓存的列表可能是旧的, 依赖 TTL 过期。
+缓存的值是共享的, 调用者不要修改。
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from json import dumps
+from pathlib import PurePosixPath as Path
+from typing import Dict, Iterable
+
+from alist_client import Client
+
+logger = logging.getLogger('alist.client.cache')
+
+_MISS = object()
+_END = object()
+
+
+def _parent(path) -> str:
+    return Path(path).parent.as_posix()
+
+
+def _norm(path) -> str:
+    return Path(path).as_posix()
+
+
+class MetaCache:
+    """TTL + LRU 缓存
+
+    :param ttl: 默认的过期时间 (秒)
+    :param ttls: 路径前缀 -> 过期时间, 最深的前缀优先, 例如 {'/local': 600, '/onedrive': 30}
+    :param max_entries: 最多缓存的条目数
+    :param max_bytes: 缓存值的估计大小 (JSON 字节数) 上限
+    """
+
+    def __init__(self, ttl=60.0, ttls: Dict[str, float] = None, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.ttl = ttl
+        self.ttls = {_norm(k): v for k, v in (ttls or dict()).items()}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.nbytes = 0
+        self.stats = dict(hits=0, misses=0, expired=0, evictions=0, invalidations=0)
+        self._data = OrderedDict()  # key -> (expire, size, dirs, value)
+        self._dirs = dict()  # dir -> {key, }
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total else 0.0
+
+    def ttl_for(self, path) -> float:
+        """路径的过期时间"""
+        if not self.ttls:
+            return self.ttl
+        path = _norm(path)
+        while True:
+            if path in self.ttls:
+                return self.ttls[path]
+            if path in ('/', '.', ''):
+                return self.ttl
+            path = _parent(path)
+
+    def get(self, key, default=None):
+        with self._lock:
+            record = self._data.get(key, _MISS)
+            if record is _MISS:
+                self.stats['misses'] += 1
+                return default
+            if record[0] < time.monotonic():
+                self._pop(key)
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return default
+            self._data.move_to_end(key)
+            self.stats['hits'] += 1
+            return record[3]
+
+    def put(self, key, value, dirs: Iterable[str], size: int = None, ttl: float = None):
+        """缓存 value, dirs 中的任一目录失效时 value 失效
+
+        :param size: 估计的字节数, None 时按 JSON 序列化的长度计算
+        """
+        dirs = tuple(_norm(d) for d in dirs)
+        if size is None:
+            size = len(dumps(value, ensure_ascii=False))
+        if size > self.max_bytes:
+            return
+        if ttl is None:
+            ttl = self.ttl_for(dirs[0]) if dirs else self.ttl
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (time.monotonic() + ttl, size, dirs, value)
+            self.nbytes += size
+            for d in dirs:
+                self._dirs.setdefault(d, set()).add(key)
+            while len(self._data) > self.max_entries or self.nbytes > self.max_bytes:
+                self._pop(next(iter(self._data)))
+                self.stats['evictions'] += 1
+
+    def _pop(self, key):
+        _, size, dirs, _ = self._data.pop(key)
+        self.nbytes -= size
+        for d in dirs:
+            keys = self._dirs.get(d)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._dirs[d]
+
+    def invalidate(self, path, recursive=False) -> int:
+        """使登记在 path 下的条目失效, recursive 时包括全部子目录, 返回失效的条目数"""
+        path = _norm(path)
+        with self._lock:
+            if recursive:
+                prefix = path.rstrip('/') + '/'
+                dirs = [d for d in self._dirs if d == path or d.startswith(prefix)]
+            else:
+                dirs = [path] if path in self._dirs else []
+            keys = {k for d in dirs for k in self._dirs.get(d, ())}
+            for key in keys:
+                self._pop(key)
+            self.stats['invalidations'] += len(keys)
+        if keys:
+            logger.debug('缓存失效 %s, %d 个条目', path, len(keys))
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._dirs.clear()
+            self.nbytes = 0
+
+    def report(self) -> dict:
+        return dict(self.stats, entries=len(self._data), nbytes=self.nbytes, hit_rate=round(self.hit_rate, 4))
+
+
+class CachedClient(Client):
+    """带元数据缓存的 Client, refresh_token=True 的请求绕过缓存并更新缓存"""
+
+    def __init__(self, base_url: str, pool=None, cache: MetaCache = None, policy=None):
+        super().__init__(base_url, pool=pool, policy=policy)
+        self.meta_cache = MetaCache() if cache is None else cache
+
+    def _bypass(self) -> bool:
+        return getattr(self._local, 'cache_bypass', False)
+
+    def fs_get(self, path):
+        key = ('get', _norm(path))
+        value = self.meta_cache.get(key, _MISS)
+        if value is _MISS:
+            value = super().fs_get(path)
+            self.meta_cache.put(key, value, (_parent(path), path), size=self.last_response_size)
+        return value
+
+    def fs_list(self, path, page=1, per_page=10, refresh_token=False):
+        if self._bypass():
+            return super().fs_list(path, page, per_page, refresh_token)
+        key = ('list', _norm(path), page, per_page)
+        value = _MISS if refresh_token else self.meta_cache.get(key, _MISS)
+        if value is _MISS:
+            value = super().fs_list(path, page, per_page, refresh_token)
+            self.meta_cache.put(key, value, (path,), size=self.last_response_size)
+        return value
+
+    def fs_dir(self, path, force_root=False):
+        key = ('dirs', _norm(path), force_root)
+        value = self.meta_cache.get(key, _MISS)
+        if value is _MISS:
+            value = super().fs_dir(path, force_root)
+            self.meta_cache.put(key, value, (path,), size=self.last_response_size)
+        return value
+
+    def fs_list_iter(self, path, refresh_token=False, per_page=None, stream=False, fields=None):
+        """缓存完整的列表; 列表超过缓存大小上限时不缓存
+
+        迭代内部的分页请求不单独缓存, 避免同一个列表保存两份。
+        """
+        key = ('iter', _norm(path), tuple(fields) if fields else None)
+        entries = _MISS if refresh_token else self.meta_cache.get(key, _MISS)
+        if entries is not _MISS:
+            yield from entries
+            return
+
+        inner = super().fs_list_iter(path, refresh_token, per_page, stream, fields)
+        entries, size = [], 0
+        while True:
+            self._local.cache_bypass = True
+            try:
+                entry = next(inner, _END)
+            finally:
+                self._local.cache_bypass = False
+            if entry is _END:
+                break
+            if entries is not None:
+                entries.append(entry)
+                size += len(entry) * 24  # 粗略估计, 完整时再按 JSON 计算
+                if size > self.meta_cache.max_bytes:
+                    entries = None
+            yield entry
+        if entries is not None:
+            self.meta_cache.put(key, entries, (path,))
+
+    def _invalidate(self, *dirs, recursive=()):
+        for d in dirs:
+            self.meta_cache.invalidate(d)
+        for d in recursive:
+            self.meta_cache.invalidate(d, recursive=True)
+
+    def fs_create_file(self, path, data):
+        try:
+            return super().fs_create_file(path, data)
+        finally:
+            self._invalidate(_parent(path), path)
+
+    def fs_put_stream(self, path, source, *args, **kwargs):
+        try:
+            return super().fs_put_stream(path, source, *args, **kwargs)
+        finally:
+            self._invalidate(_parent(path), path)
+
+    def fs_mkdir(self, path, exist_ok=True, parents=True):
+        try:
+            return super().fs_mkdir(path, exist_ok, parents)
+        finally:
+            self._invalidate(_parent(path), path)
+
+    def fs_rename(self, path, new_name):
+        try:
+            return super().fs_rename(path, new_name)
+        finally:
+            self._invalidate(_parent(path), recursive=(path, Path(path).with_name(new_name).as_posix()))
+
+    def fs_move(self, src_dir, dst_dir, *names):
+        try:
+            return super().fs_move(src_dir, dst_dir, *names)
+        finally:
+            self._invalidate(src_dir, dst_dir, recursive=[Path(d, n).as_posix()
+                                                          for d in (src_dir, dst_dir) for n in names])
+
+    def fs_copy(self, src_dir, dst_dir, *names):
+        try:
+            return super().fs_copy(src_dir, dst_dir, *names)
+        finally:
+            self._invalidate(dst_dir, recursive=[Path(dst_dir, n).as_posix() for n in names])
+
+    def fs_remove(self, _dir, *names):
+        try:
+            return super().fs_remove(_dir, *names)
+        finally:
+            self._invalidate(_dir, recursive=[Path(_dir, n).as_posix() for n in names])
@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : metrics.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/12 15:20
+
+运行指标: 计数器, 仪表, 直方图, 导出到可替换的 Sink (内存, Prometheus 文本文件)。
+
+默认关闭, 埋点处先检查 METRICS.enabled, 关闭时只有一次属性访问的开销:
+
+    if METRICS.enabled:
+        METRICS.observe('alist_request_seconds', elapsed, api=api)
+
+    METRICS.enable(PrometheusFileSink('/var/lib/node_exporter/alist_sync.prom'), interval=15)
+"""
+import atexit
+import bisect
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from tools import atomic_write_text
+
+logger = logging.getLogger('alist.metrics')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        cumulative, total = [], 0
+        for c in self.counts[:-1]:
+            total += c
+            cumulative.append(total)
+        return dict(buckets=dict(zip(self.buckets, cumulative)), sum=self.sum, count=self.count)
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """指标注册表, 线程安全; labels 按调用时的顺序组成 key"""
+
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+        self.interval = None
+        self._counters: Dict[str, Dict[Tuple, float]] = dict()
+        self._gauges: Dict[str, Dict[Tuple, float]] = dict()
+        self._hists: Dict[str, Dict[Tuple, _Histogram]] = dict()
+        self._buckets = dict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._atexit_registered = False
+
+    def enable(self, *sinks, interval: float = None):
+        """开启指标, interval 秒定时导出到 sinks, 退出时再导出一次
+
+        可以多次调用 (一个进程中有多个同步组), 已经注册的 sink (相等的) 不会重复注册, 导出线程只有一个
+        """
+        self.enabled = True
+        with self._lock:
+            sinks = [sink for sink in sinks if sink not in self.sinks]
+            self.sinks.extend(sinks)
+        if interval and sinks and self._thread is None:
+            self.interval = interval
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._export_loop, name='metrics_export', daemon=True)
+            self._thread.start()
+            if not self._atexit_registered:
+                atexit.register(self.export)
+                self._atexit_registered = True
+        return self
+
+    def disable(self):
+        """关闭指标并等待导出线程结束, 之后再次 enable 时只有一个导出线程"""
+        self.enabled = False
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._hists.clear()
+
+    def set_buckets(self, name, buckets):
+        """设置直方图的桶, 默认 LATENCY_BUCKETS"""
+        self._buckets[name] = tuple(sorted(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(labels.items())
+        with self._lock:
+            series = self._counters.setdefault(name, dict())
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, dict())[tuple(labels.items())] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(labels.items())
+        with self._lock:
+            series = self._hists.setdefault(name, dict())
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = _Histogram(self._buckets.get(name, LATENCY_BUCKETS))
+            hist.observe(value)
+
+    def timer(self, name, **labels):
+        """with METRICS.timer('name', label=...): 记录耗时 (秒); 关闭时不计时"""
+        return _Timer(self, name, labels) if self.enabled else _NULL_TIMER
+
+    def snapshot(self) -> dict:
+        """{'counters': {name: {labels: value}}, 'gauges': ..., 'histograms': {name: {labels: {...}}}}"""
+        with self._lock:
+            return dict(counters={n: dict(s) for n, s in self._counters.items()},
+                        gauges={n: dict(s) for n, s in self._gauges.items()},
+                        histograms={n: {k: h.snapshot() for k, h in s.items()} for n, s in self._hists.items()})
+
+    def export(self):
+        if not self.sinks:
+            return
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            try:
+                sink.export(snapshot)
+            except Exception as _e:
+                logger.error('导出指标到 %s 失败: %s', sink, _e)
+
+    def _export_loop(self):
+        while not self._stop.wait(self.interval):
+            self.export()
+
+
+class MemorySink:
+    """保存最近一次导出的快照, 供测试或在进程内读取"""
+
+    def __init__(self, history=0):
+        self.snapshot = dict()
+        self.history: List[dict] = []
+        self.max_history = history
+
+    def export(self, snapshot: dict):
+        self.snapshot = snapshot
+        if self.max_history:
+            self.history = (self.history + [snapshot])[-self.max_history:]
+
+
+def _labels(key, extra=()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escape = lambda v: str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+
+def prometheus_text(snapshot: dict) -> str:
+    """Prometheus 文本格式"""
+    lines = []
+    for name, series in sorted(snapshot.get('counters', dict()).items()):
+        lines.append(f'# TYPE {name} counter')
+        lines.extend(f'{name}{_labels(k)} {v}' for k, v in series.items())
+    for name, series in sorted(snapshot.get('gauges', dict()).items()):
+        lines.append(f'# TYPE {name} gauge')
+        lines.extend(f'{name}{_labels(k)} {v}' for k, v in series.items())
+    for name, series in sorted(snapshot.get('histograms', dict()).items()):
+        lines.append(f'# TYPE {name} histogram')
+        for k, h in series.items():
+            for le, count in h['buckets'].items():
+                lines.append(f'{name}_bucket{_labels(k, [("le", le)])} {count}')
+            lines.append(f'{name}_bucket{_labels(k, [("le", "+Inf")])} {h["count"]}')
+            lines.append(f'{name}_sum{_labels(k)} {h["sum"]}')
+            lines.append(f'{name}_count{_labels(k)} {h["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusFileSink:
+    """写入 Prometheus 文本文件, 供 node_exporter 的 textfile collector 读取"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return f'PrometheusFileSink({self.path})'
+
+    def __eq__(self, other):
+        return isinstance(other, PrometheusFileSink) and os.path.abspath(other.path) == os.path.abspath(self.path)
+
+    def __hash__(self):
+        return hash(os.path.abspath(self.path))
+
+    def export(self, snapshot: dict):
+        atomic_write_text(self.path, prometheus_text(snapshot))
+
+
+METRICS = Metrics()
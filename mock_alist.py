@@ -0,0 +1,376 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : mock_alist.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/08 20:40
+
+进程内的 Alist 模拟服务器, 用于基准测试和本地调试。
+
+实现了 /api/auth/login, /api/me, /api/fs/* 与 /api/admin/task/copy/* 的主要行为,
+目录树按 宽度/深度/文件数 生成, 可以注入固定的请求延迟。
+
+    with MockAlist(roots=['/local', '/onedrive'], width=5, depth=3, files=20) as server:
+        client = Client(server.base_url)
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import PurePosixPath as Path
+
+_MODIFIED = '2022-10-29T17:23:00Z'
+_PERIOD = 251
+
+
+def payload(entry, start, end) -> bytes:
+    """文件 [start, end) 的内容: _content 或者由文件名决定的重复序列"""
+    content = entry.get('_content')
+    if content is not None:
+        return content[start:end]
+    k = zlib.crc32(entry['name'].encode()) % _PERIOD
+    pattern = bytes((i * 7 + k) % _PERIOD for i in range(_PERIOD))
+    offset = start % _PERIOD
+    return (pattern * ((end - start) // _PERIOD + 2))[offset:offset + end - start]
+
+
+class MockTree:
+    """模拟的文件系统: 目录 -> {name: entry}"""
+
+    def __init__(self, roots=('/local',), width=3, depth=2, files=10, file_size=1024):
+        self.dirs = dict()
+        self.lock = threading.RLock()
+        for root in roots:
+            self._build(Path(root).as_posix(), width, depth, files, file_size)
+
+    def _build(self, path, width, depth, files, file_size):
+        self.mkdir(path)
+        for i in range(files):
+            self.add_file(f'{path}/file_{i}.txt', file_size + i)
+        if depth > 0:
+            for i in range(width):
+                self._build(f'{path}/dir_{i}', width, depth - 1, files, file_size)
+
+    def mkdir(self, path):
+        with self.lock:
+            path = Path(path)
+            for p in reversed([path, *path.parents]):
+                p = p.as_posix()
+                if p not in self.dirs:
+                    self.dirs[p] = dict()
+                    if p != '/':
+                        self.dirs[Path(p).parent.as_posix()][Path(p).name] = self._entry(Path(p).name, True, 0)
+
+    @staticmethod
+    def _entry(name, is_dir, size, modified=_MODIFIED):
+        return {'name': name, 'size': size, 'is_dir': is_dir, 'modified': modified,
+                'sign': '', 'thumb': '', 'type': 1 if is_dir else 0, 'hash_info': None}
+
+    def add_file(self, path, size, modified=_MODIFIED, content=None, hash_info=None):
+        with self.lock:
+            path = Path(path)
+            self.mkdir(path.parent)
+            entry = self._entry(path.name, False, size, modified)
+            entry['hash_info'] = hash_info
+            if content is not None:
+                entry['_content'] = content
+            self.dirs[path.parent.as_posix()][path.name] = entry
+            return entry
+
+    def list(self, path) -> list:
+        """目录中条目的副本 (其他请求线程可能同时修改目录), 目录不存在时返回 None"""
+        with self.lock:
+            entries = self.dirs.get(Path(path).as_posix())
+            return None if entries is None else [dict(e) for e in entries.values()]
+
+    def get(self, path):
+        path = Path(path)
+        if path.as_posix() == '/':
+            return self._entry('root', True, 0)
+        return self.dirs.get(path.parent.as_posix(), dict()).get(path.name)
+
+    def remove(self, path):
+        with self.lock:
+            path = Path(path).as_posix()
+            for p in [p for p in self.dirs if p == path or p.startswith(path + '/')]:
+                del self.dirs[p]
+            self.dirs.get(Path(path).parent.as_posix(), dict()).pop(Path(path).name, None)
+
+    @property
+    def file_count(self):
+        with self.lock:
+            return sum(1 for d in self.dirs.values() for e in d.values() if not e['is_dir'])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server: 'MockAlist'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, data=None, code=200, message='success'):
+        body = json.dumps({'code': code, 'message': message, 'data': data}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status):
+        body = b'Service Unavailable'
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(raw or b'null') or dict()
+        except ValueError:
+            return raw
+
+    def _handle(self):
+        mock = self.server
+        parse = urllib.parse.urlsplit(self.path)
+        api = parse.path[len('/api'):] if parse.path.startswith('/api') else parse.path
+        mock.count(api)
+        if mock.latency:
+            time.sleep(mock.latency)
+        if mock.error_rate and api != '/auth/login' and random.random() < mock.error_rate:
+            self._body()
+            return self._error(503)
+
+        if parse.path.startswith(('/d/', '/p/')):
+            return self._download(urllib.parse.unquote(parse.path[2:]), redirect=parse.path.startswith('/d/'))
+        if api == '/fs/put':
+            return self._put()
+        body = self._body()
+        if api == '/auth/login':
+            return self._send({'token': mock.token})
+        if mock.token and self.headers.get('Authorization') != mock.token:
+            return self._send(None, 401, 'token is invalidated')
+        handler = getattr(self, 'api_' + api.strip('/').replace('/', '_'), None)
+        if handler is None:
+            return self._send(None, 404, f'not found {api}')
+        return handler(body, urllib.parse.parse_qs(parse.query))
+
+    do_GET = do_POST = do_PUT = _handle
+
+    def _download(self, path, redirect):
+        """/d/ 重定向到 /p/, /p/ 返回文件内容, 支持单个 Range"""
+        entry = self.server.tree.get(path)
+        if entry is None or entry['is_dir']:
+            return self._error(404)
+        if redirect:
+            self.send_response(302)
+            self.send_header('Location', '/p' + urllib.parse.quote(path))
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+        size, start, end, status = entry['size'], 0, entry['size'], 200
+        ranges = self.headers.get('Range')
+        if ranges and self.server.range_support:
+            first, last = ranges.split('=', 1)[1].split('-', 1)
+            start, end, status = int(first), min(int(last) + 1, size) if last else size, 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        self.end_headers()
+        try:
+            for offset in range(start, end, 1 << 20):
+                self.wfile.write(payload(entry, offset, min(offset + (1 << 20), end)))
+        except (BrokenPipeError, ConnectionResetError):  # 客户端提前关闭连接 (例如探测 Range)
+            self.close_connection = True
+
+    def _put(self):
+        path = urllib.parse.unquote_plus(self.headers.get('File-Path', ''))
+        length = self.headers.get('Content-Length')
+        size, md5 = 0, hashlib.md5()
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                n = int(self.rfile.readline().split(b';')[0], 16)
+                if n == 0:
+                    self.rfile.readline()
+                    break
+                chunk = self.rfile.read(n)
+                md5.update(chunk)
+                size += len(chunk)
+                self.rfile.readline()
+        else:
+            remaining = int(length or 0)
+            while remaining:
+                chunk = self.rfile.read(min(remaining, 1 << 20))
+                if not chunk:
+                    break
+                md5.update(chunk)
+                size += len(chunk)
+                remaining -= len(chunk)
+        modified = self.headers.get('Last-Modified')
+        if modified:
+            modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(int(modified) / 1000))
+        self.server.tree.add_file(path, size, modified or _MODIFIED, hash_info={'md5': md5.hexdigest()})
+        self._send(None)
+
+    def api_me(self, body, query):
+        return self._send({'username': self.server.username, 'base_path': '/'})
+
+    def api_fs_list(self, body, query):
+        entries = self.server.tree.list(body.get('path', '/'))
+        if entries is None:
+            return self._send(None, 500, 'object not found')
+        entries = [{k: v for k, v in e.items() if not k.startswith('_')} for e in entries]
+        if not self.server.list_hashes:
+            [e.update(hash_info=None) for e in entries]
+        page, per_page = max(body.get('page') or 1, 1), body.get('per_page') or 0
+        content = entries if per_page < 1 else entries[(page - 1) * per_page:page * per_page]
+        return self._send({'content': content, 'total': len(entries), 'readme': '', 'write': True,
+                           'provider': 'Local'})
+
+    def api_fs_get(self, body, query):
+        entry = self.server.tree.get(body.get('path', '/'))
+        if entry is None:
+            return self._send(None, 500, 'object not found')
+        data = {k: v for k, v in entry.items() if not k.startswith('_')}
+        data.update(raw_url=self.server.link(body.get('path')), provider='Local')
+        return self._send(data)
+
+    def api_fs_dirs(self, body, query):
+        entries = self.server.tree.list(body.get('path', '/')) or []
+        return self._send([{'name': e['name'], 'modified': e['modified']} for e in entries if e['is_dir']])
+
+    def api_fs_mkdir(self, body, query):
+        self.server.tree.mkdir(body['path'])
+        return self._send(None)
+
+    def api_fs_remove(self, body, query):
+        for name in body.get('names') or []:
+            self.server.tree.remove(f'{body["dir"]}/{name}')
+        return self._send(None)
+
+    def api_fs_link(self, body, query):
+        return self._send({'url': self.server.link(body.get('path')), 'header': {}})
+
+    def api_fs_copy(self, body, query):
+        for name in body.get('names') or []:
+            self.server.add_copy_task(body['src_dir'], body['dst_dir'], name)
+        return self._send(None)
+
+    def api_admin_task_copy_undone(self, body, query):
+        self.server.advance_tasks()
+        return self._send([t for t in self.server.tasks.values() if t['state'] in ('pending', 'running')])
+
+    def api_admin_task_copy_done(self, body, query):
+        return self._send([t for t in self.server.tasks.values() if t['state'] not in ('pending', 'running')])
+
+    def api_admin_task_copy_retry(self, body, query):
+        task = self.server.tasks.get(query.get('tid', [''])[0])
+        if task is None:
+            return self._send(None, 400, 'task not found')
+        task.update(state='pending', error='')
+        return self._send(None)
+
+
+class MockAlist(ThreadingHTTPServer):
+    """模拟的 Alist 服务器
+
+    :param latency: 每个请求注入的延迟 (秒)
+    :param fail_rate: 复制任务失败的概率
+    :param error_rate: 请求返回 HTTP 503 的概率
+    :param token: 非空时请求需要 Authorization 头
+    :param list_hashes: False 时 fs/list 不返回 hash_info, 只有 fs/get 返回 (部分存储的行为)
+    :param range_support: 直链 (/d/, /p/) 是否支持 Range 请求
+    """
+    daemon_threads = True
+
+    def __init__(self, roots=('/local',), width=3, depth=2, files=10, file_size=1024, latency=0.0,
+                 fail_rate=0.0, error_rate=0.0, token='mock_token', username='admin', host='127.0.0.1', port=0,
+                 list_hashes=True, range_support=True):
+        super().__init__((host, port), _Handler)
+        self.tree = MockTree(roots, width, depth, files, file_size)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.error_rate = error_rate
+        self.token = token
+        self.username = username
+        self.list_hashes = list_hashes
+        self.range_support = range_support
+        self.tasks = dict()
+        self.calls = dict()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/api'
+
+    def link(self, path):
+        """文件的直链, 先重定向到 /p/ 再返回内容"""
+        return f'{self.base_url[:-4]}/d{urllib.parse.quote(path)}'
+
+    def count(self, api):
+        with self._lock:
+            self.calls[api] = self.calls.get(api, 0) + 1
+
+    def add_copy_task(self, src_dir, dst_dir, name):
+        with self._lock:
+            tid = f'{len(self.tasks) + 1:08d}'
+            src_mount, src_rel = self._split_mount(f'{src_dir}/{name}')
+            dst_mount, dst_rel = self._split_mount(dst_dir)
+            self.tasks[tid] = {'id': tid, 'name': f'copy [{src_mount}]({src_rel}) to [{dst_mount}]({dst_rel})',
+                               'state': 'pending', 'status': '', 'progress': 0, 'error': '',
+                               '_src': Path(src_dir, name).as_posix(), '_dst_dir': Path(dst_dir).as_posix()}
+
+    @staticmethod
+    def _split_mount(path):
+        """第一级目录作为存储的挂载路径"""
+        parts = Path(path).parts
+        return '/' + parts[1], '/' + '/'.join(parts[2:])
+
+    def advance_tasks(self):
+        """每次查询未完成的任务时, 任务前进一步: pending -> running -> succeeded / failed"""
+        with self._lock:
+            for task in self.tasks.values():
+                if task['state'] == 'pending':
+                    task['state'] = 'running'
+                elif task['state'] == 'running':
+                    if random.random() < self.fail_rate:
+                        task.update(state='failed', error='mock failure')
+                        continue
+                    task.update(state='succeeded', progress=100)
+                    src = self.tree.get(task['_src'])
+                    if src is not None:
+                        self.tree.add_file(Path(task['_dst_dir'], src['name']), src['size'], src['modified'],
+                                          hash_info=src['hash_info'])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='mock_alist', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import sys
+
+    server = MockAlist(roots=['/local', '/onedrive'], port=int(sys.argv[1]) if sys.argv[1:] else 5244)
+    print(f'Mock Alist on {server.base_url}, token={server.token}, {server.tree.file_count} files')
+    server.serve_forever()
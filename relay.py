@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : relay.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/16 20:20
+
+客户端中转复制。
+
+Alist 的 fs_copy 在服务器上排队执行, 部分存储之间很慢。中转复制从源文件的直链 (fs_link) 下载,
+边下载边通过 fs_put_stream 上传到目标, 数据不落盘:
+
+    小文件 (或不支持 Range 的直链) 一个 GET 流式转发;
+    大于 segment_size 的文件按 Range 分段并行下载, 按顺序送入上传, 内存中最多 segments + 1 段;
+    全部中转共用一个令牌桶 (字节/秒) 限制带宽。
+
+CopyRouter 按 (源存储, 目标存储) 记录中转与服务器端复制测得的吞吐量, 为每个复制操作选择较快的方式。
+"""
+import contextlib
+import logging
+import random
+import threading
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import PurePosixPath as Path
+from typing import Dict, Iterable, Optional, Tuple
+
+from connection_pool import ConnectionPool
+from transport import TokenBucket
+
+logger = logging.getLogger('alist.sync.relay')
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 5
+_READ_SIZE = 256 * 1024
+
+SERVER, RELAY = 'server', 'relay'
+
+
+class RelayError(Exception):
+    pass
+
+
+class RangeNotSupported(RelayError):
+    """直链不支持 Range 请求"""
+
+
+def _link_headers(header: dict) -> dict:
+    """fs/link 返回的 header 是 {name: [value, ]}"""
+    return {k: ', '.join(v) if isinstance(v, (list, tuple)) else str(v) for k, v in (header or dict()).items()}
+
+
+class _Throttled:
+    """按令牌桶限速读取响应"""
+
+    def __init__(self, resp, bucket: Optional[TokenBucket]):
+        self.resp = resp
+        self.bucket = bucket
+
+    def read(self, n=-1):
+        chunk = self.resp.read(n)
+        if self.bucket is not None and chunk:
+            time.sleep(self.bucket.reserve(len(chunk)))
+        return chunk
+
+
+class _SegmentReader:
+    """按顺序返回并行下载的分段, 提前下载 relay.segments 段"""
+
+    def __init__(self, relay: 'RelayCopier', url, headers, size, first: bytes):
+        self.relay = relay
+        self.url = url
+        self.headers = headers
+        self.size = size
+        self._next = len(first)
+        self._buf = memoryview(first)
+        self._futures = deque()
+        self._executor = ThreadPoolExecutor(max_workers=relay.segments, thread_name_prefix='relay_segment')
+        self._fill()
+
+    def _fill(self):
+        while len(self._futures) < self.relay.segments and self._next < self.size:
+            start, end = self._next, min(self._next + self.relay.segment_size, self.size)
+            self._futures.append(self._executor.submit(self.relay.segment, self.url, self.headers, start, end))
+            self._next = end
+
+    def read(self, n=-1):
+        if not self._buf:
+            if not self._futures:
+                return b''
+            self._buf = memoryview(self._futures.popleft().result())
+            self._fill()
+        chunk = self._buf[:n] if n is not None and n >= 0 else self._buf
+        self._buf = self._buf[len(chunk):]
+        return chunk
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RelayCopier:
+    """从直链下载并上传到目标
+
+    :param client: Alist 客户端, 需要管理员权限 (fs_link)
+    :param segment_size: 大于它的文件按 Range 分段下载
+    :param segments: 每个文件同时下载的段数
+    :param bandwidth: 全部中转共用的下载带宽上限 (字节/秒), None 不限制
+    :param pool: 下载使用的连接池, 默认新建
+    :param max_retries: 每段的重试次数
+    """
+
+    def __init__(self, client, segment_size=16 * 1024 * 1024, segments=4, bandwidth: float = None,
+                 pool: ConnectionPool = None, timeout=60, max_retries=3):
+        self.client = client
+        self.segment_size = segment_size
+        self.segments = segments
+        self.bucket = TokenBucket(bandwidth, bandwidth) if bandwidth else None
+        self.pool = pool or ConnectionPool(maxsize=max(segments, 1) * 4, timeout=timeout)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.stats = dict(files=0, bytes=0, failed=0, segmented=0, streamed=0, seconds=0.0)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _open(self, url, headers):
+        """GET 并跟随重定向, 返回未读取的响应"""
+        for _ in range(_MAX_REDIRECTS + 1):
+            with self.pool.stream('GET', url, headers=headers, timeout=self.timeout) as resp:
+                if resp.status in _REDIRECTS:
+                    resp.read()
+                    url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                    continue
+                if resp.status not in (200, 206):
+                    resp.read()
+                    raise RelayError(f'下载失败 HTTP {resp.status}: {url}')
+                yield resp
+                return
+        raise RelayError(f'重定向次数过多: {url}')
+
+    def segment(self, url, headers, start, end) -> bytearray:
+        """下载 [start, end) 一段, 传输错误时重试"""
+        attempt = 0
+        while True:
+            try:
+                return self._segment(url, headers, start, end)
+            except (OSError, RelayError) as _e:
+                if isinstance(_e, RangeNotSupported) or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                logger.warning('下载分段 %d-%d 失败, 第 %d 次重试: %r', start, end, attempt, _e)
+                time.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+
+    def _segment(self, url, headers, start, end) -> bytearray:
+        buf = bytearray(end - start)
+        view = memoryview(buf)
+        with self._open(url, dict(headers, Range=f'bytes={start}-{end - 1}')) as resp:
+            if resp.status != 206:
+                resp.close()
+                raise RangeNotSupported(url)
+            got = 0
+            while got < len(buf):
+                n = resp.readinto(view[got:got + _READ_SIZE])
+                if not n:
+                    break
+                got += n
+                if self.bucket is not None:
+                    time.sleep(self.bucket.reserve(n))
+        view.release()
+        if got != len(buf):
+            raise RelayError(f'分段不完整 {start}-{end}: {got} 字节')
+        return buf
+
+    def copy(self, src_path, dst_path, size: int = None, modified: float = None) -> int:
+        """复制一个文件, 返回字节数"""
+        start = time.monotonic()
+        link = self.client.fs_link(src_path) or dict()
+        url, headers = link.get('url'), _link_headers(link.get('header'))
+        if not url:
+            raise RelayError(f'没有直链: {src_path}')
+
+        first = None
+        if size and size > self.segment_size and self.segments > 1:
+            try:
+                first = self.segment(url, headers, 0, self.segment_size)
+            except RangeNotSupported:
+                logger.info('%s 的直链不支持 Range, 单连接下载', src_path)
+
+        if first is not None:
+            reader = _SegmentReader(self, url, headers, size, first)
+            try:
+                self.client.fs_put_stream(dst_path, reader, size=size, modified=modified)
+            finally:
+                reader.close()
+        else:
+            with self._open(url, headers) as resp:
+                length = resp.getheader('Content-Length')
+                size = int(length) if length is not None else size
+                self.client.fs_put_stream(dst_path, _Throttled(resp, self.bucket), size=size, modified=modified)
+
+        with self._lock:
+            self.stats['files'] += 1
+            self.stats['bytes'] += size or 0
+            self.stats['segmented' if first is not None else 'streamed'] += 1
+            self.stats['seconds'] += time.monotonic() - start
+        return size or 0
+
+    def copy_many(self, ops: Iterable[Tuple[str, str, int, Optional[float]]], workers=4, on_done=None) -> dict:
+        """并发复制 [(src_path, dst_path, size, modified), ...]
+
+        :param on_done: 回调 (src_path, dst_path, size, seconds, error), 成功时 error 为 None
+        """
+        def copy(op):
+            start = time.monotonic()
+            try:
+                self.copy(*op)
+            except Exception as _e:
+                return op, time.monotonic() - start, _e
+            return op, time.monotonic() - start, None
+
+        ops = list(ops)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='relay') as executor:
+            for future in as_completed([executor.submit(copy, op) for op in ops]):
+                op, seconds, error = future.result()
+                if error is not None:
+                    with self._lock:
+                        self.stats['failed'] += 1
+                    logger.error('中转复制失败 %s -> %s: %s', op[0], op[1], error)
+                if on_done is not None:
+                    on_done(op[0], op[1], op[2], seconds, error)
+        logger.info('中转复制 %d 个文件: %s', len(ops), self.stats)
+        return dict(self.stats)
+
+
+def storage_of(path) -> str:
+    """路径所在的存储, 以第一级目录作为挂载路径"""
+    parts = Path(path).parts
+    return '/' + parts[1] if len(parts) > 1 else '/'
+
+
+class CopyRouter:
+    """为每个复制操作选择中转 (relay) 或服务器端复制 (server)
+
+    按 (源存储, 目标存储, 方式) 记录吞吐量 (字节/秒) 的指数加权平均:
+    两种方式都有测量值后选择较快的一种, 以 explore 的概率继续尝试另一种; 缺少测量值的方式优先尝试。
+    服务器端复制的耗时从提交到任务完成, 包含排队时间。
+
+    :param mode: 'auto' | 'server' | 'relay'
+    :param min_size: 小于它的文件总是服务器端复制 (中转的请求开销相对太大)
+    """
+
+    def __init__(self, mode='auto', alpha=0.3, explore=0.05, min_size=1024 * 1024):
+        if mode not in ('auto', SERVER, RELAY):
+            raise ValueError(f'mode 应该是 auto, server, relay: {mode}')
+        self.mode = mode
+        self.alpha = alpha
+        self.explore = explore
+        self.min_size = min_size
+        self.throughput: Dict[tuple, float] = dict()
+        self._lock = threading.Lock()
+
+    def choose(self, src_path, dst_path, size) -> str:
+        if self.mode != 'auto':
+            return self.mode
+        if (size or 0) < self.min_size:
+            return SERVER
+        pair = storage_of(src_path), storage_of(dst_path)
+        server, relay = self.throughput.get(pair + (SERVER,)), self.throughput.get(pair + (RELAY,))
+        if server is None and relay is None:
+            return random.choice((SERVER, RELAY))
+        if server is None or relay is None:
+            return SERVER if server is None else RELAY
+        best, other = (RELAY, SERVER) if relay > server else (SERVER, RELAY)
+        return other if random.random() < self.explore else best
+
+    def record(self, src_path, dst_path, method, size, seconds):
+        if not size or seconds <= 0:
+            return
+        key = (storage_of(src_path), storage_of(dst_path), method)
+        rate = size / seconds
+        with self._lock:
+            old = self.throughput.get(key)
+            self.throughput[key] = rate if old is None else old + self.alpha * (rate - old)
+
+    def report(self) -> dict:
+        return {f'{s} -> {d} {m}': round(v) for (s, d, m), v in self.throughput.items()}
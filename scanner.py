@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : scanner.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/03 22:05
+
+基于工作队列的广度优先目录扫描器。
+
+多个线程并发的请求目录列表，列表结果通过队列交回调用者所在的线程，
+所以 on_file / on_files / on_dir_done 回调总是在同一个线程中执行，Operator 不需要加锁。
+一个目录在它的全部子目录扫描完成后才会回调 on_dir_done。
+目录回调的 entry 是父目录列表中该目录的 FileEntry, 根目录为 None。
+"""
+import heapq
+import logging
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath as Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from alist_client import Client
+from file_record import FileEntry
+from metrics import METRICS
+
+logger = logging.getLogger('alist.sync.scanner')
+
+_ENTRIES, _LISTED, _ERROR, _BUSY = range(4)
+LIST_FIELDS = ('name', 'is_dir', 'modified', 'size')
+
+
+class DirBusy(Exception):
+    """list_dir 在返回任何条目之前抛出: 目录暂时不能列出 (其他节点正在列出),
+    Scanner 稍后重试, 期间工作线程先列出其他目录"""
+
+
+def list_entries(client: Client, path, fields=LIST_FIELDS, refresh=False,
+                 batch_size=200) -> Iterator[Tuple[str, FileEntry]]:
+    """列出一个目录, 返回 (name, FileEntry); 每 batch_size 个条目用 FileEntry.from_dicts 一起转换"""
+    page = []
+    for file_dic in client.fs_list_iter(path, refresh_token=refresh, stream=True, fields=fields):
+        page.append(file_dic)
+        if len(page) >= batch_size:
+            yield from zip((d['name'] for d in page), FileEntry.from_dicts(page))
+            page = []
+    if page:
+        yield from zip((d['name'] for d in page), FileEntry.from_dicts(page))
+
+
+class Scanner:
+    """并发扫描目录树
+
+    :param client: 线程安全的 Alist 客户端
+    :param on_file: 回调 (path, FileEntry), 每个文件调用一次
+    :param on_files: 回调 ([(path, FileEntry), ...]), 每批条目中的文件调用一次, 设置时代替 on_file
+    :param on_dir_done: 回调 (path, entry), 目录及其全部子目录扫描完成
+    :param skip_dir: 回调 (path, entry) -> bool, 返回 True 的目录不会被扫描
+    :param workers: 并发请求目录列表的线程数
+    :param batch_size: 每批交回调用线程的条目数
+    :param progress_interval: 每隔多少秒输出一次进度 (日志 与 scan_*_per_second 指标)
+    :param on_progress: 回调 (dict), 与进度日志同时调用, 包含 stats 与 pending, dirs_per_sec, files_per_sec
+    :param fields: 列表条目中保留的字段, 需要 hash 时加上 file_record.HASH_FIELDS
+    :param list_dir: 回调 (path) -> 可迭代的 (name, FileEntry), 在工作线程中调用, 默认 list_entries;
+                     多个节点协作扫描时, 由其他节点列出的目录可以只返回子目录; 抛出 DirBusy 时稍后重试
+    :param busy_retry: DirBusy 的目录重试的最长间隔 (秒), 从 0.02 秒开始每次加倍
+    """
+
+    def __init__(self, client: Client,
+                 on_file: Callable[[str, FileEntry], None] = None,
+                 on_dir_done: Callable[[str, Optional[FileEntry]], None] = None,
+                 skip_dir: Callable[[str, Optional[FileEntry]], bool] = None,
+                 workers=8, batch_size=200, progress_interval=10.0,
+                 on_progress: Callable[[dict], None] = None, fields=LIST_FIELDS,
+                 list_dir: Callable[[str], Iterable[Tuple[str, FileEntry]]] = None,
+                 on_files: Callable[[List[Tuple[str, FileEntry]]], None] = None, busy_retry=1.0):
+        self.client = client
+        self.on_files = on_files or (lambda files: [on_file(path, entry) for path, entry in files])
+        self.on_dir_done = on_dir_done or (lambda path, entry: None)
+        self.skip_dir = skip_dir or (lambda path, entry: False)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.on_progress = on_progress
+        self.fields = tuple(fields)
+        self.list_dir = list_dir or (lambda path: list_entries(self.client, path, self.fields))
+        self.busy_retry = busy_retry
+
+        self.stats = dict(dirs=0, files=0, skipped_dirs=0)
+
+        self._results = queue.Queue()
+        self._pending = dict()  # path -> 未完成的任务数 (自身的列表 + 未完成的子目录)
+        self._parent = dict()
+        self._entry = dict()
+        self._deferred = []  # DirBusy 的目录 (重试时间, path), 堆
+        self._busy = dict()  # path -> 下次重试的间隔
+
+    def _list_dir(self, path):
+        """在工作线程中执行"""
+        try:
+            batch = []
+            for name, entry in self.list_dir(path):
+                batch.append((name, entry))
+                if len(batch) >= self.batch_size:
+                    self._results.put((_ENTRIES, path, batch))
+                    batch = []
+            if batch:
+                self._results.put((_ENTRIES, path, batch))
+            self._results.put((_LISTED, path, None))
+        except DirBusy:
+            self._results.put((_BUSY, path, None))
+        except Exception as _e:
+            self._results.put((_ERROR, path, _e))
+
+    def _submit(self, executor, path, parent=None, entry=None) -> bool:
+        if path in self._pending:  # 列表中出现重复的条目
+            return False
+        if self.skip_dir(path, entry):
+            logger.info('目录 %s 已经缓存完成，跳过 ... ', path)
+            self.stats['skipped_dirs'] += 1
+            return False
+        self._pending[path] = 1
+        self._parent[path] = parent
+        self._entry[path] = entry
+        if parent is not None:
+            self._pending[parent] += 1
+        executor.submit(self._list_dir, path)
+        return True
+
+    def _finish(self, path):
+        """path 的一个任务完成，如果 path 已经全部完成，逐级向上通知父目录"""
+        while path is not None:
+            self._pending[path] -= 1
+            if self._pending[path]:
+                return
+            del self._pending[path]
+            self.stats['dirs'] += 1
+            self.on_dir_done(path, self._entry.pop(path))
+            path = self._parent.pop(path)
+
+    def _progress(self, start, last):
+        """输出进度, 返回本次的 (时间, dirs, files)"""
+        now = time.monotonic()
+        dirs, files = self.stats['dirs'], self.stats['files']
+        dirs_rate, files_rate = (dirs - last[1]) / (now - last[0]), (files - last[2]) / (now - last[0])
+        logger.info('扫描进度: %d 个目录, %d 个文件, 排队中 %d 个目录, %.1f 目录/秒, %.1f 文件/秒, 已用 %.0f 秒',
+                    dirs, files, len(self._pending), dirs_rate, files_rate, now - start)
+        if METRICS.enabled:
+            METRICS.set('scan_dirs_per_second', dirs_rate)
+            METRICS.set('scan_files_per_second', files_rate)
+            METRICS.set('scan_pending_dirs', len(self._pending))
+        if self.on_progress is not None:
+            self.on_progress(dict(self.stats, pending=len(self._pending), dirs_per_sec=round(dirs_rate, 1),
+                                  files_per_sec=round(files_rate, 1), elapsed=round(now - start, 1)))
+        return now, dirs, files
+
+    def scan(self, *roots):
+        """同时扫描全部的根目录，阻塞直到扫描完成"""
+        start = time.monotonic()
+        last = (start, self.stats['dirs'], self.stats['files'])
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scanner') as executor:
+            for root in roots:
+                self._submit(executor, root)
+
+            while self._pending:
+                if time.monotonic() - last[0] >= self.progress_interval:
+                    last = self._progress(start, last)
+                while self._deferred and self._deferred[0][0] <= time.monotonic():
+                    executor.submit(self._list_dir, heapq.heappop(self._deferred)[1])
+                try:
+                    kind, path, payload = self._results.get(
+                        timeout=max(self._deferred[0][0] - time.monotonic(), 0) if self._deferred else None)
+                except queue.Empty:
+                    continue
+                if kind == _ERROR:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    logger.error('扫描目录 %s 失败: %s', path, payload)
+                    raise payload
+                if kind == _BUSY:
+                    delay = self._busy[path] = min(self._busy.get(path, 0.01) * 2, self.busy_retry)
+                    heapq.heappush(self._deferred, (time.monotonic() + delay, path))
+                    continue
+                if kind == _LISTED:
+                    self._busy.pop(path, None)
+                    self._finish(path)
+                    if METRICS.enabled:
+                        METRICS.inc('scan_dirs_total')
+                    continue
+                if METRICS.enabled:
+                    METRICS.inc('scan_entries_total', len(payload))
+                files = []
+                for name, entry in payload:
+                    sub_path = Path(path).joinpath(name).as_posix()
+                    if entry.is_dir:
+                        self._submit(executor, sub_path, parent=path, entry=entry)
+                    else:
+                        files.append((sub_path, entry))
+                if files:
+                    self.stats['files'] += len(files)
+                    self.on_files(files)
+        logger.info('扫描完成 %s, %s', roots, self.stats)
+        return self.stats
@@ -0,0 +1,330 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : snapshot.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/17 20:40
+
+列式快照文件, 供 SnapshotOperator (cache_uri: snap:///path/cache.snap) 使用。
+
+JSON 快照启动时需要完整解析, 百万级记录时很慢并且解析期间内存翻倍。
+列式快照用 mmap 打开, 只读取头部, 查找时在排好序的路径表中二分查找, 只解码命中的一条记录。
+
+文件布局 (小端):
+    b'ALSNAP01' | u64 头部长度 | 头部 JSON | 各列 (按 8 字节对齐)
+
+    头部: {"n": 记录数, "items": {item_dir: [起始行, 行数]}, "columns": {名称: [偏移, 字节数]}},
+          偏移相对于头部之后按 8 字节对齐的位置
+    每个 item 的行按 sub_path 的 UTF-8 字节排序:
+        path_offsets  u64[n + 1]   paths 中每个 sub_path 的起止位置
+        paths         bytes
+        modified      i64[n]
+        size          i64[n]
+        flags         u8[n]        见 _IS_DIR 等
+        extra_offsets u64[n + 1]   extras 中每条记录的附加数据: FileEntry 的 hash, 或者其他值的 JSON
+        extras        bytes
+
+转换:
+    python snapshot.py to-snap /path/cache.json /path/cache.snap
+    python snapshot.py to-json /path/cache.snap /path/cache.json
+"""
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+logger = logging.getLogger('alist.sync.snapshot')
+
+MAGIC = b'ALSNAP01'
+_COLUMNS = ('path_offsets', 'paths', 'modified', 'size', 'flags', 'extra_offsets', 'extras')
+
+_IS_DIR, _NO_MODIFIED, _NO_SIZE, _HAS_HASH, _JSON = 1, 2, 4, 8, 16
+
+
+def _data_start(header_len) -> int:
+    """列数据的起始位置, 8 字节对齐; 头部中各列的偏移相对于这里"""
+    return (16 + header_len + 7) // 8 * 8
+
+
+def _is_entry(value) -> bool:
+    """FileEntry 或者同样结构的 list / tuple: [modified, size, is_dir(, hash)]"""
+    return isinstance(value, (tuple, list)) and len(value) in (3, 4) \
+        and (value[0] is None or type(value[0]) is int) and (value[1] is None or type(value[1]) is int) \
+        and type(value[2]) is bool and (len(value) == 3 or value[3] is None or type(value[3]) is str)
+
+
+def sorted_subs(subs: Iterable[str]) -> list:
+    """快照中的顺序: sub_path 的 UTF-8 字节序"""
+    return sorted(subs, key=str.encode)
+
+
+class _SpilledColumn:
+    """写入快照时的一列: 缓冲满 1 MiB 后写入临时文件, 内存中不保留整列"""
+    flush_bytes = 1 << 20
+
+    def __init__(self, directory, code=None):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.code = code
+        self.nbytes = 0
+        self._buf = array(code) if code else bytearray()
+        self._itemsize = self._buf.itemsize if code else 1
+
+    def append(self, value):
+        self._buf.append(value)
+        if len(self._buf) * self._itemsize >= self.flush_bytes:
+            self.flush()
+
+    def extend(self, data: bytes):
+        self._buf += data
+        if len(self._buf) >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        buf = self._buf
+        if self.code and sys.byteorder != 'little':
+            buf = array(self.code, buf)
+            buf.byteswap()
+        self.file.write(buf)
+        self.nbytes += len(self._buf) * self._itemsize
+        self._buf = array(self.code) if self.code else bytearray()
+
+    def copy_to(self, f):
+        self.flush()
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, f, self.flush_bytes)
+
+    def close(self):
+        self.file.close()
+
+
+def write_snapshot(path, records: Iterable[Tuple[str, str, object]]):
+    """写入快照 (临时文件 + rename)
+
+    records 需要已经排好序: 同一个 item_dir 的记录连续, 其中按 sub_path 的 UTF-8 字节序递增 (见 sorted_subs)。
+    每列先写入快照所在目录的临时文件, 最后拼接, 内存中只有 items 表和每列 1 MiB 的缓冲。
+
+    :param records: (item_dir, sub_path, value)
+    :return: 记录数
+    """
+    path = Path(path)
+    columns = {name: _SpilledColumn(path.parent, code)
+               for name, code in zip(_COLUMNS, ('Q', None, 'q', 'q', None, 'Q', None))}
+    try:
+        path_offsets, paths, modified, size, flags, extra_offsets, extras = columns.values()
+        path_offsets.append(0)
+        extra_offsets.append(0)
+        items, n, current, last, paths_len, extras_len = dict(), 0, None, None, 0, 0
+        for n, (item, sub, value) in enumerate(records, 1):
+            sub = sub.encode()
+            if item != current:
+                if item in items:
+                    raise ValueError(f'item {item} 的记录不连续')
+                items[item], current = (n - 1, 0), item
+            elif sub <= last:
+                raise ValueError(f'{item} 中的记录没有按 sub_path 排序: {sub!r}')
+            last = sub
+            start, count = items[item]
+            items[item] = (start, count + 1)
+            paths.extend(sub)
+            paths_len += len(sub)
+            path_offsets.append(paths_len)
+            if _is_entry(value):
+                f = (_IS_DIR if value[2] else 0) | (_NO_MODIFIED if value[0] is None else 0) \
+                    | (_NO_SIZE if value[1] is None else 0)
+                modified.append(value[0] or 0)
+                size.append(value[1] or 0)
+                extra = b''
+                if len(value) == 4 and value[3] is not None:
+                    f |= _HAS_HASH
+                    extra = value[3].encode()
+            else:
+                f = _JSON
+                modified.append(0)
+                size.append(0)
+                extra = json.dumps(value, ensure_ascii=False).encode()
+            flags.append(f)
+            extras.extend(extra)
+            extras_len += len(extra)
+            extra_offsets.append(extras_len)
+
+        for column in columns.values():
+            column.flush()
+        layout, offset = dict(), 0
+        for name, column in columns.items():
+            offset += -offset % 8
+            layout[name] = [offset, column.nbytes]
+            offset += column.nbytes
+        raw_header = json.dumps(dict(n=n, items=items, columns=layout), ensure_ascii=False).encode()
+        base = _data_start(len(raw_header))
+
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(MAGIC + struct.pack('<Q', len(raw_header)) + raw_header)
+                for name, column in columns.items():
+                    f.write(b'\0' * (base + layout[name][0] - f.tell()))
+                    column.copy_to(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+    finally:
+        for column in columns.values():
+            column.close()
+    return n
+
+
+class Snapshot:
+    """只读的快照, mmap 打开; 读出的值是 list (FileEntry 的字段) 或 JSON 解析后的值"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:8] != MAGIC:
+            self._mm.close()
+            raise ValueError(f'不是快照文件: {path}')
+        header_len, = struct.unpack_from('<Q', self._mm, 8)
+        header = json.loads(self._mm[16:16 + header_len])
+        self.n = header['n']
+        self.items = {k: tuple(v) for k, v in header['items'].items()}
+
+        view, base = memoryview(self._mm), _data_start(header_len)
+        col = {name: view[base + o:base + o + nbytes] for name, (o, nbytes) in header['columns'].items()}
+        if sys.byteorder != 'little':  # 大端机器上复制一份并转换字节序
+            col.update({name: memoryview(_swapped(col[name], code))
+                        for name, code in (('path_offsets', 'Q'), ('modified', 'q'), ('size', 'q'),
+                                           ('extra_offsets', 'Q'))})
+        self._path_offsets = col['path_offsets'].cast('Q')
+        self._paths = col['paths']
+        self._modified = col['modified'].cast('q')
+        self._size = col['size'].cast('q')
+        self._flags = col['flags']
+        self._extra_offsets = col['extra_offsets'].cast('Q')
+        self._extras = col['extras']
+
+    def __len__(self):
+        return self.n
+
+    def close(self):
+        for name in ('_path_offsets', '_paths', '_modified', '_size', '_flags', '_extra_offsets', '_extras'):
+            getattr(self, name).release()
+        self._mm.close()
+
+    def _sub_path(self, i) -> bytes:
+        return bytes(self._paths[self._path_offsets[i]:self._path_offsets[i + 1]])
+
+    def value(self, i):
+        f = self._flags[i]
+        extra = self._extras[self._extra_offsets[i]:self._extra_offsets[i + 1]]
+        if f & _JSON:
+            return json.loads(bytes(extra))
+        return [None if f & _NO_MODIFIED else self._modified[i], None if f & _NO_SIZE else self._size[i],
+                bool(f & _IS_DIR), bytes(extra).decode() if f & _HAS_HASH else None]
+
+    def find(self, item_dir, sub_path: str) -> Optional[int]:
+        """二分查找, 返回行号"""
+        start, count = self.items.get(item_dir, (0, 0))
+        key = sub_path.encode()
+        lo, hi = start, start + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._sub_path(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < start + count and self._sub_path(lo) == key else None
+
+    def get(self, item_dir, sub_path, load: Callable = None, default=None):
+        i = self.find(item_dir, sub_path)
+        if i is None:
+            return default
+        return self.value(i) if load is None else load(self.value(i))
+
+    def iter_item(self, item_dir, load: Callable = None) -> Iterator[Tuple[str, object]]:
+        start, count = self.items.get(item_dir, (0, 0))
+        for i in range(start, start + count):
+            value = self.value(i)
+            yield self._sub_path(i).decode(), value if load is None else load(value)
+
+
+def _swapped(view, code) -> array:
+    a = array(code, view)
+    a.byteswap()
+    return a
+
+
+def _raw_operator(cache_uri):
+    """不转换值, 不验证值的 Operator, 用于转换格式"""
+    from back_operator import Operator
+
+    class RawRecord(Operator):
+        def verify_item_value(self, item_value) -> bool:
+            return True
+
+    return RawRecord(cache_uri)
+
+
+def json_to_snapshot(json_path, snap_path) -> int:
+    """JSON 缓存 (包括未压缩的 .journal) 转换为快照, 返回记录数"""
+    op = _raw_operator(f'json://{Path(json_path).absolute().as_posix()}')
+    with op._lock:
+        count = write_snapshot(snap_path, ((item, sub, values[sub]) for item, values in op.data.items()
+                                           for sub in sorted_subs(values)))
+    logger.info('%s -> %s, %d 条记录', json_path, snap_path, count)
+    return count
+
+
+def snapshot_to_json(snap_path, json_path) -> int:
+    """快照 (包括未压缩的 .journal) 转换为 JSON 缓存, 返回记录数"""
+    from tools import atomic_write_text
+
+    op = _raw_operator(f'snap://{Path(snap_path).absolute().as_posix()}')
+    data = {item: dict(op.iter_item(item)) for item in op.stored_items()}
+    atomic_write_text(json_path, json.dumps(data, ensure_ascii=False))
+    Path(str(json_path) + '.journal').unlink(missing_ok=True)
+    count = sum(len(v) for v in data.values())
+    logger.info('%s -> %s, %d 条记录', snap_path, json_path, count)
+    return count
+
+
+def bench_startup(n=1000000, tmp_dir=None):
+    """对比 JSON 与快照的启动时间和一次查找"""
+    import time
+    from file_record import FileEntry, FileRecord
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        values = {f'dir_{i // 1000}/file_{i}.txt': FileEntry(1667000000 + i, i) for i in range(n)}
+        Path(tmp, 'c.json').write_text(json.dumps({'/item': values}), encoding='utf8')
+        json_to_snapshot(f'{tmp}/c.json', f'{tmp}/c.snap')
+        for scheme, name in (('json', 'c.json'), ('snap', 'c.snap')):
+            start = time.perf_counter()
+            op = FileRecord(f'{scheme}://{tmp}/{name}')
+            op.set_item_dirs(['/item'])
+            loaded = time.perf_counter() - start
+            assert op.search_path(f'/item/dir_{n // 2000}/file_{n // 2}.txt') == values[
+                f'dir_{n // 2000}/file_{n // 2}.txt']
+            print(f'{scheme}: {n} records, start {loaded * 1000:.1f} ms, '
+                  f'file {Path(tmp, name).stat().st_size / 1048576:.1f} MiB')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:2] == ['to-snap'] and len(sys.argv) == 4:
+        json_to_snapshot(sys.argv[2], sys.argv[3])
+    elif sys.argv[1:2] == ['to-json'] and len(sys.argv) == 4:
+        snapshot_to_json(sys.argv[2], sys.argv[3])
+    elif sys.argv[1:2] == ['bench']:
+        bench_startup(int(sys.argv[2]) if sys.argv[2:] else 1000000)
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : supervisor.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/13 16:40
+
+在进程池中运行全部的 sync_group。
+
+每个 group 的扫描是一个任务; cache_uri 是 sqlite / redis 时 (多个进程可以同时写入), 每个 item 单独作为一个扫描任务。
+group 的扫描任务全部完成后, 再提交它的同步任务 (计算复制计划并复制)。
+任务在工作进程中创建自己的 Sync (Client, Operator); 同一个 Alist 服务器的并发请求数由进程间共享的信号量限制。
+
+    python supervisor.py config.json --processes 8 --server-concurrency 32
+
+config.json:
+    {
+      "sync_group": [{...}, {...}],
+      "server_concurrency": {"alist.example.com": 32}   # 可选, 按 Host 覆盖 --server-concurrency
+    }
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from typing import Dict, List
+
+logger = logging.getLogger('alist.supervisor')
+
+_SHARED = dict()  # 工作进程中的 limits 和 progress 队列
+
+
+def _init_worker(limits, progress, log_level):
+    logging.basicConfig(level=log_level, format='[%(asctime)s] %(processName)s %(levelname)s %(name)s - %(message)s')
+    _SHARED.update(limits=limits, progress=progress)
+
+
+def _report(name, phase, data):
+    try:
+        _SHARED['progress'].put_nowait((name, phase, data))
+    except (KeyError, queue.Full):
+        pass
+
+
+def _run_unit(group: dict, phase: str, roots: List[str]) -> dict:
+    """在工作进程中执行一个任务"""
+    from sync import Sync
+
+    group = dict(group)
+    group.pop('metrics', None)  # 多个进程不能写同一个指标文件
+    name = group.get('name')
+    start = time.monotonic()
+    sync = Sync(group, limits=_SHARED.get('limits'))
+    sync.on_progress = lambda p: _report(name, phase, dict(p, roots=roots))
+    _report(name, phase, dict(roots=roots, state='running'))
+    if phase == 'scan':
+        stats = sync.scan_file_in_item(roots[0]) if len(roots) == 1 else sync.scan_update_file()
+    else:
+        stats = sync.sync_files()
+    return dict(stats or dict(), roots=roots, seconds=round(time.monotonic() - start, 1), pid=os.getpid())
+
+
+def _scan_units(group: dict) -> List[List[str]]:
+    """group 的扫描任务, 每个任务是一组根目录"""
+    items = list(group.get('items') or [])
+    scheme = urllib.parse.urlparse(group.get('cache_path', '')).scheme.lower()
+    if scheme in ('sqlite', 'redis') and len(items) > 1:
+        return [[item] for item in items]
+    return [items]
+
+
+class Supervisor:
+    """运行多个 sync_group
+
+    :param groups: sync_group 配置列表
+    :param processes: 进程数, 默认 CPU 数
+    :param server_concurrency: 每个 Alist 服务器 (Host) 同时进行的请求数上限, 所有进程共用
+    :param server_limits: Host -> 上限, 覆盖 server_concurrency
+    :param scan_only: 只扫描, 不复制
+    """
+
+    def __init__(self, groups: List[dict], processes=None, server_concurrency=16,
+                 server_limits: Dict[str, int] = None, scan_only=False):
+        names = [g.get('name') for g in groups]
+        if None in names or len(set(names)) != len(names):
+            raise ValueError('每个 sync_group 都需要唯一的 name')
+        self.groups = {g['name']: g for g in groups}
+        self.processes = processes or os.cpu_count()
+        self.server_concurrency = server_concurrency
+        self.server_limits = dict(server_limits or dict())
+        self.scan_only = scan_only
+
+        self.progress = {name: dict() for name in self.groups}  # name -> 最近一次的进度
+        self.results = {name: dict(scan=[], sync=None, errors=[]) for name in self.groups}
+
+    def _hosts(self) -> Dict[str, int]:
+        hosts = {urllib.parse.urlsplit(g['alist_prefix']).netloc for g in self.groups.values()}
+        return {h: self.server_limits.get(h, self.server_concurrency) for h in hosts}
+
+    def _watch(self, progress):
+        while True:
+            event = progress.get()
+            if event is None:
+                return
+            name, phase, data = event
+            self.progress[name] = dict(data, phase=phase)
+            if 'files' in data:
+                logger.info('[%s] %s %s: %d 目录, %d 文件, %.1f 文件/秒', name, phase, data.get('roots'),
+                            data['dirs'], data['files'], data.get('files_per_sec', 0))
+
+    def run(self) -> dict:
+        ctx = get_context('spawn')
+        limits = {host: ctx.BoundedSemaphore(n) for host, n in self._hosts().items()}
+        progress = ctx.Queue(10000)
+        watcher = threading.Thread(target=self._watch, args=(progress,), name='supervisor_progress', daemon=True)
+        watcher.start()
+        start = time.monotonic()
+
+        with ProcessPoolExecutor(max_workers=self.processes, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(limits, progress, logging.getLogger('alist').getEffectiveLevel())) as ex:
+            futures, remaining = dict(), dict()
+            for name, group in self.groups.items():
+                units = _scan_units(group)
+                remaining[name] = len(units)
+                for roots in units:
+                    futures[ex.submit(_run_unit, group, 'scan', roots)] = (name, 'scan')
+            logger.info('%d 个 group, %d 个扫描任务, %d 个进程, 并发预算 %s',
+                        len(self.groups), len(futures), self.processes, self._hosts())
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, phase = futures.pop(future)
+                    result = self.results[name]
+                    try:
+                        stats = future.result()
+                    except Exception as _e:
+                        logger.error('[%s] %s 失败: %r', name, phase, _e)
+                        result['errors'].append(dict(phase=phase, error=repr(_e)))
+                        stats = None
+                    if phase == 'sync':
+                        result['sync'] = stats
+                        continue
+                    if stats is not None:
+                        result['scan'].append(stats)
+                    remaining[name] -= 1
+                    if remaining[name] == 0 and not self.scan_only and not result['errors']:
+                        futures[ex.submit(_run_unit, self.groups[name], 'sync', [])] = (name, 'sync')
+
+        progress.put(None)
+        watcher.join()
+        failed = [name for name, r in self.results.items() if r['errors']]
+        logger.info('全部完成, %.1f 秒, %d 个 group 失败 %s', time.monotonic() - start, len(failed), failed)
+        return self.results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='在进程池中运行全部的 sync_group')
+    parser.add_argument('config', nargs='?', default='config.json')
+    parser.add_argument('--processes', type=int, default=None, help='进程数, 默认 CPU 数')
+    parser.add_argument('--server-concurrency', type=int, default=16, help='每个 Alist 服务器的并发请求数')
+    parser.add_argument('--groups', help='只运行这些 group, 逗号分隔')
+    parser.add_argument('--scan-only', action='store_true')
+    parser.add_argument('--output', help='结果写入 JSON 文件')
+    args = parser.parse_args(argv)
+
+    conf = json.loads(open(args.config, encoding='utf8').read())
+    groups = conf['sync_group']
+    if args.groups:
+        wanted = set(args.groups.split(','))
+        groups = [g for g in groups if g.get('name') in wanted]
+    results = Supervisor(groups, processes=args.processes, server_concurrency=args.server_concurrency,
+                         server_limits=conf.get('server_concurrency'), scan_only=args.scan_only).run()
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2, default=str)
+    return 1 if any(r['errors'] for r in results.values()) else 0
+
+
+if __name__ == '__main__':
+    import sys
+
+    if os.path.exists('logger_config.yml'):
+        import logging.config, yaml
+
+        logging.config.dictConfig(yaml.safe_load(open('logger_config.yml').read()))
+    else:
+        logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
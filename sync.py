@@ -7,10 +7,18 @@
 """
 import json
 import logging
+import time
 from pathlib import PurePosixPath as Path
-from file_record import FileRecord
-from alist_client import Client as AlistClient
-from tools import time_2_timestamp
+from content_verify import ContentVerifier
+from dir_index import DirIndex
+from file_record import HASH_FIELDS, FileEntry, FileRecord
+from scanner import LIST_FIELDS, DirBusy, Scanner, list_entries
+from sync_plan import CopyBatch, CopyPlan, SyncPlanner, group_copies, run_copy_batches
+from task_tracker import DONE, CopyTaskTracker
+from alist_client import Client as AlistClient, transport_policy
+from meta_cache import CachedClient, MetaCache
+from metrics import METRICS, PrometheusFileSink
+from relay import RELAY, SERVER, CopyRouter, RelayCopier
 from updating_cache import UpdatingCache
 
 
@@ -27,22 +35,71 @@ class Sync:
         "/onedrive/tmp/",
         "/local/tmp/"
       ],
-      "cache_uri": "json:///tmp/alist_sync_t1.json"
+      "cache_uri": "json:///tmp/alist_sync_t1.json",  # 或 snap:///tmp/alist_sync_t1.snap, 记录很多时启动更快
+      "scan_workers": 8,
+      "scan_mode": "full",          # full | incremental: 只进入指纹 (父目录列表中的 modified, size) 变化的目录;
+                                    #   修改深层文件时不更新上级目录 modified 且目录 size 为 0 的存储, 深层的变化
+                                    #   发现不了, 需要定期 full 扫描, 见 dir_index.py
+      "copy_workers": 4,
+      "copy_batch_size": 100,
+      "copy_max_outstanding": 200,
+      "copy_max_retries": 3,
+      "copy_mode": "server",        # server: Alist 的复制任务 | relay: 客户端中转 | auto: 按测得的吞吐量选择
+      "relay": {"segment_size": 16777216, "segments": 4, "bandwidth": null, "workers": 4},  # 可选, 见 RelayCopier
+      "verify": "hash",             # 可选, 复制前比较 size (size) 或 size 与 hash_info (hash), 内容相同的不复制
+      "meta_cache": {"ttl": 60, "max_entries": 10000},  # 可选, 缓存 fs_get / fs_list 的结果
+      "transport": {"rate": 20, "max_retries": 3},      # 可选, 限速 / 重试 / 熔断, 见 TransportPolicy
+      "metrics": {"prometheus": "/var/lib/node_exporter/alist_sync.prom", "interval": 15}  # 可选
+      "watch": {"min_interval": 10, "max_interval": 600, "list_rate": 5}  # 可选, watch.py 常驻运行时使用, 见 Watcher
     }
 
     """
     logger = logging.getLogger('alist.sync.Sync')
 
-    def __init__(self, config: dict):
-
+    def __init__(self, config: dict, limits: dict = None):
+        """
+        :param limits: Host -> 信号量, 多个 Sync (可能在不同进程中) 共用的并发预算, 见 TransportPolicy
+        """
+        self.name = config.get('name')
         self.items = config.get('items')
+        self.on_progress = None  # 回调 (dict), 扫描进度
+        if config.get('metrics') is not None:
+            prom = config['metrics'].get('prometheus')
+            # 多个同步组共用 METRICS, 同一个文件只注册一次; 没有 prometheus 时只在进程内记录 (METRICS.snapshot())
+            METRICS.enable(*([PrometheusFileSink(prom)] if prom else []),
+                           interval=config['metrics'].get('interval', 15))
+        self.scan_workers = config.get('scan_workers', 8)
+        self.incremental = config.get('scan_mode', 'full') == 'incremental'
+        self.copy_workers = config.get('copy_workers', 4)
+        self.copy_batch_size = config.get('copy_batch_size', 100)
+        self.verify = config.get('verify')
+        self.verify_stats = None
+        self.list_fields = LIST_FIELDS + HASH_FIELDS if self.verify == 'hash' else LIST_FIELDS
+        self.lease_poll = 1.0  # 其他节点正在列出的目录, 重试的最长间隔
 
         self.files_record = FileRecord(config['cache_path'])
         self.update_cache = UpdatingCache(config['cache_path'])
-        self.alist_client = AlistClient(config['alist_prefix'])
+        self.dir_index = DirIndex(config['cache_path'])
+        policy = transport_policy(**config.get('transport', dict()), limits=limits)
+        if config.get('meta_cache') is not None:
+            self.alist_client = CachedClient(config['alist_prefix'], cache=MetaCache(**config['meta_cache']),
+                                             policy=policy)
+        else:
+            self.alist_client = AlistClient(config['alist_prefix'], policy=policy)
+
+        self.copy_tracker = CopyTaskTracker(self.alist_client,
+                                            max_outstanding=config.get('copy_max_outstanding', 200),
+                                            max_retries=config.get('copy_max_retries', 3),
+                                            on_finish=self._server_copy_done)
+        self.router = CopyRouter(config.get('copy_mode', SERVER))
+        relay = dict(config.get('relay') or dict())
+        self.relay_workers = relay.pop('workers', 4)
+        self.relay = RelayCopier(self.alist_client, **relay) if self.router.mode != SERVER else None
+        self._server_sizes = dict()  # (src_path, dst_dir) -> size, 计算服务器端复制的吞吐量
 
         self.update_cache.set_item_dirs(self.items)
         self.files_record.set_item_dirs(self.items)
+        self.dir_index.set_item_dirs(self.items)
 
         if config.get('alist_token'):
             self.alist_client.set_token(config.get('alist_token'))
@@ -52,31 +109,102 @@ class Sync:
             raise
 
     def scan_update_file(self):
-        """扫描更新的文件"""
-        for item in self.items:
-            self.scan_file_in_item(item)
+        """扫描更新的文件, 全部 items 同时扫描"""
+        return self._scan(*self.items)
 
     def scan_file_in_item(self, in_dir):
         """扫描更新文件"""
         self.logger.info('Scan Dir %s', in_dir)
-        if self.update_cache.search_path(in_dir):  # 已经缓存的跳过
-            logger.info('目录 %s 已经缓存完成，跳过 ... ', in_dir)
+        return self._scan(in_dir)
+
+    def _scan(self, *roots):
+        """UpdatingCache 记录本次扫描已经完成的目录, 就是扫描的游标:
+        中断后再次扫描时跳过这些目录, 从中断的位置继续; 扫描完成后清空。
+        多个节点共享 Redis 后端时, 只有最后一个结束扫描的节点清空游标。
+        """
+        for item in self.items:
+            if next(iter(self.update_cache.iter_item(item)), None) is not None:
+                self.logger.info('%s 上次扫描没有完成, 继续扫描', item)
+        for root in roots:
+            self.update_cache.enter_scan(root)
+        try:
+            stats = self._scanner().scan(*roots)
+        except BaseException:
+            for root in roots:
+                self.update_cache.leave_scan(root)
+            raise
+        for root in roots:
+            if self.update_cache.leave_scan(root) and root in self.items:
+                self.update_cache.drop_item(root)
+        self.update_cache.dumps_data()
+        self.dir_index.dumps_data()
+        self.files_record.dumps_data()
+        return stats
+
+    def _scanner(self) -> Scanner:
+        return Scanner(self.alist_client,
+                       on_files=self._record_files,
+                       on_dir_done=self._dir_done,
+                       skip_dir=self._skip_dir,
+                       workers=self.scan_workers,
+                       on_progress=self.on_progress,
+                       fields=self.list_fields,
+                       list_dir=self._list_dir,
+                       busy_retry=self.lease_poll)
+
+    def _list_dir(self, path):
+        """列出一个目录, 在扫描的工作线程中执行
+
+        获得租约时列出目录并发布其中的子目录; 其他节点已经列出时, 只返回它发布的子目录继续向下扫描
+        (文件由列出的节点记录); 其他节点正在列出时抛出 DirBusy, Scanner 先列出其他目录, 稍后重试。
+        """
+        cache = self.update_cache
+        if not cache.acquire_lease(path):
+            shared = cache.shared_listing(path)
+            if shared is None:
+                raise DirBusy(path)
+            self.logger.debug('目录 %s 已经由其他节点列出', path)
+            yield from ((name, FileEntry.from_value(value)) for name, value in shared)
             return
 
-        for file_dic in self.alist_client.fs_list_iter(in_dir):
-            name = file_dic.get('name')
-            path = Path(in_dir).joinpath(file_dic.get('name')).as_posix()
-            self.logger.debug('%s is dir -- %s', path, file_dic.get('is_dir'))
-            if file_dic.get('is_dir'):
-                self.scan_file_in_item(path)
-            else:
+        dirs, renew_at = [], time.monotonic() + cache.lease_ttl / 3
+        try:
+            for name, entry in list_entries(self.alist_client, path, self.list_fields):
+                if entry.is_dir:
+                    dirs.append((name, entry))
+                if time.monotonic() > renew_at:
+                    cache.renew_lease(path)
+                    renew_at = time.monotonic() + cache.lease_ttl / 3
+                yield name, entry
+        except BaseException:
+            cache.release_lease(path)
+            raise
+        cache.release_lease(path, dirs)
+
+    def _skip_dir(self, path, entry: FileEntry = None) -> bool:
+        """本次扫描已经完成的跳过; 增量扫描时指纹没有变化的跳过"""
+        if self.update_cache.search_path(path):
+            return True
+        if self.incremental and self.dir_index.unchanged(path, entry):
+            self.logger.debug('目录 %s 没有变化, 跳过', path)
+            return True
+        return False
+
+    def _dir_done(self, path, entry: FileEntry = None):
+        self.update_cache.update_path(path, 'success')
+        if entry is not None:
+            self.dir_index.update_path(path, entry)
+
+    def _record_files(self, files):
+        """记录扫描到的一批文件 [(path, FileEntry), ...]"""
+        entries = []
+        for path, entry in files:
+            if entry.hash is None:  # 列表中没有 hash 时, 保留之前 fs_get 查询到的
                 old_p = self.files_record.select_path(path)
-                op_time = old_p.get('update_time', 0) if old_p else 0
-                if op_time == 0:
-                    self.files_record.update_path(path, file_dic)
-                self.update_cache.update_path(path, time_2_timestamp(file_dic.get('modified')) - op_time)
-        self.update_cache.update_path(in_dir, 'success')
-        # TODO 优化中断恢复方案
+                if isinstance(old_p, FileEntry) and old_p.hash and old_p[:2] == entry[:2]:
+                    entry = entry._replace(hash=old_p.hash)
+            entries.append((path, entry))
+        self.files_record.update_many(entries)
 
     @staticmethod
     def get_dict_max_key(dic: dict):
@@ -91,44 +219,93 @@ class Sync:
 
         :return Noting, Doing, Down
         """
+        return self.copy_tracker.state(path)
 
     def copy_file(self, sor, target, file):
-        """拷贝文件
-
-        1. 验证目标文件是否存在  是 -> 2,   否 -> 3
-        2. 移动目标到 /@alist_sync_older_file
-                     产生2个文件： 1. 源文件(name_id)  2. name_id.json
-             2.1 复制文件到 /@alist_sync_old_file/
-             2.2 生成源文件信息 到 /@alist_sync_old_file/.json
-             2.3 验证上述文件存在   -->  删除源文件
-        3. 开始 fs_copy()   -- fs_copy 实际是在alist 上生成一个task, 进行异步的复制
-        4. 调用 task/copy/undone 接口，检查是否已经添加 task
-        5. 将 目标path update_time  设置为 upping
+        """拷贝文件, 等待复制完成
+
+        1. 开始 fs_copy()   -- fs_copy 实际是在alist 上生成一个task, 进行异步的复制
+        2. CopyTaskTracker 轮询 task/copy/undone 与 task/copy/done, 跟踪 task 直到完成 (失败时重试)
+        3. 返回目标文件的状态
+
+        :return Noting (没有管理员权限, 不能跟踪), Down, Failed
         """
-        try:
-            old_s = self.alist_client.fs_get(Path(target).joinpath(file))
-            if old_s:
-                self.alist_client.fs_copy()
-                self.alist_client.create_file('md5.json')
+        with self.copy_tracker:
+            batch = CopyBatch(Path(sor).as_posix(), Path(target).as_posix(), (file,))
+            run_copy_batches(self.alist_client, [batch], tracker=self.copy_tracker)
+            self.copy_tracker.wait()
+        return self.verify_copying(Path(target).joinpath(file).as_posix())
 
-        except Exception:
-            """"""
+    def plan_sync(self) -> CopyPlan:
+        """根据 FileRecord 计算复制计划"""
+        planner = SyncPlanner(self.items)
+        for item in self.items:
+            planner.load(item, self.files_record.iter_item(item))
+        plan = planner.plan()
+        for path in plan.conflict_paths():
+            self.logger.warning('%s 在多个 item 中 modified 相同但 size 不同, 跳过', path)
+        if self.verify and len(plan):
+            verifier = ContentVerifier(self.alist_client, self.files_record, mode=self.verify,
+                                       workers=self.scan_workers)
+            plan = verifier.filter(plan)
+            self.files_record.dumps_data()
+            self.verify_stats = verifier.stats
+        return plan
 
-    def sync_files(self):
-        """update"""
-        for path, up_cache in self.update_cache.items():
-            update_item = self.get_dict_max_key(up_cache)
-            for item in self.items:
-                if item == update_item:
-                    continue
+    def _route(self, plan: CopyPlan):
+        """按 CopyRouter 分为服务器端复制 [(sub_path, src_item, dst_item, size)] 与
+        中转复制 [(src_path, dst_path, size, modified)]"""
+        server, relay = [], []
+        # 只有任务跟踪器会回调 _server_copy_done 取出大小, 否则不记录
+        track = self.router.mode == 'auto' and self.copy_tracker.enabled
+        for sub_path, src_item, dst_item, size in plan:
+            src, dst = Path(src_item, sub_path).as_posix(), Path(dst_item, sub_path).as_posix()
+            if self.router.choose(src, dst, size) == RELAY:
+                entry = self.files_record.select_path(src)
+                relay.append((src, dst, size, entry.modified if isinstance(entry, FileEntry) else None))
+            else:
+                server.append((sub_path, src_item, dst_item, size))
+                if track:
+                    self._server_sizes[(src, Path(dst).parent.as_posix())] = size
+        return server, relay
 
-                self.alist_client.fs_copy(Path(item).joinpath(path).parent, Path(item).joinpath(path).parent,
-                                          Path(path).name)
-                self.verify_copying()
+    def _server_copy_done(self, src_path, dst_dir, state, seconds):
+        size = self._server_sizes.pop((src_path, dst_dir), None)
+        if state == DONE:
+            self.router.record(src_path, dst_dir, SERVER, size, seconds)
+            self._copied(src_path, Path(dst_dir, Path(src_path).name).as_posix())
 
+    def _relay_done(self, src_path, dst_path, size, seconds, error):
+        if error is not None:
+            return
+        self.router.record(src_path, dst_path, RELAY, size, seconds)
+        self._copied(src_path, dst_path)
+
+    def _copied(self, src_path, dst_path):
+        """复制完成, 目标记录为源文件的记录, 下一次计划不会再复制; 下一次扫描时以目标的实际列表为准"""
+        entry = self.files_record.select_path(src_path)
+        if isinstance(entry, FileEntry):
+            self.files_record.update_path(dst_path, entry)
 
-def test_copy():
-    pass
+    def sync_files(self):
+        """update, 同一对目录中的文件合并为一个 fs_copy 请求; copy_mode 不是 server 时部分或全部文件中转复制"""
+        server, relay = self._route(self.plan_sync())
+        batches = group_copies(server, max_names=self.copy_batch_size)
+        with self.copy_tracker:
+            stats = run_copy_batches(self.alist_client, batches, workers=self.copy_workers,
+                                     tracker=self.copy_tracker)
+            if relay:
+                stats['relay'] = self.relay.copy_many(relay, workers=self.relay_workers, on_done=self._relay_done)
+                self.files_record.dumps_data()
+            stats['tasks'] = self.copy_tracker.wait()
+        if self.router.mode == 'auto':
+            stats['router'] = self.router.report()
+        if self.verify_stats is not None:
+            stats['verify'] = self.verify_stats
+        if isinstance(self.alist_client, CachedClient):
+            stats['meta_cache'] = self.alist_client.meta_cache.report()
+        self.logger.info('同步完成: %s', stats)
+        return stats
 
 
 if __name__ == '__main__':
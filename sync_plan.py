@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : sync_plan.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/06 14:30
+
+按列计算同步计划。
+
+每个 item 的 modified / size 载入按路径编号对齐的 array 列, 缺失的文件为 -1。
+最新的来源、需要复制的目标、大小冲突都通过 map(operator.*, 列, 列) 对整列计算,
+只有最终需要复制的文件才会回到 Python 循环。
+"""
+import logging
+import operator
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import compress, repeat
+from pathlib import PurePosixPath
+from typing import Iterable, List, NamedTuple, Tuple
+
+logger = logging.getLogger('alist.sync.plan')
+
+_MISSING = -1
+_BIG = 1 << 62
+
+
+class CopyPlan:
+    """复制计划, 每个操作是 (path 编号, 来源 item 编号, 目标 item 编号, 文件大小)"""
+
+    def __init__(self, items: List[str], paths: List[str]):
+        self.items = items
+        self.paths = paths
+        self.path_idx = array('q')
+        self.src = array('b')
+        self.dst = array('b')
+        self.size = array('q')
+        self.conflicts = array('q')  # modified 相同但 size 不同的路径编号, 不自动复制
+
+    def add(self, path_idx: Iterable[int], src: Iterable[int], dst: int, size: Iterable[int]):
+        n = len(self.path_idx)
+        self.path_idx.extend(path_idx)
+        self.src.extend(src)
+        self.size.extend(size)
+        self.dst.extend(repeat(dst, len(self.path_idx) - n))
+
+    def __len__(self):
+        return len(self.path_idx)
+
+    def __iter__(self):
+        """返回 (sub_path, src_item, dst_item, size)"""
+        items, paths = self.items, self.paths
+        for i, s, d, z in zip(self.path_idx, self.src, self.dst, self.size):
+            yield paths[i], items[s], items[d], z
+
+    def subset(self, ops: Iterable[int]) -> 'CopyPlan':
+        """只包含第 ops 个操作的新计划, 冲突保持不变"""
+        plan = CopyPlan(self.items, self.paths)
+        for n in ops:
+            plan.path_idx.append(self.path_idx[n])
+            plan.src.append(self.src[n])
+            plan.dst.append(self.dst[n])
+            plan.size.append(self.size[n])
+        plan.conflicts = self.conflicts
+        return plan
+
+    def conflict_paths(self) -> List[str]:
+        return [self.paths[i] for i in self.conflicts]
+
+
+class SyncPlanner:
+    """收集各个 item 的文件记录, 计算复制计划
+
+        planner = SyncPlanner(items)
+        for item in items:
+            planner.load(item, file_record.iter_item(item))
+        for sub_path, src, dst, size in planner.plan(): ...
+    """
+
+    def __init__(self, items: List[str]):
+        self.items = list(items)
+        self.index = dict()  # sub_path -> 编号
+        self.paths = []
+        self._rows = {item: (array('q'), array('q'), array('q')) for item in self.items}  # 编号, modified, size
+
+    def load(self, item_dir, records: Iterable[tuple]):
+        """载入 (sub_path, FileEntry) 记录, 目录会被忽略"""
+        index, paths = self.index, self.paths
+        idx, mod, size = self._rows[item_dir]
+        for sub_path, entry in records:
+            if entry.is_dir:
+                continue
+            i = index.get(sub_path)
+            if i is None:
+                i = index[sub_path] = len(paths)
+                paths.append(sub_path)
+            idx.append(i)
+            mod.append(entry.modified or 0)
+            size.append(entry.size or 0)
+
+    def _columns(self):
+        """按路径编号对齐的 modified, size 列"""
+        n = len(self.paths)
+        mods, sizes = [], []
+        for item in self.items:
+            idx, mod, size = self._rows[item]
+            m, s = array('q', repeat(_MISSING, n)), array('q', repeat(_MISSING, n))
+            for i, v, z in zip(idx, mod, size):
+                m[i] = v
+                s[i] = z
+            mods.append(m)
+            sizes.append(s)
+        return mods, sizes
+
+    def plan(self) -> CopyPlan:
+        n, k = len(self.paths), len(self.items)
+        plan = CopyPlan(self.items, self.paths)
+        if n == 0 or k < 2:
+            return plan
+        mods, sizes = self._columns()
+
+        # key = modified * k + (k - 1 - item 编号), 取 max 同时得到最新的 modified 和 (相同时靠前的) 来源
+        keys = [array('q', map(operator.add, map(operator.mul, mods[j], repeat(k)), repeat(k - 1 - j)))
+                for j in range(k)]
+        best = array('q', map(max, *keys))
+        newest = array('q', map(operator.floordiv, best, repeat(k)))
+        src = array('b', map(operator.sub, repeat(k - 1), map(operator.mod, best, repeat(k))))
+
+        # modified 与最新相同的 item 中, size 的最大值与最小值不同即为冲突
+        latest = [array('b', map(operator.eq, mods[j], newest)) for j in range(k)]
+        size_max = map(max, *[map(operator.sub, map(operator.mul, map(operator.add, sizes[j], repeat(1)),
+                                                    latest[j]), repeat(1)) for j in range(k)])
+        size_min = map(min, *[map(operator.add, map(operator.mul, sizes[j], latest[j]),
+                                  map(operator.mul, map(operator.sub, repeat(1), latest[j]), repeat(_BIG)))
+                              for j in range(k)])
+        conflict = array('b', map(operator.ne, size_max, size_min))
+        plan.conflicts.extend(compress(range(n), conflict))
+        ok = array('b', map(operator.not_, conflict))
+
+        for j in range(k):
+            stale = map(operator.and_, map(operator.lt, mods[j], newest), ok)
+            rows = array('q', compress(range(n), stale))
+            if not rows:
+                continue
+            row_src = [src[i] for i in rows]
+            plan.add(rows, row_src, j, [sizes[s][i] for s, i in zip(row_src, rows)])
+
+        logger.info('同步计划: %d 个路径, %d 个复制操作, %d 个冲突', n, len(plan), len(plan.conflicts))
+        return plan
+
+
+class CopyBatch(NamedTuple):
+    """一次 fs_copy 请求"""
+    src_dir: str
+    dst_dir: str
+    names: Tuple[str, ...]
+
+
+def group_copies(plan: Iterable[tuple], max_names=100) -> List[CopyBatch]:
+    """将 (sub_path, src_item, dst_item, ...) 按 (src_dir, dst_dir) 分组, 每组最多 max_names 个文件"""
+    groups = dict()
+    for sub_path, src_item, dst_item, *_ in plan:
+        src, dst = PurePosixPath(src_item, sub_path), PurePosixPath(dst_item, sub_path)
+        groups.setdefault((src.parent.as_posix(), dst.parent.as_posix()), []).append(src.name)
+    return [CopyBatch(src_dir, dst_dir, tuple(names[i:i + max_names]))
+            for (src_dir, dst_dir), names in groups.items()
+            for i in range(0, len(names), max_names)]
+
+
+def run_copy_batches(client, batches: List[CopyBatch], workers=4, on_done=None, tracker=None) -> dict:
+    """并发发送 fs_copy 请求
+
+    :param on_done: 回调 (CopyBatch, error), 成功时 error 为 None
+    :param tracker: task_tracker.CopyTaskTracker, 发送前登记 (未完成的任务过多时等待)
+    :return: 统计 files, requests, saved_requests, failed
+    """
+    stats = dict(files=sum(len(b.names) for b in batches), requests=len(batches), failed=0)
+    stats['saved_requests'] = stats['files'] - stats['requests']
+
+    def copy(batch: CopyBatch):
+        if tracker is not None:
+            tracker.reserve(batch)
+        try:
+            client.fs_copy(batch.src_dir, batch.dst_dir, *batch.names)
+        except Exception:
+            if tracker is not None:
+                tracker.discard(batch)
+            raise
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='copy') as executor:
+        futures = {executor.submit(copy, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            error = future.exception()
+            if error is not None:
+                stats['failed'] += 1
+                logger.error('复制失败 %s -> %s %s: %s', futures[future].src_dir, futures[future].dst_dir,
+                             futures[future].names, error)
+            if on_done is not None:
+                on_done(futures[future], error)
+    logger.info('复制 %d 个文件, %d 个请求, 节省 %d 个请求, 失败 %d',
+                stats['files'], stats['requests'], stats['saved_requests'], stats['failed'])
+    return stats
+
+
+def bench_plan(n=1000000, items=3):
+    """生成 n 个路径的记录并计算同步计划"""
+    import random
+    import time
+    from file_record import FileEntry
+
+    planner = SyncPlanner([f'/item_{j}' for j in range(items)])
+    for j, item in enumerate(planner.items):
+        planner.load(item, ((f'dir_{i % 1000}/file_{i}', FileEntry(1667000000 + random.randrange(3), i))
+                            for i in range(n) if random.random() > 0.05))
+    start = time.perf_counter()
+    plan = planner.plan()
+    print(f'{n} paths x {items} items: {len(plan)} copies, {len(plan.conflicts)} conflicts, '
+          f'{time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    bench_plan()
@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : task_tracker.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/07 21:15
+
+fs_copy 只是在 Alist 上创建异步的复制任务，这里跟踪这些任务直到完成。
+
+每个轮询周期只请求 task/copy/undone 和 task/copy/done 两个列表，
+按任务名称 "copy [/mount](/src/path) to [/mount](/dst/dir)" 匹配到计划中的复制操作。
+失败的任务通过 task/copy/retry 重试，未完成的操作数量有上限，避免任务队列被塞满。
+"""
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import PurePosixPath as Path
+from typing import Callable, Dict, Optional
+
+from alist_client import AlistException, Client
+
+logger = logging.getLogger('alist.sync.task')
+
+_TASK_NAME = re.compile(r'^copy \[(.*?)\]\((.*)\) to \[(.*?)\]\((.*)\)$')
+
+# Alist 不同版本的任务状态分别是字符串或数字
+_SUCCEEDED = {'succeeded', 2}
+_FAILED = {'errored', 'failed', 'canceled', 4, 5, 7}
+
+NOTHING, DOING, DONE, FAILED = 'Noting', 'Doing', 'Down', 'Failed'
+
+
+def _join(mount, actual) -> str:
+    return Path(mount, str(actual).lstrip('/')).as_posix()
+
+
+def parse_task_name(name: str) -> Optional[tuple]:
+    """返回 (src_path, dst_dir), 不是复制任务时返回 None"""
+    match = _TASK_NAME.match(name or '')
+    if match is None:
+        return None
+    src_mount, src_path, dst_mount, dst_dir = match.groups()
+    return _join(src_mount, src_path), _join(dst_mount, dst_dir)
+
+
+class _CopyOp:
+    __slots__ = ('state', 'tid', 'retries', 'unseen', 'start')
+
+    def __init__(self):
+        self.state = DOING
+        self.tid = None
+        self.retries = 0
+        self.unseen = 0
+        self.start = time.monotonic()
+
+
+class CopyTaskTracker:
+    """跟踪复制任务
+
+    :param max_outstanding: 同时未完成的复制操作上限, reserve 在超过时阻塞
+    :param max_retries: 失败任务的重试次数
+    :param min_interval, max_interval: 轮询间隔, 没有进展时逐步变长
+    :param unseen_grace: 连续多少个周期在任务列表中都找不到的操作, 检查目标文件: 存在并且大小与源文件相同时
+                         视为已完成, 否则视为失败 (同一存储内的复制, Alist 可能直接完成而不创建任务;
+                         或者已完成的任务被清除)
+    :param on_finish: 回调 (src_path, dst_dir, state, seconds), 操作完成时调用, seconds 从 reserve 开始计算
+    :param history: state() 可以查询的最近完成的操作数, 更早完成的操作不再保留 (常驻运行时内存有上限)
+    """
+
+    def __init__(self, client: Client, max_outstanding=200, max_retries=3,
+                 min_interval=1.0, max_interval=30.0, unseen_grace=3,
+                 on_finish: Callable[[str, str, str, float], None] = None, history=10000):
+        self.client = client
+        self.max_outstanding = max_outstanding
+        self.max_retries = max_retries
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.unseen_grace = unseen_grace
+        self.on_finish = on_finish
+        self.history = history
+
+        self.ops: Dict[tuple, _CopyOp] = dict()  # 未完成的操作 (src_path, dst_dir) -> _CopyOp
+        self._finished = OrderedDict()  # 最近完成的操作 (src_path, dst_dir) -> state
+        self._targets = dict()  # (dst_dir, name) -> (src_path, dst_dir), 只包含 ops 与 _finished 中的操作
+        self._doing = set()
+        self.enabled = True
+        self.stats = dict(polls=0, succeeded=0, failed=0, retried=0, untracked=0)
+        self._outstanding = 0
+        self._ignore_tids = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """记录已经存在的任务, 启动轮询线程"""
+        if self._thread is not None or not self.enabled:
+            return self
+        try:
+            self._ignore_tids = {t.get('id') for t in self._fetch_tasks()}
+        except AlistException as _e:
+            logger.warning('无法读取复制任务 (需要管理员权限), 不跟踪复制任务: %s', _e)
+            self.enabled = False
+            return self
+        self._stopped = False
+        self._thread = threading.Thread(target=self._poll_loop, name='copy_task_tracker', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @staticmethod
+    def _key(src_dir, name, dst_dir):
+        return Path(src_dir, name).as_posix(), Path(dst_dir).as_posix()
+
+    def reserve(self, batch):
+        """登记一个 CopyBatch, 未完成的操作过多时等待"""
+        if not self.enabled:
+            return
+        with self._cond:
+            self._cond.wait_for(lambda: self._outstanding == 0 or self._stopped or
+                                self._outstanding + len(batch.names) <= self.max_outstanding)
+            for name in batch.names:
+                key = self._key(batch.src_dir, name, batch.dst_dir)
+                if key not in self._doing:
+                    self._outstanding += 1
+                    self._doing.add(key)
+                self.ops[key] = _CopyOp()
+                self._finished.pop(key, None)
+                self._targets[(key[1], name)] = key
+            self._cond.notify_all()
+
+    def discard(self, batch):
+        """fs_copy 请求失败, 没有创建任务"""
+        with self._cond:
+            for name in batch.names:
+                key = self._key(batch.src_dir, name, batch.dst_dir)
+                if key in self._doing:
+                    self._finish(key, FAILED)
+            self._cond.notify_all()
+
+    def state(self, path, dst_dir=None) -> str:
+        """目标路径的复制状态: Noting, Doing, Down, Failed"""
+        path = Path(path)
+        dst_dir = Path(dst_dir or path.parent).as_posix()
+        with self._cond:
+            key = self._targets.get((dst_dir, path.name))
+            op = self.ops.get(key)
+            return op.state if op is not None else self._finished.get(key, NOTHING)
+
+    def wait(self, timeout=None) -> dict:
+        """等待全部操作完成"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._outstanding == 0 or self._stopped, timeout)
+            return dict(self.stats, outstanding=self._outstanding)
+
+    def _finish(self, key, state):
+        op = self.ops.pop(key)
+        op.state = state
+        self._doing.discard(key)
+        self._outstanding -= 1
+        self._finished[key] = state
+        while len(self._finished) > self.history:
+            old, _ = self._finished.popitem(last=False)
+            target = (old[1], Path(old[0]).name)
+            if self._targets.get(target) == old:
+                del self._targets[target]
+        self.stats['succeeded' if state == DONE else 'failed'] += 1
+        if self.on_finish is not None:
+            self.on_finish(key[0], key[1], state, time.monotonic() - op.start)
+
+    def _target_exists(self, src_path, dst_dir) -> bool:
+        """目标文件存在并且大小与源文件相同"""
+        try:
+            src = self.client.fs_get(src_path)
+            dst = self.client.fs_get(Path(dst_dir, Path(src_path).name).as_posix())
+        except AlistException as _e:
+            logger.debug('检查复制结果 %s -> %s: %s', src_path, dst_dir, _e)
+            return False
+        return bool(dst) and not dst.get('is_dir') and dst.get('size') == (src or dict()).get('size')
+
+    def _fetch_tasks(self) -> list:
+        return list(self.client.task_copy_undone()) + list(self.client.task_copy_done())
+
+    def _poll_loop(self):
+        interval = self.min_interval
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._outstanding or self._stopped)
+                if self._stopped:
+                    return
+                self._cond.wait(interval)  # stop 时提前结束等待
+                if self._stopped:
+                    return
+            try:
+                progressed = self.poll()
+            except Exception as _e:
+                logger.error('轮询复制任务失败: %s', _e)
+                progressed = False
+            interval = self.min_interval if progressed else min(self.max_interval, interval * 1.5)
+
+    def poll(self) -> bool:
+        """请求一次任务列表并更新状态, 返回是否有操作完成"""
+        tasks = self._fetch_tasks()
+        seen, retry, unseen = set(), [], []
+        with self._cond:
+            self.stats['polls'] += 1
+            before = self._outstanding
+            for task in tasks:
+                if task.get('id') in self._ignore_tids:
+                    continue
+                key = parse_task_name(task.get('name'))
+                if key not in self._doing:
+                    continue
+                op = self.ops[key]
+                seen.add(key)
+                op.tid, op.unseen = task.get('id'), 0
+                state = task.get('state')
+                if state in _SUCCEEDED:
+                    self._finish(key, DONE)
+                elif state in _FAILED:
+                    if op.retries < self.max_retries:
+                        op.retries += 1
+                        retry.append(op.tid)
+                    else:
+                        logger.error('复制失败 %s -> %s: %s', key[0], key[1], task.get('error'))
+                        self._finish(key, FAILED)
+
+            for key in self._doing - seen:
+                op = self.ops[key]
+                op.unseen += 1
+                if op.unseen >= self.unseen_grace:
+                    unseen.append(key)
+
+        # 任务列表中一直找不到的操作, 检查目标文件确认是否已经复制完成 (不持有锁)
+        confirmed = {key: self._target_exists(*key) for key in unseen}
+        with self._cond:
+            for key, exists in confirmed.items():
+                if key not in self._doing:
+                    continue
+                self.stats['untracked'] += 1
+                if not exists:
+                    logger.error('复制任务 %s -> %s 找不到, 目标文件不存在或大小不同', key[0], key[1])
+                self._finish(key, DONE if exists else FAILED)
+            progressed = self._outstanding < before
+            self._cond.notify_all()
+
+        for tid in retry:
+            try:
+                self.client.task_copy_retry(tid)
+                self.stats['retried'] += 1
+            except Exception as _e:
+                logger.warning('重试任务 %s 失败: %s', tid, _e)
+        logger.debug('轮询复制任务: %d 个任务, 未完成 %d', len(tasks), self._outstanding)
+        return progressed
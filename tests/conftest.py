@@ -0,0 +1,24 @@
+"""模块都在仓库根目录, 直接运行 pytest 时加入 sys.path"""
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def redis_url(monkeypatch) -> str:
+    """测试使用的 Redis: 环境变量 ALIST_SYNC_TEST_REDIS (例如本地启动的 redis-server) 或 fakeredis"""
+    prefix = f'alist_test_{uuid.uuid4().hex[:8]}'
+    if os.environ.get('ALIST_SYNC_TEST_REDIS'):
+        return f'{os.environ["ALIST_SYNC_TEST_REDIS"]}?prefix={prefix}'
+    fakeredis = pytest.importorskip('fakeredis')
+    import redis
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, 'from_url',
+                        classmethod(lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs)))
+    return f'redis://localhost:6379/0?prefix={prefix}'
@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+from back_operator import Operator
+
+
+class Record(Operator):
+    def verify_item_value(self, item_value) -> bool:
+        return True
+
+
+@pytest.mark.parametrize('scheme, name', [('json', 'c.json'), ('snap', 'c.snap'), ('sqlite', 'c.db')])
+def test_search_path_outside_items(tmp_path, scheme, name):
+    """各后端: 不在任何 item_dir 中的路径返回 None, 不抛出异常"""
+    op = Record(f'{scheme}://{tmp_path.as_posix()}/{name}')
+    op.set_item_dirs(['/item'])
+    op.update_path('/item/x', 1)
+    assert op.search_path('/item/x') == 1
+    assert op.search_path('/item/y') is None
+    assert op.search_path('/other/x') is None
+    assert op.search_path('/') is None
+
+
+def test_sqlite_iter_item_with_concurrent_commits(tmp_path):
+    """遍历时其他线程在共用的连接上插入并提交: 遍历读到的是开始时的记录, 不中断, 不重复"""
+    op = Record(f'sqlite://{tmp_path.as_posix()}/c.db?batch=50')
+    op.set_item_dirs(['/item', '/other'])
+    for i in range(1000):
+        op.update_path(f'/item/f{i:04d}', i)
+    op.commit()
+
+    started, stop = threading.Event(), threading.Event()
+
+    def writer():
+        started.wait()
+        i = 0
+        while not stop.is_set():
+            op.update_path(f'/other/f{i}', i)
+            op.update_path(f'/item/g{i}', i)
+            op.update_path(f'/item/f{i % 1000:04d}', i % 1000)
+            op.commit()
+            i += 1
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    got = []
+    try:
+        for row in op.iter_item('/item'):
+            got.append(row)
+            started.set()
+            time.sleep(0.0002)
+            assert len(got) <= 1000, '读到了遍历开始后插入的记录'
+    finally:
+        stop.set()
+        thread.join()
+    assert sorted(got) == [(f'f{i:04d}', i) for i in range(1000)]
+
+
+def test_redis_operator(redis_url):
+    """两个节点共享 Redis: 批量写入, 目录租约, 发布子目录, 最后结束的节点"""
+    a, b = Record(redis_url + '&batch=3'), Record(redis_url)
+    for op in (a, b):
+        op.set_item_dirs(['/item/'])
+
+    a.update_path('/item/x', [1, 2])
+    assert a.search_path('/item/x') == [1, 2] and b.search_path('/item/x') is None  # 还在缓冲区中
+    a.update_path('/item/y', 1)
+    a.update_path('/item/z', 2)  # 满 batch 条时写入
+    assert b.search_path('/item/x') == [1, 2] and dict(b.iter_item('/item/')) == {'x': [1, 2], 'y': 1, 'z': 2}
+    a.delete_path('/item/y')
+    a.commit()
+    assert b.search_path('/item/y') is None
+
+    a.enter_scan('/item/')
+    b.enter_scan('/item')
+    assert a.acquire_lease('/item/d') and not b.acquire_lease('/item/d')
+    assert b.shared_listing('/item/d') is None  # a 正在列出
+    b.release_lease('/item/d', [['e', 1]])  # 不是自己的租约, 没有作用
+    a.renew_lease('/item/d')
+    assert b.shared_listing('/item/d') is None
+    a.release_lease('/item/d', [['e', [1, 0, True, None]]])
+    assert not b.acquire_lease('/item/d') and b.shared_listing('/item/d') == [['e', [1, 0, True, None]]]
+
+    assert b.acquire_lease('/item/f')
+    b.release_lease('/item/f')  # 列出失败, 其他节点可以重试
+    assert a.acquire_lease('/item/f')
+
+    a.update_path('/item/w', 1)  # 结束扫描前写入缓冲区中的记录
+    assert a.leave_scan('/item/') is False  # b 还在扫描
+    assert b.search_path('/item/w') == 1
+    assert b.leave_scan('/item/') is True
+
+    a.enter_scan('/item/')  # 新的一轮, 上一轮的租约和发布的列表不再有效
+    assert a.shared_listing('/item/d') is None and a.acquire_lease('/item/d')
+    assert a.leave_scan('/item/') is True
@@ -0,0 +1,18 @@
+import threading
+
+from metrics import Metrics, MemorySink, PrometheusFileSink
+
+
+def test_enable_disable_cycles_keep_one_export_thread(tmp_path):
+    """多次 enable / disable 后只有一个导出线程, 同一个文件的 sink 只注册一次"""
+    metrics = Metrics()
+    for _ in range(5):
+        metrics.enable(PrometheusFileSink(tmp_path / 'a.prom'), interval=0.01)
+        metrics.disable()
+    metrics.enable(PrometheusFileSink(tmp_path / 'a.prom'), MemorySink(), interval=0.01)
+    try:
+        assert sum(t.name == 'metrics_export' for t in threading.enumerate()) == 1
+        assert len(metrics.sinks) == 2
+    finally:
+        metrics.disable()
+    assert not any(t.name == 'metrics_export' for t in threading.enumerate())
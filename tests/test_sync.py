@@ -0,0 +1,51 @@
+import threading
+from pathlib import PurePosixPath as Path
+
+from file_record import FileEntry
+from mock_alist import MockAlist
+from sync import Sync
+from task_tracker import DONE
+
+
+def test_copy(tmp_path):
+    """copy_file 在模拟的 Alist 上复制一个文件, 跟踪复制任务直到完成, 结束后停止跟踪线程"""
+    with MockAlist(roots=('/a', '/b'), width=1, depth=1, files=2) as server:
+        sync = Sync(dict(name='t', items=['/a', '/b'], cache_path=f'json://{tmp_path.as_posix()}/c.json',
+                         alist_prefix=server.base_url, alist_token=server.token))
+        sync.copy_tracker.min_interval = 0.05
+        server.tree.add_file('/a/new.txt', 4096)
+
+        assert sync.copy_file('/a', '/b', 'new.txt') == DONE
+        assert server.tree.get('/b/new.txt')['size'] == server.tree.get('/a/new.txt')['size']
+        assert server.calls['/fs/copy'] == 1 and server.calls['/admin/task/copy/done']
+        assert sync.copy_tracker._thread is None
+
+
+def test_redis_shared_scan(redis_url):
+    """两个节点通过 Redis 同时扫描: 每个目录只被列出一次, 两个节点都分担了目录, 扫描结束后游标清空"""
+    with MockAlist(roots=('/a', '/b'), width=4, depth=2, files=4, latency=0.05) as server:
+        nodes = [Sync(dict(name='t', items=['/a', '/b'], cache_path=redis_url, alist_prefix=server.base_url,
+                           alist_token=server.token, scan_workers=3)) for _ in range(2)]
+        listed = [[] for _ in nodes]
+        for sync, paths in zip(nodes, listed):
+            sync.lease_poll = 0.05
+
+            def fs_list_iter(path, *args, _inner=sync.alist_client.fs_list_iter, _paths=paths, **kwargs):
+                _paths.append(path)
+                return _inner(path, *args, **kwargs)
+
+            sync.alist_client.fs_list_iter = fs_list_iter
+
+        threads = [threading.Thread(target=sync.scan_update_file) for sync in nodes]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        all_dirs = sorted(p for p in server.tree.dirs if p.startswith(('/a', '/b')))
+        assert sorted(listed[0] + listed[1]) == all_dirs  # 每个目录只列出一次
+        assert listed[0] and listed[1]
+        files = [Path(d, name).as_posix() for d in all_dirs for name, e in server.tree.dirs[d].items()
+                 if not e['is_dir']]
+        assert all(isinstance(nodes[1].files_record.search_path(f), FileEntry) for f in files)
+        assert not list(nodes[0].update_cache.iter_item('/a')) and not list(nodes[0].update_cache.iter_item('/b'))
@@ -0,0 +1,26 @@
+from alist_client import Client
+from mock_alist import MockAlist
+from sync_plan import CopyBatch
+from task_tracker import DONE, FAILED, CopyTaskTracker
+
+
+def test_unseen_copy_checks_target():
+    """任务列表中找不到的复制: 目标文件存在并且大小相同时完成, 否则失败"""
+    with MockAlist(roots=('/a', '/b'), width=0, depth=0, files=1) as server:
+        client = Client(server.base_url)
+        client.set_token(server.token)
+        server.tree.add_file('/a/copied.txt', 10)
+        server.tree.add_file('/a/missing.txt', 10)
+        server.tree.add_file('/a/short.txt', 10)
+        server.tree.add_file('/b/copied.txt', 10)  # 同一存储内的复制直接完成, 没有任务
+        server.tree.add_file('/b/short.txt', 3)
+
+        finished = []
+        with CopyTaskTracker(client, min_interval=0.05, unseen_grace=2,
+                             on_finish=lambda src, dst, state, _: finished.append((src, state))) as tracker:
+            tracker.reserve(CopyBatch('/a', '/b', ('copied.txt', 'missing.txt', 'short.txt')))
+            stats = tracker.wait(timeout=10)
+
+        assert stats['outstanding'] == 0 and stats['untracked'] == 3
+        assert sorted(finished) == [('/a/copied.txt', DONE), ('/a/missing.txt', FAILED), ('/a/short.txt', FAILED)]
+        assert tracker.state('/b/copied.txt') == DONE and tracker.state('/b/missing.txt') == FAILED
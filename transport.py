@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : transport.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/10 20:45
+
+请求的传输策略: 每个 Host 的令牌桶限速, 熔断器, 幂等请求的指数退避重试, 按接口的超时时间。
+
+同步的 Client 与 AsyncClient 共用同一个实现, 需要等待的时间由 admit / retry_delay 返回,
+由调用者 time.sleep 或 asyncio.sleep。
+"""
+import asyncio
+import http.client
+import logging
+import random
+import threading
+import time
+import urllib.parse
+from typing import Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger('alist.client.transport')
+
+
+class CircuitOpen(Exception):
+    """熔断器打开, 请求没有发送"""
+
+    def __init__(self, host, retry_after):
+        super().__init__(f'{host} 熔断中, {retry_after:.1f} 秒后重试')
+        self.host = host
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """令牌桶, rate 每秒生成的令牌, burst 桶的容量"""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1.0)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1) -> float:
+        """取 n 个令牌, 返回需要等待的秒数 (令牌可以预支)"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class CircuitBreaker:
+    """连续失败 failure_threshold 次后打开, reset_timeout 秒后放行一个探测请求,
+    探测成功时关闭, 失败时重新打开。"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures >= self.failure_threshold
+
+    def check(self, host):
+        with self._lock:
+            if not self.is_open:
+                return
+            now = time.monotonic()
+            if now < self.open_until:
+                raise CircuitOpen(host, self.open_until - now)
+            self.open_until = now + self.reset_timeout  # 放行这一个探测请求
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures == self.failure_threshold:
+                self.open_until = time.monotonic() + self.reset_timeout
+                logger.warning('连续失败 %d 次, 熔断 %.0f 秒', self.failures, self.reset_timeout)
+
+
+class TransportPolicy:
+    """传输策略
+
+    :param rate: 每个 Host 每秒的请求数, None 不限速
+    :param burst: 令牌桶容量, 默认等于 rate
+    :param max_retries: 幂等请求的最多重试次数
+    :param backoff: 退避的基础时间, 第 n 次重试等待 uniform(0, min(max_backoff, backoff * 2**n)) 秒
+    :param failure_threshold, reset_timeout: 熔断器参数, failure_threshold=0 不熔断
+    :param timeouts: 接口 -> 超时时间, 例如 {'/fs/list': 120}; 其他接口使用连接池的超时
+    :param idempotent: 可以重试的接口
+    :param retryable: (error) -> bool, 可以重试的错误; 同时也是熔断器计为失败的错误
+    :param limits: Host -> 信号量 (acquire / release), 限制同时进行的请求数;
+                   可以是 multiprocessing.BoundedSemaphore, 多个进程共用一个预算
+    """
+
+    def __init__(self, rate: float = None, burst: float = None, max_retries=3, backoff=0.5, max_backoff=30.0,
+                 failure_threshold=5, reset_timeout=30.0, timeouts: Dict[str, float] = None,
+                 idempotent: Iterable[str] = (), retryable: Callable[[BaseException], bool] = None,
+                 limits: dict = None):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeouts = dict(timeouts or dict())
+        self.idempotent = set(idempotent)
+        self.retryable = retryable or self.transport_error
+        self.limits = dict(limits or dict())
+
+        self.stats = dict(requests=0, retries=0, failures=0, rate_limited=0, rate_wait=0.0, circuit_open=0)
+        self._buckets = dict()
+        self._breakers = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def transport_error(error: BaseException) -> bool:
+        """连接错误, 超时, 不完整的 HTTP 响应"""
+        return isinstance(error, (OSError, http.client.HTTPException, asyncio.TimeoutError))
+
+    @staticmethod
+    def _host(url) -> str:
+        return urllib.parse.urlsplit(url).netloc
+
+    def _get(self, table, host, factory):
+        with self._lock:
+            if host not in table:
+                table[host] = factory()
+            return table[host]
+
+    def timeout(self, api) -> Optional[float]:
+        return self.timeouts.get(api)
+
+    def admit(self, url) -> float:
+        """请求发送前调用, 熔断时抛出 CircuitOpen, 返回限速需要等待的秒数"""
+        host = self._host(url)
+        if self.failure_threshold:
+            self._get(self._breakers, host, lambda: CircuitBreaker(self.failure_threshold, self.reset_timeout)) \
+                .check(host)
+        with self._lock:
+            self.stats['requests'] += 1
+        if not self.rate:
+            return 0.0
+        wait = self._get(self._buckets, host, lambda: TokenBucket(self.rate, self.burst)).reserve()
+        if wait:
+            with self._lock:
+                self.stats['rate_limited'] += 1
+                self.stats['rate_wait'] += wait
+        return wait
+
+    def acquire(self, url):
+        """占用 Host 的一个并发名额, 没有限制时什么也不做"""
+        limit = self.limits.get(self._host(url)) if self.limits else None
+        if limit is not None:
+            limit.acquire()
+
+    def release(self, url):
+        limit = self.limits.get(self._host(url)) if self.limits else None
+        if limit is not None:
+            limit.release()
+
+    async def aacquire(self, url):
+        """acquire 的异步版本, 信号量可能属于其他进程, 所以轮询而不是阻塞事件循环"""
+        limit = self.limits.get(self._host(url)) if self.limits else None
+        if limit is not None:
+            while not limit.acquire(False):
+                await asyncio.sleep(0.005)
+
+    def record(self, url, error: BaseException = None):
+        """请求完成后调用, error 为 None 表示成功"""
+        if isinstance(error, CircuitOpen):
+            with self._lock:
+                self.stats['circuit_open'] += 1
+            return
+        breaker = self._breakers.get(self._host(url))
+        if error is not None and self.retryable(error):
+            with self._lock:
+                self.stats['failures'] += 1
+            if breaker is not None:
+                breaker.failure()
+        elif breaker is not None:
+            breaker.success()  # 4xx 等业务错误说明服务器是正常的
+
+    def retry_delay(self, api, error: BaseException, attempt: int) -> Optional[float]:
+        """第 attempt 次 (从 0 开始) 失败后, 返回重试前等待的秒数; 不能重试时返回 None"""
+        if attempt >= self.max_retries or api not in self.idempotent:
+            return None
+        if isinstance(error, CircuitOpen):
+            delay = error.retry_after
+        elif self.retryable(error):
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        else:
+            return None
+        with self._lock:
+            self.stats['retries'] += 1
+        return delay
+
+    def call(self, url, api, func: Callable[[Optional[float]], object]):
+        """func(timeout) 发送请求, 按策略限速和重试"""
+        attempt = 0
+        while True:
+            try:
+                time.sleep(self.admit(url))
+                self.acquire(url)
+                try:
+                    result = func(self.timeout(api))
+                finally:
+                    self.release(url)
+            except Exception as _e:
+                self.record(url, _e)
+                delay = self.retry_delay(api, _e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                logger.warning('%s 失败, %.2f 秒后第 %d 次重试: %r', url, delay, attempt, _e)
+                time.sleep(delay)
+                continue
+            self.record(url)
+            return result
+
+    async def acall(self, url, api, func):
+        """call 的异步版本, func(timeout) 返回 coroutine"""
+        attempt = 0
+        while True:
+            try:
+                await asyncio.sleep(self.admit(url))
+                await self.aacquire(url)
+                try:
+                    result = await func(self.timeout(api))
+                finally:
+                    self.release(url)
+            except Exception as _e:
+                self.record(url, _e)
+                delay = self.retry_delay(api, _e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                logger.warning('%s 失败, %.2f 秒后第 %d 次重试: %r', url, delay, attempt, _e)
+                await asyncio.sleep(delay)
+                continue
+            self.record(url)
+            return result
@@ -1,29 +1,40 @@
 import logging
 from pathlib import Path
 
-from back_operator import JsonOperator as Operator
-from urllib.parse import urlparse
+from back_operator import Operator
+from urllib.parse import urlparse, parse_qs, urlencode
 
 logger = logging.getLogger('alist.sync.updating_cache')
 
 
 class UpdatingCache(Operator):
-    """"""
+    """扫描进度, 与 FileRecord 使用同一个后端, 文件名 / prefix 加上 suffix"""
+    suffix = '_updating_cache'
 
     def __init__(self, cache_uri):
         _p = urlparse(cache_uri)
-        if _p.scheme.lower() == 'json':
+        if _p.scheme.lower() in ('json', 'sqlite', 'snap'):
 
-            super().__init__(self.json_op(_p))
+            super().__init__(self.file_op(_p))
+        elif _p.scheme.lower() == 'redis':
+            super().__init__(self.redis_op(_p))
         else:
-            raise
+            raise ValueError(f'UpdatingCache 不支持的 cache_uri: {cache_uri}')
 
-    def json_op(self, _p):
+    def file_op(self, _p):
         path = Path(_p.path)
-        new_path = 'json://' + path.with_stem(path.stem + '_updating_cache').as_posix()
-        logger.info('Rewrite Json File path from <%s> to <%s>', path, new_path, )
+        new_path = f'{_p.scheme}://{_p.netloc}' + path.with_stem(path.stem + self.suffix).as_posix()
+        new_path += f'?{_p.query}' if _p.query else ''
+        logger.info('Rewrite %s File path from <%s> to <%s>', _p.scheme, path, new_path, )
         return new_path
 
+    def redis_op(self, _p):
+        query = parse_qs(_p.query)
+        query['prefix'] = [query.get('prefix', ['alist_sync'])[0] + self.suffix]
+        new_uri = _p._replace(query=urlencode(query, doseq=True)).geturl()
+        logger.info('Rewrite Redis prefix to <%s>', query['prefix'][0])
+        return new_uri
+
     def verify_item_value(self, item_value) -> bool:
         """验证的"""
         # TODO 验证器
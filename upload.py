@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : upload.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/15 20:10
+
+流式上传 (/fs/put)。
+
+UploadBody 把本地路径、二进制文件对象 或 bytes-like (bytes, memoryview, mmap) 包装成 http.client 可以分块读取的
+请求体, 不会把整个文件读入内存: 大小已知时发送 Content-Length, 未知时 (管道等) 使用 chunked 编码;
+bytes-like 按 memoryview 切片发送, 不复制。
+
+    client.fs_put_stream('/onedrive/big.iso', '/data/big.iso', on_progress=print)
+    put_many(client, [('/onedrive/a.bin', '/data/a.bin'), ...], workers=4)
+"""
+import logging
+import os
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterable, Optional, Tuple
+
+logger = logging.getLogger('alist.client.upload')
+
+
+class UploadBody:
+    """上传的请求体
+
+    :param source: 本地路径 | 二进制文件对象 | bytes-like
+    :param size: 文件对象的大小, None 时尝试 fstat, 仍然未知时使用 chunked 编码
+    :param on_progress: 回调 (sent, size), 每读取一块调用一次, size 可能为 None
+    """
+
+    def __init__(self, source, size: int = None, on_progress: Callable[[int, Optional[int]], None] = None):
+        self._owned = False
+        self._file = None
+        self._view = None
+        if isinstance(source, (str, os.PathLike)):
+            self._file = open(source, 'rb')
+            self._owned = True
+        elif hasattr(source, 'read'):
+            self._file = source
+        else:
+            self._view = memoryview(source).cast('B')
+
+        self._start = self._tell()
+        self.size = self._view.nbytes if self._view is not None else (size if size is not None else self._fsize())
+        self.on_progress = on_progress
+        self.sent = 0
+
+    def _tell(self) -> Optional[int]:
+        if self._view is not None:
+            return 0
+        try:
+            return self._file.tell() if self._file.seekable() else None
+        except (AttributeError, OSError):
+            return None
+
+    def _fsize(self) -> Optional[int]:
+        """普通文件从当前位置到结尾的字节数"""
+        if self._start is None:
+            return None
+        try:
+            st = os.fstat(self._file.fileno())
+        except (AttributeError, OSError, ValueError):
+            return None
+        return max(st.st_size - self._start, 0) if stat.S_ISREG(st.st_mode) else None
+
+    def read(self, n=-1):
+        """http.client 按 blocksize 调用"""
+        if self.size is not None:
+            remaining = self.size - self.sent
+            n = remaining if n is None or n < 0 else min(n, remaining)
+        if self._view is not None:
+            chunk = self._view[self.sent:self.sent + n] if n >= 0 else self._view[self.sent:]
+        else:
+            chunk = self._file.read(n) if n != 0 else b''
+        self.sent += len(chunk)
+        if self.on_progress is not None and chunk:
+            self.on_progress(self.sent, self.size)
+        return chunk
+
+    def rewind(self) -> bool:
+        """回到开头以便重发, 不可 seek 的文件对象返回 False"""
+        if self._start is None:
+            return False
+        if self._file is not None:
+            self._file.seek(self._start)
+        self.sent = 0
+        return True
+
+    def close(self):
+        if self._owned:
+            self._file.close()
+        if self._view is not None:
+            self._view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def put_many(client, uploads: Iterable[Tuple[str, object]], workers=4, as_task=False,
+             on_progress: Callable[[str, int, Optional[int]], None] = None, progress_interval=5.0) -> dict:
+    """并发上传 [(远程路径, source), ...]
+
+    :param on_progress: 回调 (远程路径, sent, size), 在上传线程中调用
+    :param progress_interval: 每隔多少秒输出一次总进度日志
+    :return: 统计 files, bytes, failed, seconds, errors {远程路径: 错误}
+    """
+    uploads = list(uploads)
+    stats = dict(files=len(uploads), bytes=0, failed=0, seconds=0.0, errors=dict())
+    sent_by_path = dict()
+    lock = threading.Lock()
+    start = last = time.monotonic()
+
+    def progress(path, sent, size):
+        nonlocal last
+        if on_progress is not None:
+            on_progress(path, sent, size)
+        with lock:
+            sent_by_path[path] = sent
+            now = time.monotonic()
+            if now - last < progress_interval:
+                return
+            last = now
+            total = sum(sent_by_path.values())
+        logger.info('上传进度: %d 个文件, 已发送 %.1f MiB, %.1f MiB/秒',
+                    stats['files'], total / 1048576, total / (now - start) / 1048576)
+
+    def put(path, source):
+        client.fs_put_stream(path, source, as_task=as_task, on_progress=lambda n, size: progress(path, n, size))
+        return sent_by_path.get(path, 0)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload') as executor:
+        futures = {executor.submit(put, path, source): path for path, source in uploads}
+        for future in as_completed(futures):
+            path = futures[future]
+            error = future.exception()
+            if error is not None:
+                stats['failed'] += 1
+                stats['errors'][path] = repr(error)
+                logger.error('上传 %s 失败: %s', path, error)
+            else:
+                stats['bytes'] += future.result()
+    stats['seconds'] = round(time.monotonic() - start, 3)
+    logger.info('上传 %d 个文件, %d 字节, 失败 %d, %.1f 秒', stats['files'], stats['bytes'], stats['failed'],
+                stats['seconds'])
+    return stats
@@ -0,0 +1,505 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@File Name  : watch.py
+@Author     : LeeCQ
+@Date-Time  : 2022/11/18 21:00
+
+常驻运行的同步 (watch 模式)。
+
+sync.py 每次运行都从头扫描; watch 模式启动时扫描一次 (scan_mode 为 incremental 时只进入变化的目录),
+之后 FileRecord, DirIndex, MetaCache 一直留在内存中, 按目录的时间表重新列出单个目录:
+
+    DirSchedule  每个目录有自己的轮询间隔, 发现变化时降到 min_interval, 没有变化时逐步变长到 max_interval;
+                 启动时按目录上次修改距今的时间估计初始间隔, 最近修改过的目录轮询得更频繁。
+                 列出目录的速率由令牌桶 (list_rate) 限制, 到期的目录超过预算时按到期时间排队。
+    CopyQueue    变化稳定 settle 秒后重新计算复制计划, 复制操作按文件大小从小到大发送,
+                 在途 (已发送未完成) 的字节数不超过 max_inflight_bytes。
+
+    python watch.py config.json --groups t1,t2
+
+每个 sync_group 可以单独配置 (全部可选):
+    "watch": {"min_interval": 10, "max_interval": 600, "backoff": 2, "age_factor": 0.1,
+              "list_rate": 5, "max_inflight_bytes": 1073741824, "settle": 5, "refresh": true}
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import signal
+import threading
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import PurePosixPath as Path
+from typing import Dict, Iterable, List, Optional
+
+from alist_client import AlistServerExpcetion
+from file_record import FileEntry
+from metrics import METRICS
+from scanner import list_entries
+from sync import Sync
+from sync_plan import group_copies, run_copy_batches
+from task_tracker import DONE
+from transport import TokenBucket
+
+logger = logging.getLogger('alist.sync.watch')
+
+
+class DirSchedule:
+    """目录的轮询时间表 (按到期时间的最小堆)
+
+    :param min_interval: 发现变化后的轮询间隔 (秒)
+    :param max_interval: 最长的轮询间隔
+    :param backoff: 没有变化时间隔乘以 backoff
+    :param age_factor: 初始间隔 = 目录上次修改距今的时间 * age_factor
+    """
+
+    def __init__(self, min_interval=10.0, max_interval=600.0, backoff=2.0, age_factor=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.age_factor = age_factor
+        self.intervals: Dict[str, float] = dict()  # path -> 轮询间隔
+        self._due: Dict[str, float] = dict()  # path -> 下次轮询的时间 (monotonic), 正在列出的目录不在其中
+        self._heap = []
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def __contains__(self, path):
+        return path in self.intervals
+
+    def _clamp(self, interval) -> float:
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def _push(self, path, due):
+        self._due[path] = due
+        heapq.heappush(self._heap, (due, path))
+
+    def add(self, path, modified: int = None, now: float = None, jitter=True):
+        """加入一个目录; modified 为 None 时从 min_interval 开始"""
+        now = time.monotonic() if now is None else now
+        age = time.time() - modified if modified else 0
+        interval = self.intervals[path] = self._clamp(age * self.age_factor)
+        self._push(path, now + (random.uniform(0, interval) if jitter else 0))
+
+    def hot(self, path, now: float = None):
+        """目录有变化 (父目录列表中的指纹改变): 立即轮询, 间隔降到 min_interval"""
+        self.intervals[path] = self.min_interval
+        if path in self._due:  # 正在列出的目录在 done 时重新排期
+            self._push(path, time.monotonic() if now is None else now)
+
+    def done(self, path, changed: bool, now: float = None):
+        """列出完成, 按是否有变化调整间隔并重新排期"""
+        if path not in self.intervals:  # 列出期间被删除
+            return
+        interval = self.min_interval if changed else self._clamp(self.intervals[path] * self.backoff)
+        self.intervals[path] = interval
+        self._push(path, (time.monotonic() if now is None else now) + interval)
+
+    def remove(self, path) -> List[str]:
+        """删除目录及其全部子目录, 返回删除的路径"""
+        prefix = path.rstrip('/') + '/'
+        removed = [p for p in self.intervals if p == path or p.startswith(prefix)]
+        for p in removed:
+            del self.intervals[p]
+            self._due.pop(p, None)
+        return removed
+
+    def pop_due(self, now: float, limit: int) -> List[str]:
+        """取出最多 limit 个已经到期的目录, 最早到期的优先"""
+        paths = []
+        while self._heap and len(paths) < limit and self._heap[0][0] <= now:
+            due, path = heapq.heappop(self._heap)
+            if self._due.get(path) != due:  # 已经重新排期或删除
+                continue
+            del self._due[path]
+            paths.append(path)
+        return paths
+
+    def next_due(self) -> Optional[float]:
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def overdue(self, now: float) -> int:
+        return sum(1 for due in self._due.values() if due <= now)
+
+
+class CopyQueue:
+    """按优先级发送复制操作: 小文件优先, 在途的字节数不超过 max_inflight_bytes
+
+    单个超过上限的文件在没有其他在途操作时发送。服务器端复制在 CopyTaskTracker 报告完成时释放额度,
+    中转复制在上传完成时释放。失败的操作 retry_delay 秒内不再加入队列。
+    """
+
+    def __init__(self, sync: Sync, max_inflight_bytes=1 << 30, retry_delay=600.0):
+        self.sync = sync
+        self.max_inflight_bytes = max_inflight_bytes
+        self.retry_delay = retry_delay
+        self.inflight_bytes = 0
+        self.stats = dict(queued=0, copied=0, failed=0, bytes=0)
+
+        self._heap = []  # (size, seq, op)
+        self._queued = set()  # (src_path, dst_path)
+        self._inflight: Dict[tuple, int] = dict()  # (src_path, dst_path) -> size
+        self._failed: Dict[tuple, float] = dict()  # (src_path, dst_path) -> 可以重试的时间
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=sync.copy_workers + sync.relay_workers,
+                                            thread_name_prefix='watch_copy')
+        sync.copy_tracker.on_finish = self._server_done
+
+    def __len__(self):
+        return len(self._heap)
+
+    @staticmethod
+    def _key(sub_path, src_item, dst_item) -> tuple:
+        return Path(src_item, sub_path).as_posix(), Path(dst_item, sub_path).as_posix()
+
+    def push(self, plan: Iterable[tuple]) -> int:
+        """加入 (sub_path, src_item, dst_item, size), 已经在队列中或在途的跳过, 返回加入的数量"""
+        now, n = time.monotonic(), 0
+        with self._lock:
+            for op in plan:
+                key = self._key(*op[:3])
+                if key in self._queued or key in self._inflight or self._failed.get(key, 0) > now:
+                    continue
+                self._failed.pop(key, None)
+                self._queued.add(key)
+                heapq.heappush(self._heap, (op[3] or 0, next(self._seq), tuple(op)))
+                n += 1
+            self.stats['queued'] += n
+        return n
+
+    def dispatch(self) -> int:
+        """在额度内发送队列中最小的操作, 返回发送的数量"""
+        ready = []
+        with self._lock:
+            while self._heap and not self._closed:
+                size = self._heap[0][0]
+                if self._inflight and self.inflight_bytes + size > self.max_inflight_bytes:
+                    break
+                op = heapq.heappop(self._heap)[2]
+                key = self._key(*op[:3])
+                self._queued.discard(key)
+                self._inflight[key] = size
+                self.inflight_bytes += size
+                ready.append(op)
+        if not ready:
+            return 0
+
+        server, relay = self.sync._route(ready)
+        if server:
+            batches = group_copies(server, max_names=self.sync.copy_batch_size)
+            self._executor.submit(run_copy_batches, self.sync.alist_client, batches, workers=self.sync.copy_workers,
+                                  on_done=self._batch_sent, tracker=self.sync.copy_tracker)
+        for op in relay:
+            self._executor.submit(self._relay, *op)
+        logger.debug('发送 %d 个复制操作, 在途 %d 字节', len(ready), self.inflight_bytes)
+        return len(ready)
+
+    def _release(self, key, ok: bool):
+        with self._lock:
+            size = self._inflight.pop(key, None)
+            if size is None:
+                return
+            self.inflight_bytes -= size
+            if ok:
+                self.stats['copied'] += 1
+                self.stats['bytes'] += size
+            else:
+                self.stats['failed'] += 1
+                self._failed[key] = time.monotonic() + self.retry_delay
+        self.dispatch()
+
+    def _batch_sent(self, batch, error):
+        """fs_copy 请求完成; 失败时 tracker.discard 已经释放, 不跟踪任务时在这里释放"""
+        tracked = self.sync.copy_tracker.enabled and error is None
+        for name in batch.names:
+            src, dst = Path(batch.src_dir, name).as_posix(), Path(batch.dst_dir, name).as_posix()
+            if not tracked:
+                if error is None:
+                    self.sync._copied(src, dst)
+                self._release((src, dst), error is None)
+
+    def _server_done(self, src_path, dst_dir, state, seconds):
+        self.sync._server_copy_done(src_path, dst_dir, state, seconds)
+        self._release((src_path, Path(dst_dir, Path(src_path).name).as_posix()), state == DONE)
+
+    def _relay(self, src_path, dst_path, size, modified):
+        start = time.monotonic()
+        try:
+            self.sync.relay.copy(src_path, dst_path, size, modified)
+            error = None
+        except Exception as _e:
+            logger.error('中转复制失败 %s -> %s: %s', src_path, dst_path, _e)
+            error = _e
+        self.sync._relay_done(src_path, dst_path, size, time.monotonic() - start, error)
+        self._release((src_path, dst_path), error is None)
+
+    def idle(self) -> bool:
+        with self._lock:
+            return not self._heap and not self._inflight
+
+    def close(self):
+        """不再发送新的操作, 等待正在发送的请求和中转复制结束; 队列中的操作下次启动时重新计划"""
+        with self._lock:
+            self._closed = True
+        self.sync.copy_tracker.stop()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class Watcher:
+    """常驻运行一个 sync_group
+
+    :param sync: Sync, 其中的 FileRecord / DirIndex / MetaCache 在整个运行期间保持在内存中
+    :param list_rate: 每秒最多列出的目录数, 限制 API 用量
+    :param max_inflight_bytes: 在途复制的字节数上限
+    :param settle: 第一个变化之后等待多少秒再计算复制计划, 合并一段时间内的变化
+    :param refresh: 列出目录时要求 Alist 刷新存储的列表 (不使用 Alist 自己的目录缓存)
+    :param report_interval: 每隔多少秒输出一次状态日志 (与 watch_* 指标)
+    其余参数见 DirSchedule
+    """
+
+    def __init__(self, sync: Sync, min_interval=10.0, max_interval=600.0, backoff=2.0, age_factor=0.1,
+                 list_rate=5.0, max_inflight_bytes=1 << 30, settle=5.0, refresh=True, report_interval=60.0):
+        self.sync = sync
+        self.schedule = DirSchedule(min_interval, max_interval, backoff, age_factor)
+        self.bucket = TokenBucket(list_rate, max(list_rate, 1.0))
+        self.copies = CopyQueue(sync, max_inflight_bytes=max_inflight_bytes, retry_delay=max_interval)
+        self.settle = settle
+        self.refresh = refresh
+        self.report_interval = report_interval
+        self.workers = sync.scan_workers
+        self.stats = dict(polls=0, changed_dirs=0, changed_files=0, removed_files=0, new_dirs=0, removed_dirs=0,
+                          errors=0, plans=0)
+
+        self._children: Dict[str, set] = dict()  # 目录 -> 子目录
+        self._files: Dict[str, set] = dict()  # 目录 -> 有记录的文件名, 用于发现删除的文件
+        self._fingerprints: Dict[str, FileEntry] = dict()  # 等待列出的目录 -> 父目录列表中的指纹
+        self._roots = {Path(item).as_posix() for item in sync.items}
+        self._dirty_at = None  # 第一个还没有计算复制计划的变化
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def warm(self):
+        """启动时扫描一次, 然后把全部已知的目录加入时间表"""
+        self.sync.scan_update_file()
+        now = time.monotonic()
+        for item in self.sync.items:
+            self.schedule.add(Path(item).as_posix(), now=now)
+            for sub_path, entry in self.sync.dir_index.iter_item(item):
+                path = Path(item, sub_path).as_posix()
+                self.schedule.add(path, entry.modified, now=now)
+                self._children.setdefault(Path(path).parent.as_posix(), set()).add(path)
+            for sub_path, entry in self.sync.files_record.iter_item(item):
+                if not entry.is_dir:
+                    path = Path(item, sub_path)
+                    self._files.setdefault(path.parent.as_posix(), set()).add(path.name)
+        logger.info('[%s] 监视 %d 个目录, %d 个文件', self.sync.name, len(self.schedule),
+                    sum(len(v) for v in self._files.values()))
+        self._dirty_at = now - self.settle  # 启动时立即计算一次复制计划
+
+    def _list(self, path, delay) -> list:
+        """在工作线程中执行"""
+        if delay > 0:
+            time.sleep(delay)
+        return list(list_entries(self.sync.alist_client, path, self.sync.list_fields, refresh=self.refresh))
+
+    def _apply(self, path, entries) -> bool:
+        """比较目录列表与记录, 更新记录和子目录的时间表, 返回是否有变化"""
+        record, dir_index, now = self.sync.files_record, self.sync.dir_index, time.monotonic()
+        children, files, changed = set(), set(), 0
+        for name, entry in entries:
+            sub_path = Path(path, name).as_posix()
+            if entry.is_dir:
+                children.add(sub_path)
+                if sub_path not in self.schedule:
+                    self.schedule.add(sub_path, now=now, jitter=False)
+                    self._fingerprints[sub_path] = entry
+                    self.stats['new_dirs'] += 1
+                    changed += 1
+                elif entry.modified and not dir_index.unchanged(sub_path, entry) \
+                        and self._fingerprints.get(sub_path) != entry:
+                    self.schedule.hot(sub_path, now)
+                    self._fingerprints[sub_path] = entry
+                continue
+            files.add(name)
+            old = record.search_path(sub_path)
+            if isinstance(old, FileEntry) and old[:2] == entry[:2]:
+                continue
+            record.update_path(sub_path, entry)
+            self.stats['changed_files'] += 1
+            changed += 1
+
+        for name in self._files.get(path, set()) - files:
+            self._delete_record(Path(path, name).as_posix())
+            changed += 1
+        self._files[path] = files
+        for gone in self._children.get(path, set()) - children:
+            self._remove_dir(gone)
+            changed += 1
+        self._children[path] = children
+        fingerprint = self._fingerprints.pop(path, None)
+        if fingerprint is not None:
+            dir_index.update_path(path, fingerprint)
+        if changed:
+            self.stats['changed_dirs'] += 1
+            self._dirty_at = self._dirty_at or now
+        return bool(changed)
+
+    def _delete_record(self, path):
+        """源中已经删除的文件不再出现在复制计划中"""
+        if self.sync.files_record.search_path(path) is not None:
+            self.sync.files_record.delete_path(path)
+        self.stats['removed_files'] += 1
+
+    def _remove_dir(self, path):
+        """目录已经不存在: 删除它和全部子目录的时间表, 指纹, 文件记录"""
+        self._children.get(Path(path).parent.as_posix(), set()).discard(path)
+        for removed in self.schedule.remove(path):
+            self._children.pop(removed, None)
+            self._fingerprints.pop(removed, None)
+            if self.sync.dir_index.search_path(removed) is not None:
+                self.sync.dir_index.delete_path(removed)
+            self.stats['removed_dirs'] += 1
+        prefix = path + '/'
+        for d in [d for d in self._files if d == path or d.startswith(prefix)]:
+            for name in self._files.pop(d):
+                self._delete_record(Path(d, name).as_posix())
+
+    def _failed(self, path, error):
+        self.stats['errors'] += 1
+        if isinstance(error, AlistServerExpcetion) and 'not found' in str(error).lower() \
+                and path not in self._roots:
+            logger.info('[%s] 目录 %s 已经不存在', self.sync.name, path)
+            self._remove_dir(path)
+            self._dirty_at = self._dirty_at or time.monotonic()
+            return
+        logger.warning('[%s] 列出 %s 失败: %r', self.sync.name, path, error)
+        self.schedule.done(path, changed=False)
+
+    def _plan(self):
+        self._dirty_at = None
+        self.stats['plans'] += 1
+        try:
+            plan = self.sync.plan_sync()
+        except Exception as _e:
+            logger.error('[%s] 计算复制计划失败: %r', self.sync.name, _e)
+            return
+        added = self.copies.push(plan)
+        sent = self.copies.dispatch()
+        if added:
+            logger.info('[%s] 复制计划 %d 个操作, 新加入 %d, 发送 %d', self.sync.name, len(plan), added, sent)
+
+    def _persist(self):
+        for op in (self.sync.files_record, self.sync.dir_index):
+            getattr(op, 'flush', op.dumps_data)()
+
+    def report(self) -> dict:
+        now = time.monotonic()
+        report = dict(self.stats, dirs=len(self.schedule), overdue=self.schedule.overdue(now),
+                      queued_copies=len(self.copies), inflight_bytes=self.copies.inflight_bytes,
+                      copies=dict(self.copies.stats))
+        logger.info('[%s] 状态: %s', self.sync.name, report)
+        if METRICS.enabled:
+            for key in ('dirs', 'overdue', 'queued_copies', 'inflight_bytes'):
+                METRICS.set(f'watch_{key}', report[key], group=self.sync.name)
+        return report
+
+    def run(self):
+        """阻塞运行直到 stop"""
+        self.sync.copy_tracker.start()
+        self.warm()
+        listing = dict()  # Future -> path
+        last_report = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='watch_list') as executor:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                for path in self.schedule.pop_due(now, self.workers - len(listing)):
+                    listing[executor.submit(self._list, path, self.bucket.reserve())] = path
+
+                if self._dirty_at is not None and now - self._dirty_at >= self.settle:
+                    self._plan()
+                if now - last_report >= self.report_interval:
+                    self._persist()
+                    self.report()
+                    last_report = now
+
+                next_due = self.schedule.next_due()
+                timeout = min(1.0, max(0.0, next_due - now)) if next_due is not None else 1.0
+                if not listing:
+                    self._stop.wait(timeout)
+                    continue
+                done, _ = wait(listing, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = listing.pop(future)
+                    self.stats['polls'] += 1
+                    if METRICS.enabled:
+                        METRICS.inc('watch_polls_total', group=self.sync.name)
+                    try:
+                        entries = future.result()
+                    except Exception as _e:
+                        self._failed(path, _e)
+                        continue
+                    self.schedule.done(path, self._apply(path, entries))
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        self.copies.close()
+        for op in (self.sync.files_record, self.sync.dir_index, self.sync.update_cache):
+            op.dumps_data()
+        return self.report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='常驻运行 sync_group, 按时间表重新列出目录并复制')
+    parser.add_argument('config', nargs='?', default='config.json')
+    parser.add_argument('--groups', help='只运行这些 group, 逗号分隔')
+    parser.add_argument('--server-concurrency', type=int, default=16, help='每个 Alist 服务器的并发请求数')
+    args = parser.parse_args(argv)
+
+    conf = json.loads(open(args.config, encoding='utf8').read())
+    groups = conf['sync_group']
+    if args.groups:
+        wanted = set(args.groups.split(','))
+        groups = [g for g in groups if g.get('name') in wanted]
+    server_limits = conf.get('server_concurrency') or dict()
+    hosts = {urllib.parse.urlsplit(g['alist_prefix']).netloc for g in groups}
+    limits = {h: threading.BoundedSemaphore(server_limits.get(h, args.server_concurrency)) for h in hosts}
+
+    watchers = [Watcher(Sync(group, limits=limits), **group.get('watch', dict())) for group in groups]
+    threads = [threading.Thread(target=w.run, name=f'watch_{w.sync.name}') for w in watchers]
+
+    def stop(signum, frame):
+        logger.info('收到信号 %d, 停止 ...', signum)
+        for w in watchers:
+            w.stop()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for t in threads:
+        t.start()
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(0.5)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+
+    if os.path.exists('logger_config.yml'):
+        import logging.config, yaml
+
+        logging.config.dictConfig(yaml.safe_load(open('logger_config.yml').read()))
+    else:
+        logging.basicConfig(level=logging.INFO)
+    sys.exit(main())